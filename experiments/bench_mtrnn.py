@@ -0,0 +1,68 @@
+"""Cost of every additional MTRNN resolution.
+
+Times the forward (and backward) pass of a MTRNNCell over one batch of lag
+states for an increasing list of frequencies, e.g. [1], [1, 2], [1, 2, 4]:
+
+    python bench_mtrnn.py --freqs=1,2,4,8 --hidden_size=16 --num_lags=8
+"""
+
+from __future__ import print_function
+
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from trnn import MTRNNCell
+
+flags = tf.flags
+flags.DEFINE_string("freqs", "1,2,4", "frequencies of the resolutions")
+flags.DEFINE_integer("batch_size", 128, "batch size")
+flags.DEFINE_integer("input_size", 8, "input size")
+flags.DEFINE_integer("hidden_size", 16, "hidden layer size")
+flags.DEFINE_integer("num_lags", 8, "num prev hiddens")
+flags.DEFINE_integer("rank", 4, "rank for tt decomposition")
+flags.DEFINE_integer("num_orders", 2, "tensor prod order")
+flags.DEFINE_string("contraction", "fused", "tt contraction: 'outer' or 'fused'")
+flags.DEFINE_integer("num_iters", 100, "timed runs")
+FLAGS = flags.FLAGS
+
+
+def _time(sess, fetch, num_iters):
+    for _ in range(10):
+        sess.run(fetch)
+    start = time.time()
+    for _ in range(num_iters):
+        sess.run(fetch)
+    return 1e3 * (time.time() - start) / num_iters
+
+
+def main(_):
+    freqs = [int(f) for f in FLAGS.freqs.split(",")]
+    rank_vals = [FLAGS.rank] * (FLAGS.num_orders - 1)
+    results = []
+    for num_res in range(1, len(freqs) + 1):
+        tf.reset_default_graph()
+        inputs = tf.constant(np.random.rand(FLAGS.batch_size, FLAGS.input_size), tf.float32)
+        states = [tf.constant(np.random.rand(FLAGS.batch_size, FLAGS.hidden_size), tf.float32)
+                  for _ in range(FLAGS.num_lags)]
+        cell = MTRNNCell(FLAGS.hidden_size, FLAGS.num_lags, freqs[:num_res], rank_vals,
+                         contraction=FLAGS.contraction)
+        with tf.variable_scope("mtrnn"):
+            output, _ = cell(inputs, states)
+        grads = tf.gradients(tf.reduce_sum(output), tf.trainable_variables())
+        with tf.Session() as sess:
+            sess.run(tf.global_variables_initializer())
+            fwd = _time(sess, output, FLAGS.num_iters)
+            bwd = _time(sess, grads, FLAGS.num_iters)
+        results.append((freqs[:num_res], fwd, bwd))
+
+    print('='*80)
+    print('%-20s %10s %10s %12s' % ('freqs', 'fwd ms', 'fwd+bwd ms', 'added fwd ms'))
+    for k, (res_freqs, fwd, bwd) in enumerate(results):
+        added = fwd - results[k - 1][1] if k else 0.0
+        print('%-20s %10.3f %10.3f %12.3f' % (res_freqs, fwd, bwd, added))
+
+
+if __name__ == "__main__":
+    tf.app.run()
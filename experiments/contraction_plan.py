@@ -0,0 +1,146 @@
+"""Contraction order planning for tensor network einsums."""
+
+from __future__ import print_function
+
+from functools import reduce
+
+# plans are memoized per (inputs, output, index sizes) signature, so that
+# every unrolled time step and every layer of a cell reuses the same plan
+_PLAN_CACHE = {}
+
+
+def _size(indices, size_dict):
+    return reduce(lambda n, ix: n * size_dict[ix], indices, 1)
+
+
+def _result_indices(mask, inputs, output):
+    """Indices that survive contracting the inputs selected by mask: the ones
+    still shared with the output or with an input outside of mask"""
+    inside, outside = set(), set(output)
+    for i, indices in enumerate(inputs):
+        if mask >> i & 1:
+            inside.update(indices)
+        else:
+            outside.update(indices)
+    return inside & outside
+
+
+def _search(inputs, output, size_dict):
+    """Exhaustive dynamic programming over subsets of the inputs.
+    The cost of a pairwise contraction is its number of multiply-adds, i.e.
+    the size of the union of both index sets; ties are broken on the largest
+    intermediate kept alive (memory)."""
+    num_inputs = len(inputs)
+    best = {}
+    kept = {}
+    for i in range(num_inputs):
+        best[1 << i] = (0, 0, i)
+        kept[1 << i] = set(inputs[i])
+
+    for mask in range(1, 1 << num_inputs):
+        if mask in best:
+            continue
+        kept[mask] = _result_indices(mask, inputs, output)
+        mem = _size(kept[mask], size_dict)
+        candidate = None
+        left = (mask - 1) & mask
+        while left:
+            right = mask ^ left
+            if left < right:
+                flops_l, peak_l, tree_l = best[left]
+                flops_r, peak_r, tree_r = best[right]
+                flops = flops_l + flops_r + _size(kept[left] | kept[right], size_dict)
+                peak = max(peak_l, peak_r, mem)
+                if candidate is None or (flops, peak) < candidate[:2]:
+                    candidate = (flops, peak, (tree_l, tree_r))
+            left = (left - 1) & mask
+        best[mask] = candidate
+    full = (1 << num_inputs) - 1
+    return best[full], kept
+
+
+def _ordered(indices, first, second):
+    """Deterministic index order: first appearance in first + second"""
+    return "".join(ix for ix in dict.fromkeys(first + second) if ix in indices)
+
+
+def plan_contraction(inputs, output, size_dict):
+    """Cheapest pairwise contraction order for the einsum inputs -> output.
+
+    inputs: list of index strings, one per operand
+    output: index string of the result
+    size_dict: index -> dimension
+    Returns a tuple of (i, j, einsum) steps with i < j: operands i and j are
+    popped from the working list of operands, contracted with einsum and the
+    result is appended to the list. The last step produces output.
+    """
+    key = (tuple(inputs), output, tuple(sorted(size_dict.items())))
+    if key in _PLAN_CACHE:
+        return _PLAN_CACHE[key]
+
+    if len(inputs) == 1:
+        plan = ()
+    else:
+        (_, _, tree), _ = _search(inputs, output, size_dict)
+
+        # flatten the contraction tree into steps over a working list
+        working = list(inputs)
+        nodes = list(range(len(inputs)))
+        steps = []
+        remaining = [len(inputs) - 1]
+
+        def _visit(node):
+            if not isinstance(node, tuple):
+                return node
+            left, right = _visit(node[0]), _visit(node[1])
+            i, j = sorted((nodes.index(left), nodes.index(right)))
+            a, b = working[i], working[j]
+            remaining[0] -= 1
+            if remaining[0] == 0:
+                c = output
+            else:
+                rest = set(output)
+                for k, indices in enumerate(working):
+                    if k not in (i, j):
+                        rest.update(indices)
+                c = _ordered(rest & set(a + b), a, b)
+            steps.append((i, j, "%s,%s->%s" % (a, b, c)))
+            for k in (j, i):
+                working.pop(k)
+                nodes.pop(k)
+            working.append(c)
+            nodes.append(node)
+            return node
+
+        _visit(tree)
+        plan = tuple(steps)
+
+    _PLAN_CACHE[key] = plan
+    return plan
+
+
+def plan_cost(inputs, output, size_dict, plan):
+    """(flops, peak intermediate size) of executing plan"""
+    working = list(inputs)
+    flops, peak = 0, 0
+    for i, j, einsum in plan:
+        a, b = working[i], working[j]
+        c = einsum.split("->")[1]
+        flops += _size(set(a + b), size_dict)
+        peak = max(peak, _size(c, size_dict))
+        working.pop(j)
+        working.pop(i)
+        working.append(c)
+    return flops, peak
+
+
+def tt_einsum_network(num_orders):
+    """Index strings of the tt contraction of a [batch, D, ..., D] state
+    tensor with num_orders cores [r_i, D, r_{i+1}]. The leading dummy rank
+    (r_0 = 1) is kept in the output."""
+    abc = "abcdefgh"
+    ijk = "ijklmnopqrstuvwxy"
+    inputs = ["z" + ijk[:num_orders]]
+    inputs += ["%s%s%s" % (abc[i], ijk[i], abc[i + 1]) for i in range(num_orders)]
+    output = "z" + abc[0] + abc[num_orders]
+    return inputs, output
@@ -0,0 +1,55 @@
+"""tf.data input pipelines of the DataSet, DataSetS2S and MNISTDataSet sources.
+
+The batches are prepared by parallel map calls and prefetched while the
+training step runs, instead of next_batch and feed_dict on the training
+thread. The map calls run source.gather in tf.py_func, which holds the GIL:
+they overlap with the training step, but num_parallel_calls gives little
+speedup to sources that are Python loops, such as the MNISTDataSet videos
+(see mnist_producer.py for worker processes):
+
+    enc_inps, dec_inps, dec_outs = batch_tensors(dataset.train, batch_size)
+    X = tf.placeholder_with_default(enc_inps, [None, inp_steps, num_input])
+"""
+
+from __future__ import print_function
+
+import numpy as np
+import tensorflow as tf
+
+
+def batch_pipeline(source, batch_size, shuffle=True, num_parallel_calls=4, prefetch_batches=2, seed=None):
+    """Endless tf.data.Dataset of the batches of source.
+
+    The example indices are shuffled and batched first, then a parallel map
+    gathers (or synthesizes) every batch with source.gather in a py_func, and
+    prefetch_batches batches are kept ready. The epochs follow each other
+    without a gap, an epoch is num_examples / batch_size steps.
+    Every gather call draws from its own RandomState seeded with (seed, batch
+    index), the concurrent calls share no random state.
+    """
+    # number and shapes of the arrays of a batch
+    example = source.gather(np.arange(1))
+    shapes = [(None,) + arr.shape[1:] for arr in example]
+    base_seed = np.random.randint(2**31) if seed is None else seed
+
+    def _gather_seeded(index, rows):
+        return source.gather(rows, seed=(base_seed, int(index) % 2**32))
+
+    def _gather(index, rows):
+        arrays = tf.py_func(_gather_seeded, [index, rows], [tf.float32] * len(shapes))
+        for arr, shape in zip(arrays, shapes):
+            arr.set_shape(shape)
+        return tuple(arrays)
+
+    rows = tf.data.Dataset.range(source.num_examples)
+    if shuffle:
+        rows = rows.shuffle(source.num_examples, seed=seed)
+    rows = rows.repeat().batch(batch_size)
+    batches = tf.data.Dataset.zip((tf.data.Dataset.range(np.iinfo(np.int64).max), rows))
+    return batches.map(_gather, num_parallel_calls=num_parallel_calls).prefetch(prefetch_batches)
+
+
+def batch_tensors(source, batch_size, **kwargs):
+    """Next batch tensors of batch_pipeline(source, batch_size, **kwargs),
+    every sess.run that uses them takes a new batch"""
+    return batch_pipeline(source, batch_size, **kwargs).make_one_shot_iterator().get_next()
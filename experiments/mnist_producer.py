@@ -0,0 +1,129 @@
+"""Moving MNIST batches synthesized by a pool of worker processes.
+
+The workers write the videos of their batches into a ring of preallocated
+slots in shared memory. The slot numbers go around two queues: free slots
+to the workers, filled slots to the trainer. The trainer reads the batch
+arrays in place (no copy) and the slot goes back to the workers on its next
+call:
+
+    producer = MNISTBatchProducer(dataset.train, batch_size, num_workers=4)
+    batch_x, batch_y, batch_z = producer.next_batch()
+    ...
+    producer.close()
+
+The epochs follow one shared permutation each, whose batches are split
+between the workers, and every batch draws its trajectories from its own
+RandomState. Everything the workers get is picklable, so the producer also
+works with the spawn start method.
+"""
+
+from __future__ import print_function
+
+import ctypes
+import multiprocessing
+
+import numpy as np
+
+from reader import _decoder_inputs
+
+
+def _slot_arrays(buffer, batch_size, video_shape, dec_inps_shape, queue_depth):
+    """(video, dec_inps) arrays of every slot of the shared buffer"""
+    video_size = batch_size * int(np.prod(video_shape))
+    dec_inps_size = batch_size * int(np.prod(dec_inps_shape))
+    slot_size = video_size + dec_inps_size
+    flat = np.frombuffer(buffer, dtype=np.float32)
+    slots = []
+    for slot in range(queue_depth):
+        start = slot * slot_size
+        video = flat[start:start + video_size].reshape((batch_size,) + video_shape)
+        dec_inps = flat[start + video_size:start + slot_size].reshape((batch_size,) + dec_inps_shape)
+        slots.append((video, dec_inps))
+    return slots
+
+
+def _epoch_permutation(num_examples, seed, epoch):
+    """Shuffled example indices of epoch, the same in every worker"""
+    return np.random.RandomState((seed, 0, epoch)).permutation(num_examples)
+
+
+def _produce(dataset, batch_size, worker, num_workers, seed, buffer, layout, free, ready):
+    """Worker loop: fill the free slots with the batches worker,
+    worker + num_workers, ... of the epochs until a None slot"""
+    slots = _slot_arrays(buffer, batch_size, *layout)
+    num_batches = dataset.num_examples // batch_size # per epoch
+    input_steps = dataset.input_steps_
+    dec_outs_shape = (batch_size,) + layout[1]
+    epoch, perm = None, None
+    batch = worker
+    while True:
+        slot = free.get()
+        if slot is None:
+            return
+        if batch // num_batches != epoch:
+            epoch = batch // num_batches
+            perm = _epoch_permutation(dataset.num_examples, seed, epoch)
+        start = (batch % num_batches) * batch_size
+        rows = perm[start:start + batch_size]
+        video, dec_inps = slots[slot]
+        dataset.gen_video(rows, batch_size, out=video, rng=np.random.RandomState((seed, 1, batch)))
+        _decoder_inputs(video[:, input_steps:].reshape(dec_outs_shape), out=dec_inps)
+        ready.put(slot)
+        batch += num_workers
+
+
+class MNISTBatchProducer(object):
+    """num_workers processes synthesizing batches of an MNISTDataSet into
+    queue_depth shared memory slots. Worker k makes the batches k,
+    k + num_workers, ... of every epoch, the trajectories of batch b come
+    from np.random.RandomState((seed, 1, b)): every batch is deterministic,
+    only their order of arrival is not. An epoch is num_examples //
+    batch_size batches."""
+
+    def __init__(self, dataset, batch_size, num_workers=2, queue_depth=4, seed=0):
+        if queue_depth < 2:
+            raise ValueError("queue_depth %d, the trainer holds one slot." % queue_depth)
+        if dataset.num_examples < batch_size:
+            raise ValueError("%d examples, less than a batch of %d." % (dataset.num_examples, batch_size))
+        self._batch_size = batch_size
+        self._input_steps = dataset.input_steps_
+        self._output_steps = dataset.output_steps_
+        self._frame_size = dataset.frame_size_
+        video_shape = (dataset.seq_length_, dataset.image_size_, dataset.image_size_)
+        dec_inps_shape = (dataset.output_steps_, dataset.frame_size_)
+        layout = (video_shape, dec_inps_shape, queue_depth)
+        slot_size = batch_size * (int(np.prod(video_shape)) + int(np.prod(dec_inps_shape)))
+        self._buffer = multiprocessing.RawArray(ctypes.c_float, queue_depth * slot_size)
+        self._slots = _slot_arrays(self._buffer, batch_size, *layout)
+
+        self._free = multiprocessing.Queue()
+        self._ready = multiprocessing.Queue()
+        for slot in range(queue_depth):
+            self._free.put(slot)
+        self._current = None
+        self._workers = [multiprocessing.Process(target=_produce,
+                                                 args=(dataset, batch_size, k, num_workers, seed,
+                                                       self._buffer, layout, self._free, self._ready))
+                         for k in range(num_workers)]
+        for worker in self._workers:
+            worker.daemon = True
+            worker.start()
+
+    def next_batch(self):
+        """(enc_inps, dec_inps, dec_outs) of the next filled slot, views of
+        the shared memory valid until the next call"""
+        if self._current is not None:
+            self._free.put(self._current)
+        self._current = self._ready.get()
+        video, dec_inps = self._slots[self._current]
+        enc_inps = video[:, :self._input_steps].reshape((self._batch_size, self._input_steps, self._frame_size))
+        dec_outs = video[:, self._input_steps:].reshape((self._batch_size, self._output_steps, self._frame_size))
+        return enc_inps, dec_inps, dec_outs
+
+    def close(self):
+        for _ in self._workers:
+            self._free.put(None)
+        for worker in self._workers:
+            worker.join(timeout=1.0)
+            if worker.is_alive():
+                worker.terminate()
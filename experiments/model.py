@@ -6,6 +6,12 @@ from tensorflow.contrib import rnn
 from trnn import *
 from trnn_imply import *
 
+def _run_rnn(rnn_fn, cell, inputs, is_training, config):
+    """rnn_fn, from carried states when training with truncated BPTT"""
+    if is_training and config.carry_state:
+        return rnn_with_carried_state(rnn_fn, cell, inputs, is_training, config)
+    return rnn_fn(cell, inputs, is_training, config)
+
 def LSTM(inputs, is_training, config):
 
     # Prepare data shape to match `rnn` function requirements
@@ -20,31 +26,27 @@ def LSTM(inputs, is_training, config):
         [lstm_cell() for _ in range(config.num_layers)])
 
     # Get lstm cell output
-    outputs, state  = rnn_with_feed_prev(cell, inputs, is_training, config)
+    outputs, state  = _run_rnn(rnn_with_feed_prev, cell, inputs, is_training, config)
     return outputs
 
 def MLSTM(inputs, is_training, config):
     def mlstm_cell():
         return MatrixLSTMCell(config.hidden_size,config.num_lags)
     cell = mlstm_cell()
-    if is_training and config.keep_prob < 1:
-        cell = tf.contrib.rnn.DropoutWrapper(
-          cell, output_keep_prob=config.keep_prob)        
     cell = tf.contrib.rnn.MultiRNNCell(
         [cell for _ in range(config.num_layers)])
-    outputs, state = tensor_rnn_with_feed_prev(cell, inputs, is_training, config) 
+    outputs, state = _run_rnn(tensor_rnn_with_feed_prev, cell, inputs, is_training, config) 
     return outputs  
 
 def TLSTM(inputs, is_training, config):
     def tlstm_cell():
-        return TensorLSTMCell(config.hidden_size, config.num_lags, config.rank_vals)
+        return TensorLSTMCell(config.hidden_size, config.num_lags, config.rank_vals,
+                              contraction=config.contraction,
+                              tt_modes=config.tt_modes, tt_rank=config.tt_rank)
     cell= tlstm_cell() 
-    if is_training and config.keep_prob < 1:
-        cell = tf.contrib.rnn.DropoutWrapper(
-          cell, output_keep_prob=config.keep_prob)        
     cell = tf.contrib.rnn.MultiRNNCell(
         [cell for _ in range(config.num_layers)])
-    outputs, state = tensor_rnn_with_feed_prev(cell, inputs, is_training, config) 
+    outputs, state = _run_rnn(tensor_rnn_with_feed_prev, cell, inputs, is_training, config) 
     return outputs  
 
 def PLSTM(inputs, is_training, config):
@@ -54,7 +56,7 @@ def PLSTM(inputs, is_training, config):
     cell = tf.contrib.rnn.MultiRNNCell(
         [rnn_cell() for _ in range(config.num_layers)])
 
-    outputs, state  = rnn_with_feed_prev(cell, inputs, is_training, config)
+    outputs, state  = _run_rnn(rnn_with_feed_prev, cell, inputs, is_training, config)
     return outputs
 
 def RNN(inputs, is_training, config):
@@ -64,7 +66,7 @@ def RNN(inputs, is_training, config):
     cell = tf.contrib.rnn.MultiRNNCell(
         [rnn_cell() for _ in range(config.num_layers)])
     
-    outputs, state  = rnn_with_feed_prev(cell, inputs, is_training, config)
+    outputs, state  = _run_rnn(rnn_with_feed_prev, cell, inputs, is_training, config)
     return outputs
 
 def MRNN(inputs, is_training, config):
@@ -74,17 +76,18 @@ def MRNN(inputs, is_training, config):
     cell = tf.contrib.rnn.MultiRNNCell(
         [mrnn_cell() for _ in range(config.num_layers)])
     
-    outputs, state  = tensor_rnn_with_feed_prev(cell, inputs, is_training, config)
+    outputs, state  = _run_rnn(tensor_rnn_with_feed_prev, cell, inputs, is_training, config)
     return outputs
 
 def HOLSTM(inputs, is_training, config):
     def holstm_cell():
-        return HighOrderLSTMCell(config.hidden_size,config.num_lags,config.num_orders)
+        return HighOrderLSTMCell(config.hidden_size,config.num_lags,config.num_orders,
+                                 sketch_size=config.sketch_size)
         
     cell = tf.contrib.rnn.MultiRNNCell(
         [holstm_cell() for _ in range(config.num_layers)])
     
-    outputs, state  = tensor_rnn_with_feed_prev(cell, inputs, is_training, config)
+    outputs, state  = _run_rnn(tensor_rnn_with_feed_prev, cell, inputs, is_training, config)
     return outputs
 
 def HORNN(inputs, is_training, config):
@@ -94,25 +97,29 @@ def HORNN(inputs, is_training, config):
     cell = tf.contrib.rnn.MultiRNNCell(
         [hornn_cell() for _ in range(config.num_layers)])
     
-    outputs, state  = tensor_rnn_with_feed_prev(cell, inputs, is_training, config)
+    outputs, state  = _run_rnn(tensor_rnn_with_feed_prev, cell, inputs, is_training, config)
     return outputs
 
 def TRNN(inputs, is_training, config):
     def trnn_cell():
-        return EinsumTensorRNNCell(config.hidden_size, config.num_lags, config.rank_vals)
+        return EinsumTensorRNNCell(config.hidden_size, config.num_lags, config.rank_vals,
+                                   contraction=config.contraction,
+                                   tt_modes=config.tt_modes, tt_rank=config.tt_rank)
         
     cell = tf.contrib.rnn.MultiRNNCell(
         [trnn_cell() for _ in range(config.num_layers)])
     
-    outputs, state  = tensor_rnn_with_feed_prev(cell, inputs, is_training, config)
+    outputs, state  = _run_rnn(tensor_rnn_with_feed_prev, cell, inputs, is_training, config)
     return outputs
 
 def MTRNN(inputs, is_training, config):
     def mtrnn_cell():
-        return MTRNNCell(config.hidden_size, config.num_lags, config.num_freq, config.rank_vals)
+        return MTRNNCell(config.hidden_size, config.num_lags, config.num_freq, config.rank_vals,
+                         contraction=config.contraction,
+                         tt_modes=config.tt_modes, tt_rank=config.tt_rank)
         
     cell = tf.contrib.rnn.MultiRNNCell(
         [mtrnn_cell() for _ in range(config.num_layers)])
     
-    outputs, state  = tensor_rnn_with_feed_prev(cell, inputs, is_training, config)
+    outputs, state  = _run_rnn(tensor_rnn_with_feed_prev, cell, inputs, is_training, config)
     return outputs
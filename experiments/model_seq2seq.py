@@ -1,11 +1,101 @@
 
 from __future__ import print_function
 
+import copy
+
 import tensorflow as tf
 from tensorflow.contrib import rnn
+from tensorflow.python.util import nest
 from trnn import *
 from trnn_imply import *
 
+def tensor_cell(model, config):
+    """One layer cell of the tensor model named model (no dropout), shared by
+    the seq2seq models and the graphs built outside of them"""
+    cells = {
+        "MRNN": lambda: MatrixRNNCell(config.hidden_size,config.num_lags),
+        "MLSTM": lambda: MatrixLSTMCell(config.hidden_size,config.num_lags),
+        "HORNN": lambda: HighOrderRNNCell(config.hidden_size,config.num_lags, config.num_orders,
+                                          sketch_size=config.sketch_size),
+        "HOLSTM": lambda: HighOrderLSTMCell(config.hidden_size,config.num_lags, config.num_orders,
+                                            sketch_size=config.sketch_size),
+        "TRNN": lambda: EinsumTensorRNNCell(config.hidden_size, config.num_lags, config.rank_vals,
+                                            contraction=config.contraction,
+                                            tt_modes=config.tt_modes, tt_rank=config.tt_rank),
+        "TLSTM": lambda: TensorLSTMCell(config.hidden_size, config.num_lags, config.rank_vals,
+                                        contraction=config.contraction,
+                                        tt_modes=config.tt_modes, tt_rank=config.tt_rank),
+        "MTRNN": lambda: MTRNNCell(config.hidden_size, config.num_lags, config.num_freq, config.rank_vals,
+                                   contraction=config.contraction,
+                                   tt_modes=config.tt_modes, tt_rank=config.tt_rank),
+        "TALSTM": lambda: TensorAugLSTMCell(config.hidden_size,config.num_lags, config.rank_vals,
+                                            contraction=config.contraction,
+                                            input_proj_size=config.input_proj_size,
+                                            tt_modes=config.tt_modes, tt_rank=config.tt_rank),
+    }
+    return cells[model]()
+
+def _repeat(tensor, num_samples):
+    """[batch_size, ...] -> [batch_size * num_samples, ...], every example
+    repeated num_samples times in a row"""
+    shape = tensor.get_shape().as_list()
+    tiled = tf.tile(tf.expand_dims(tensor, 1), [1, num_samples] + [1] * (len(shape) - 1))
+    return tf.reshape(tiled, [-1] + shape[1:])
+
+def _seq2seq(rnn_fn, cell, enc_inps, dec_inps, is_training, config):
+    """Encoder then decoder run of cell, the decoder starts from the encoder
+    states. With config.decoder "direct" all the horizons are read off the
+    encoder states at once by direct_horizon_outputs instead.
+
+    At inference with config.num_samples > 1 the encoder states of every
+    example are replicated into num_samples particles, decoded together as
+    one [batch_size * num_samples] batch. The particles differ by the noise on
+    the fed back outputs (config.feedback_noise) and by their dropout masks
+    (config.keep_prob). Returns the forecasts [batch_size, num_samples,
+    num_steps, input_size] then.
+    """
+    # the encoder always takes the ground truth, dropout only when training
+    keep_prob = config.keep_prob if is_training else 1.0
+    enc_config = config
+    if not is_training and config.recompute_segment:
+        # gradient checkpointing in the Train graph only
+        enc_config = copy.copy(config)
+        enc_config.recompute_segment = None
+    with tf.variable_scope("Encoder", reuse=None):
+        enc_outs, enc_states = rnn_fn(cell, enc_inps, True, enc_config, keep_prob=keep_prob)
+
+    if config.decoder == "direct":
+        if not is_training and config.num_samples > 1:
+            raise ValueError("Sampled forecasts need the autoregressive decoder.")
+        num_steps, input_size = dec_inps.get_shape().as_list()[1:]
+        with tf.variable_scope("Decoder", reuse=None):
+            return direct_horizon_outputs(enc_states, num_steps, input_size, config)
+
+    num_samples = 1 if is_training else config.num_samples
+    if num_samples > 1:
+        enc_states = nest.map_structure(lambda state: _repeat(state, num_samples), enc_states)
+        dec_inps = _repeat(dec_inps, num_samples)
+        # Monte Carlo dropout, one mask per particle
+        keep_prob = config.keep_prob
+
+    with tf.variable_scope("Decoder", reuse=None):
+        config.burn_in_steps = 0
+        dec_outs, dec_states = rnn_fn(cell, dec_inps, is_training, config, enc_states, keep_prob=keep_prob)
+
+    if num_samples > 1:
+        dec_outs = tf.reshape(dec_outs, [-1, num_samples] + dec_outs.get_shape().as_list()[1:])
+    return dec_outs
+
+def sample_quantiles(samples, quantiles):
+    """Quantiles [len(quantiles), batch_size, num_steps, input_size] of the
+    sampled forecasts [batch_size, num_samples, num_steps, input_size], one
+    sort of the samples for all quantiles"""
+    num_samples = samples.get_shape()[1].value
+    # descending order along the last axis
+    ordered, _ = tf.nn.top_k(tf.transpose(samples, [0, 2, 3, 1]), k=num_samples)
+    ranks = [int(round((1.0 - q) * (num_samples - 1))) for q in quantiles]
+    return tf.stack([ordered[:, :, :, rank] for rank in ranks])
+
 def LSTM(enc_inps, dec_inps, is_training, config):
 
     # Prepare data shape to match `rnn` function requirements
@@ -21,183 +111,87 @@ def LSTM(enc_inps, dec_inps, is_training, config):
     cell = tf.contrib.rnn.MultiRNNCell(
         [lstm_cell() for _ in range(config.num_layers)])
 
-    # Get encoder output
-    with tf.variable_scope("Encoder", reuse=None):
-        enc_outs, enc_states = rnn_with_feed_prev(cell, enc_inps, True, config)
-    # Get decoder output
-    with tf.variable_scope("Decoder", reuse=None):
-        config.burn_in_steps = 0
-        dec_outs, dec_states = rnn_with_feed_prev(cell, dec_inps, is_training, config, enc_states)
-    
-    return dec_outs
+    # Encoder then decoder output
+    return _seq2seq(rnn_with_feed_prev, cell, enc_inps, dec_inps, is_training, config)
 
 def PLSTM(enc_inps, dec_inps, is_training, config):
     def plstm_cell():
         return tf.contrib.rnn.PhasedLSTMCell(config.hidden_size)
     cell = plstm_cell()
-    if is_training and config.keep_prob < 1:
-        cell = tf.contrib.rnn.DropoutWrapper(
-          cell, output_keep_prob=config.keep_prob)        
     cell = tf.contrib.rnn.MultiRNNCell(
         [cell for _ in range(config.num_layers)])
-    with tf.variable_scope("Encoder", reuse=None):
-        enc_outs, enc_states = rnn_with_feed_prev(cell, enc_inps, True, config)
-
-    with tf.variable_scope("Decoder", reuse=None):
-        config.burn_in_steps = 0
-        dec_outs, dec_states = rnn_with_feed_prev(cell, dec_inps, is_training, config, enc_states) 
-    return dec_outs
+    return _seq2seq(rnn_with_feed_prev, cell, enc_inps, dec_inps, is_training, config)
 
 
 def RNN(enc_inps, dec_inps,is_training, config):
     def rnn_cell():
         return tf.contrib.rnn.BasicRNNCell(config.hidden_size)
-    if is_training and config.keep_prob < 1:
-        cell = tf.contrib.rnn.DropoutWrapper(
-          rnn_cell(), output_keep_prob=config.keep_prob)        
     cell = tf.contrib.rnn.MultiRNNCell(
         [rnn_cell() for _ in range(config.num_layers)])
-    with tf.variable_scope("Encoder", reuse=None):
-        enc_outs, enc_states = rnn_with_feed_prev(cell, enc_inps, True, config)
-
-    with tf.variable_scope("Decoder", reuse=None):
-        config.burn_in_steps = 0
-        dec_outs, dec_states = rnn_with_feed_prev(cell, dec_inps, is_training, config, enc_states) 
-    return dec_outs    
+    return _seq2seq(rnn_with_feed_prev, cell, enc_inps, dec_inps, is_training, config)
 
 
 def MRNN(enc_inps, dec_inps, is_training, config):
     def mrnn_cell():
-        return MatrixRNNCell(config.hidden_size,config.num_lags)
+        return tensor_cell("MRNN", config)
     cell = mrnn_cell()
-    if is_training and config.keep_prob < 1:
-        cell = tf.contrib.rnn.DropoutWrapper(
-          cell, output_keep_prob=config.keep_prob)        
     cell = tf.contrib.rnn.MultiRNNCell(
         [cell for _ in range(config.num_layers)])
-    with tf.variable_scope("Encoder", reuse=None):
-        enc_outs, enc_states = tensor_rnn_with_feed_prev(cell, enc_inps, True, config)
-
-    with tf.variable_scope("Decoder", reuse=None):
-        config.burn_in_steps = 0
-        dec_outs, dec_states = tensor_rnn_with_feed_prev(cell, dec_inps, is_training, config, enc_states) 
-    return dec_outs    
+    return _seq2seq(tensor_rnn_with_feed_prev, cell, enc_inps, dec_inps, is_training, config)
 
 def MLSTM(enc_inps, dec_inps, is_training, config):
     def mlstm_cell():
-        return MatrixLSTMCell(config.hidden_size,config.num_lags)
+        return tensor_cell("MLSTM", config)
     cell = mlstm_cell()
-    if is_training and config.keep_prob < 1:
-        cell = tf.contrib.rnn.DropoutWrapper(
-          cell, output_keep_prob=config.keep_prob)        
     cell = tf.contrib.rnn.MultiRNNCell(
         [cell for _ in range(config.num_layers)])
-    with tf.variable_scope("Encoder", reuse=None):
-        enc_outs, enc_states = tensor_rnn_with_feed_prev(cell, enc_inps, True, config)
-
-    with tf.variable_scope("Decoder", reuse=None):
-        config.burn_in_steps = 0
-        dec_outs, dec_states = tensor_rnn_with_feed_prev(cell, dec_inps, is_training, config, enc_states) 
-    return dec_outs  
+    return _seq2seq(tensor_rnn_with_feed_prev, cell, enc_inps, dec_inps, is_training, config)
 
 def HORNN(enc_inps, dec_inps, is_training, config):
     def hornn_cell():
-        return HighOrderRNNCell(config.hidden_size,config.num_lags, config.num_orders)
+        return tensor_cell("HORNN", config)
     cell = hornn_cell()
-    if is_training and config.keep_prob < 1:
-        cell = tf.contrib.rnn.DropoutWrapper(
-          cell, output_keep_prob=config.keep_prob)        
     cell = tf.contrib.rnn.MultiRNNCell(
         [cell for _ in range(config.num_layers)])
-    with tf.variable_scope("Encoder", reuse=None):
-        enc_outs, enc_states = tensor_rnn_with_feed_prev(cell, enc_inps, True, config)
-
-    with tf.variable_scope("Decoder", reuse=None):
-        config.burn_in_steps = 0
-        dec_outs, dec_states = tensor_rnn_with_feed_prev(cell, dec_inps, is_training, config, enc_states) 
-    return dec_outs    
+    return _seq2seq(tensor_rnn_with_feed_prev, cell, enc_inps, dec_inps, is_training, config)
 
 def HOLSTM(enc_inps, dec_inps, is_training, config):
     def holstm_cell():
-        return HighOrderLSTMCell(config.hidden_size,config.num_lags, config.num_orders)
+        return tensor_cell("HOLSTM", config)
     cell = holstm_cell()
-    if is_training and config.keep_prob < 1:
-        cell = tf.contrib.rnn.DropoutWrapper(
-          cell, output_keep_prob=config.keep_prob)        
     cell = tf.contrib.rnn.MultiRNNCell(
         [cell for _ in range(config.num_layers)])
-    with tf.variable_scope("Encoder", reuse=None):
-        enc_outs, enc_states = tensor_rnn_with_feed_prev(cell, enc_inps, True, config)
-
-    with tf.variable_scope("Decoder", reuse=None):
-        config.burn_in_steps = 0
-        dec_outs, dec_states = tensor_rnn_with_feed_prev(cell, dec_inps, is_training, config, enc_states) 
-    return dec_outs    
+    return _seq2seq(tensor_rnn_with_feed_prev, cell, enc_inps, dec_inps, is_training, config)
 
 def TRNN(enc_inps, dec_inps, is_training, config):
     def trnn_cell():
-        return EinsumTensorRNNCell(config.hidden_size, config.num_lags, config.rank_vals)
+        return tensor_cell("TRNN", config)
     cell= trnn_cell() 
-    if is_training and config.keep_prob < 1:
-        cell = tf.contrib.rnn.DropoutWrapper(
-          cell, output_keep_prob=config.keep_prob)        
     cell = tf.contrib.rnn.MultiRNNCell(
         [cell for _ in range(config.num_layers)])
-    with tf.variable_scope("Encoder", reuse=None):
-        enc_outs, enc_states = tensor_rnn_with_feed_prev(cell, enc_inps, True, config)
-
-    with tf.variable_scope("Decoder", reuse=None):
-        config.burn_in_steps = 0
-        dec_outs, dec_states = tensor_rnn_with_feed_prev(cell, dec_inps, is_training, config, enc_states) 
-    return dec_outs    
+    return _seq2seq(tensor_rnn_with_feed_prev, cell, enc_inps, dec_inps, is_training, config)
 
 def TLSTM(enc_inps, dec_inps, is_training, config):
     def tlstm_cell():
-        return TensorLSTMCell(config.hidden_size, config.num_lags, config.rank_vals)
+        return tensor_cell("TLSTM", config)
     cell= tlstm_cell() 
-    if is_training and config.keep_prob < 1:
-        cell = tf.contrib.rnn.DropoutWrapper(
-          cell, output_keep_prob=config.keep_prob)        
     cell = tf.contrib.rnn.MultiRNNCell(
         [cell for _ in range(config.num_layers)])
-    with tf.variable_scope("Encoder", reuse=None):
-        enc_outs, enc_states = tensor_rnn_with_feed_prev(cell, enc_inps, True, config)
-    with tf.variable_scope("Decoder", reuse=None):
-        config.burn_in_steps = 0
-        dec_outs, dec_states = tensor_rnn_with_feed_prev(cell, dec_inps, is_training, config, enc_states) 
-    return dec_outs   
+    return _seq2seq(tensor_rnn_with_feed_prev, cell, enc_inps, dec_inps, is_training, config)
 
 def MTRNN(enc_inps, dec_inps, is_training, config):
     def mtrnn_cell():
-        return MTRNNCell(config.hidden_size, config.num_lags, config.num_freq, config.rank_vals)
+        return tensor_cell("MTRNN", config)
     cell= mtrnn_cell()
-    if is_training and config.keep_prob < 1:
-        cell = tf.contrib.rnn.DropoutWrapper(
-          cell, output_keep_prob=config.keep_prob)        
     cell = tf.contrib.rnn.MultiRNNCell(
         [cell for _ in range(config.num_layers)])
-    with tf.variable_scope("Encoder", reuse=None):
-        enc_outs, enc_states = tensor_rnn_with_feed_prev(cell, enc_inps, True, config)
-
-    with tf.variable_scope("Decoder", reuse=None):
-        config.burn_in_steps = 0
-        dec_outs, dec_states = tensor_rnn_with_feed_prev(cell, dec_inps, is_training, config, enc_states) 
-    return dec_outs    
+    return _seq2seq(tensor_rnn_with_feed_prev, cell, enc_inps, dec_inps, is_training, config)
 
 
 def TALSTM(enc_inps, dec_inps, is_training, config):
     def talstm_cell():
-        return TensorAugLSTMCell(config.hidden_size,config.num_lags, config.rank_vals)
+        return tensor_cell("TALSTM", config)
     cell = talstm_cell()
-    if is_training and config.keep_prob < 1:
-        cell = tf.contrib.rnn.DropoutWrapper(
-          cell, output_keep_prob=config.keep_prob)        
     cell = tf.contrib.rnn.MultiRNNCell(
         [cell for _ in range(config.num_layers)])
-    with tf.variable_scope("Encoder", reuse=None):
-        enc_outs, enc_states = tensor_rnn_with_feed_prev(cell, enc_inps, True, config)
-
-    with tf.variable_scope("Decoder", reuse=None):
-        config.burn_in_steps = 0
-        dec_outs, dec_states = tensor_rnn_with_feed_prev(cell, dec_inps, is_training, config, enc_states) 
-    return dec_outs  
+    return _seq2seq(tensor_rnn_with_feed_prev, cell, enc_inps, dec_inps, is_training, config)
@@ -24,45 +24,152 @@ def slide_window(a, window):
     return inp, out
 
 
-def normalize_columns(arr):
-    def _norm_col(arr):
-        stats = np.zeros((2,))
-        stats[0] = arr.min()
-        stats[1] = arr.max()
-        if abs(stats[0] - stats[1]) < 1e-10:
-            pass 
+class MinMaxScaler(object):
+    """Per column (last axis) scaling to (0-1) with the min and max of the
+    fitted data. Fitted in one vectorized pass, or incrementally over chunks
+    with partial_fit. Constant columns are left as they are. Saved next to
+    the checkpoints, so that serving code rescales without the history."""
+
+    def __init__(self, data_min=None, data_max=None):
+        self.data_min = data_min
+        self.data_max = data_max
+
+    @property
+    def stats(self):
+        """[min, max] per column, [2, dim]"""
+        return np.stack((self.data_min, self.data_max))
+
+    def partial_fit(self, chunk):
+        chunk = np.asarray(chunk)
+        chunk = chunk.reshape((-1, chunk.shape[-1]))
+        chunk_min, chunk_max = chunk.min(axis=0), chunk.max(axis=0)
+        if self.data_min is None:
+            self.data_min, self.data_max = chunk_min.astype(np.float64), chunk_max.astype(np.float64)
         else:
-            arr = (arr - arr.min() ) / (arr.max() - arr.min()) 
-        return arr, stats
-    # Normalize each feature dimension
-    n_dim = arr.shape[-1]
-    stats = np.zeros((2,n_dim))
-    if np.ndim(arr) ==2:
-        for d in range(n_dim):
-            arr[:,d], stats[:,d]= _norm_col(arr[:,d])
-    elif np.ndim(arr)==3:
-        for d in range(n_dim):
-            arr[:,:,d], stats[:,d] = _norm_col(arr[:,:,d])  
-    return arr, stats
+            np.minimum(self.data_min, chunk_min, out=self.data_min)
+            np.maximum(self.data_max, chunk_max, out=self.data_max)
+        return self
+
+    def fit(self, data, chunk_size=65536):
+        """Fit on data [..., dim] in chunks of the first axis, data can be
+        memory-mapped"""
+        self.data_min = self.data_max = None
+        for start in range(0, len(data), chunk_size):
+            self.partial_fit(data[start:start + chunk_size])
+        return self
+
+    def _offset_scale(self):
+        span = self.data_max - self.data_min
+        const = np.abs(span) < 1e-10
+        return np.where(const, 0.0, self.data_min), np.where(const, 1.0, span)
+
+    def transform(self, arr, out=None):
+        """Scaled arr, written into out if given (can be arr), float32 for
+        float32 arr"""
+        offset, scale = self._offset_scale()
+        if out is None:
+            out = np.empty(np.shape(arr), dtype=np.result_type(arr, np.float32))
+        np.subtract(arr, offset, out=out)
+        np.divide(out, scale, out=out)
+        return out
+
+    def inverse_transform(self, arr, out=None):
+        """Original values of the scaled arr, written into out if given"""
+        offset, scale = self._offset_scale()
+        if out is None:
+            out = np.empty(np.shape(arr), dtype=np.result_type(arr, np.float32))
+        np.multiply(arr, scale, out=out)
+        np.add(out, offset, out=out)
+        return out
+
+    def save(self, path):
+        np.savez(path, data_min=self.data_min, data_max=self.data_max)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as f:
+            return cls(f["data_min"], f["data_max"])
+
+
+def normalize_columns(arr):
+    """Normalize each feature dimension to (0-1) in place, returns (arr,
+    [min, max] per column)"""
+    scaler = MinMaxScaler().fit(arr)
+    return scaler.transform(arr, out=arr), scaler.stats
 
 def denormalize_colums(arr, stats):
-    def _denorm_col(arr, stats):
-        arr  = arr  * (stats[1]- stats[0]) +  stats[0]
-        return arr
-    
-    n_dim = arr.shape[-1]
-    for d in range(n_dim):
-        arr[:,:,d]  = _denorm_col(arr[:,:,d], stats[:,d])
-    return arr
-                    
+    """Inverse of normalize_columns with its stats, in place"""
+    return MinMaxScaler(stats[0], stats[1]).inverse_transform(arr, out=arr)
+
+def _decoder_inputs(dec_outs, out=None):
+    """SOS followed by dec_outs shifted by one step"""
+    if out is None or out.shape != dec_outs.shape:
+        out = np.empty_like(dec_outs)
+    out[:, 0] = SOS
+    out[:, 1:] = dec_outs[:, :-1]
+    return out
+
+def _next_rows(dataset, batch_size, shuffle):
+    """Example indices of the next batch of dataset (DataSet or DataSetS2S),
+    shuffled through the permutation dataset._perm instead of the data"""
+    start = dataset._index_in_epoch
+    num_examples = dataset._num_examples
+    # Shuffle for the first epoch
+    if dataset._epochs_completed == 0 and start == 0 and shuffle:
+        np.random.shuffle(dataset._perm)
+    # Go to the next epoch
+    if start + batch_size > num_examples:
+        # Finished epoch
+        dataset._epochs_completed += 1
+        # Get the rest examples in this epoch
+        rest_rows = dataset._perm[start:num_examples]
+        # Shuffle the data
+        if shuffle:
+            dataset._perm = np.random.permutation(num_examples)
+        # Start next epoch
+        dataset._index_in_epoch = batch_size - len(rest_rows)
+        return np.concatenate((rest_rows, dataset._perm[:dataset._index_in_epoch]))
+    dataset._index_in_epoch += batch_size
+    return dataset._perm[start:dataset._index_in_epoch]
+
+def _take_rows(arrays, rows, buffers=None):
+    """Gather the rows of every array of arrays into buffers, preallocated
+    arrays reallocated only when the batch size changes"""
+    if buffers is None or len(buffers[0]) != len(rows):
+        buffers = tuple(np.empty((len(rows),) + array.shape[1:], dtype=array.dtype) for array in arrays)
+    for array, buf in zip(arrays, buffers):
+        # mode="clip" writes into buf directly, "raise" would buffer
+        np.take(array, rows, axis=0, out=buf, mode="clip")
+    return buffers
+
+def _take_normalized_rows(arrays, rows, scaler, buffers=None):
+    """_take_rows of arrays normalized with scaler (if any) into float32
+    batches. np.take does not cast, the rows of raw (e.g. integer or float64)
+    arrays are gathered in their dtype and the scaler writes them into float32
+    buffers. Returns (gathered, batches), pass it back as buffers."""
+    gathered = _take_rows(arrays, rows, None if buffers is None else buffers[0])
+    if scaler is None:
+        return gathered, gathered
+    batches = None if buffers is None or buffers[0] is not gathered else buffers[1]
+    if batches is None:
+        batches = tuple(buf if buf.dtype == np.float32 else np.empty(buf.shape, dtype=np.float32)
+                        for buf in gathered)
+    for buf, batch in zip(gathered, batches):
+        scaler.transform(buf, out=batch)
+    return gathered, batches
+
 class DataSet(object):
 
     def __init__(self,
                      data,
                      num_steps,
-                     seed=None):
+                     num_test_steps=None,
+                     seed=None,
+                     scaler=None):
         """Construct a DataSet.
         Seed arg provides for convenient deterministic testing.
+        scaler: MinMaxScaler of raw (e.g. memory-mapped) data, the batches
+        are normalized with it. None: data is normalized already.
         """
         seed1, seed2 = random_seed.get_seed(seed)
         # If op level seed is not set, use whatever graph level seed is returned
@@ -79,16 +186,25 @@ class DataSet(object):
         self._num_examples = inps.shape[0]
         self._inps = inps
         self._outs = outs
+        # the windows stay strided views, batches are gathered through perm
+        self._perm = np.arange(self._num_examples)
+        self._buffers = None
+        self._scaler = scaler
         self._epochs_completed = 0
         self._index_in_epoch = 0
 
+    def _normalized(self, arr):
+        if self._scaler is None:
+            return arr
+        return self._scaler.transform(arr)
+
     @property
     def inps(self):
-        return self._inps
+        return self._normalized(self._inps)
 
     @property
     def outs(self):
-        return self._outs
+        return self._normalized(self._outs)
 
     @property
     def num_examples(self):
@@ -99,49 +215,32 @@ class DataSet(object):
         return self._epochs_completed
 
     def next_batch(self, batch_size, shuffle=True):
-        """Return the next `batch_size` examples from this data set."""
-
-        start = self._index_in_epoch
-        # Shuffle for the first epoch
-        if self._epochs_completed == 0 and start == 0 and shuffle:
-            perm0 = np.arange(self._num_examples)
-            np.random.shuffle(perm0)
-            self._inps = self.inps[perm0]
-            self._outs = self.outs[perm0]
-        # Go to the next epoch
-        if start + batch_size > self._num_examples:
-            # Finished epoch
-            self._epochs_completed += 1
-            # Get the rest examples in this epoch
-            rest_num_examples = self._num_examples - start
-            inps_rest_part = self._inps[start:self._num_examples]
-            outs_rest_part = self._outs[start:self._num_examples]
-            # Shuffle the data
-            if shuffle:
-                perm = np.arange(self._num_examples)
-                np.random.shuffle(perm)
-                self._inps = self.inps[perm]
-                self._outs = self.outs[perm]
-            # Start next epoch
-            start = 0
-            self._index_in_epoch = batch_size - rest_num_examples
-            end = self._index_in_epoch
-            inps_new_part = self._inps[start:end]
-            outs_new_part = self._outs[start:end]
-            return np.concatenate((inps_rest_part, inps_new_part), axis=0) , np.concatenate((outs_rest_part, outs_new_part), axis=0)
-        else:
-            self._index_in_epoch += batch_size
-            end = self._index_in_epoch
-            return self._inps[start:end], self._outs[start:end]
+        """Return the next `batch_size` examples from this data set.
+        The batch arrays are reused by the next call."""
+        rows = _next_rows(self, batch_size, shuffle)
+        self._buffers = _take_normalized_rows((self._inps, self._outs), rows,
+                                              self._scaler, self._buffers)
+        return self._buffers[1]
+
+    def gather(self, rows, seed=None):
+        """New float32 (inps, outs) arrays of the examples rows, does not
+        touch the state of next_batch (input pipelines). seed is unused, the
+        examples are not random"""
+        return tuple(self._normalized(arr).astype(np.float32)
+                     for arr in _take_rows((self._inps, self._outs), rows))
 
 class DataSetS2S(object):
     def __init__(self,
                      data,
                      num_steps,
                      num_test_steps=None,
-                     seed=None):
+                     seed=None,
+                     scaler=None):
         """Construct a DataSet.
         Seed arg provides for convenient deterministic testing.
+        scaler: MinMaxScaler of raw (e.g. memory-mapped) data, the batches
+        are normalized with it. None: data is normalized already.
+        The decoder inputs are built per batch from the decoder outputs.
         """
         seed1, seed2 = random_seed.get_seed(seed)
         # If op level seed is not set, use whatever graph level seed is returned
@@ -155,7 +254,6 @@ class DataSetS2S(object):
         if num_test_steps is None:
             num_test_steps=  time_len-num_steps 
         enc_inps = data[:,:num_steps, :]
-        dec_inps = np.insert(data[:,num_steps:num_steps+num_test_steps-1,:], 0, SOS, axis=1)
         #dec_outs = np.insert(data[:,num_steps:num_steps+num_test_steps,:], num_test_steps, EOS, axis=1)
         dec_outs = data[:,num_steps:num_steps+num_test_steps,:]
 
@@ -165,20 +263,28 @@ class DataSetS2S(object):
 
         self._num_examples = enc_inps.shape[0]
         self._enc_inps = enc_inps
-        self._dec_inps = dec_inps
         self._dec_outs = dec_outs
+        self._perm = np.arange(self._num_examples)
+        self._buffers = None
+        self._dec_inps_buffer = None
+        self._scaler = scaler
         self._epochs_completed = 0
         self._index_in_epoch = 0
 
+    def _normalized(self, arr):
+        if self._scaler is None:
+            return arr
+        return self._scaler.transform(arr)
+
     @property
     def enc_inps(self):
-        return self._enc_inps
+        return self._normalized(self._enc_inps)
     @property
     def dec_inps(self):
-        return self._dec_inps
+        return _decoder_inputs(self.dec_outs)
     @property
     def dec_outs(self):
-        return self._dec_outs
+        return self._normalized(self._dec_outs)
 
     @property
     def num_examples(self):
@@ -189,74 +295,129 @@ class DataSetS2S(object):
         return self._epochs_completed
 
     def next_batch(self, batch_size, shuffle=True):
-        """Return the next `batch_size` examples from this data set."""
-
-        start = self._index_in_epoch
-        # Shuffle for the first epoch
-        if self._epochs_completed == 0 and start == 0 and shuffle:
-            perm0 = np.arange(self._num_examples)
-            np.random.shuffle(perm0)
-            self._enc_inps = self.enc_inps[perm0]
-            self._dec_inps = self.dec_inps[perm0]
-            self._dec_outs = self.dec_outs[perm0]
-        # Go to the next epoch
-        if start + batch_size > self._num_examples:
-            # Finished epoch
-            self._epochs_completed += 1
-            # Get the rest examples in this epoch
-            rest_num_examples = self._num_examples - start
-            enc_inps_rest_part = self._enc_inps[start:self._num_examples]
-            dec_inps_rest_part = self._dec_inps[start:self._num_examples]
-            dec_outs_rest_part = self._dec_outs[start:self._num_examples]
-            # Shuffle the data
-            if shuffle:
-                perm = np.arange(self._num_examples)
-                np.random.shuffle(perm)
-                self._enc_inps = self.enc_inps[perm]
-                self._dec_inps = self.dec_inps[perm]
-                self._dec_outs = self.dec_outs[perm]
-            # Start next epoch
-            start = 0
-            self._index_in_epoch = batch_size - rest_num_examples
-            end = self._index_in_epoch
-            enc_inps_new_part = self._enc_inps[start:end]
-            dec_inps_new_part = self._dec_inps[start:end]
-            dec_outs_new_part = self._dec_outs[start:end]
-            return np.concatenate((enc_inps_rest_part, enc_inps_new_part), axis=0), \
-                   np.concatenate((dec_inps_rest_part, dec_inps_new_part), axis=0), \
-                   np.concatenate((dec_outs_rest_part, dec_outs_new_part), axis=0)
-        else:
-            self._index_in_epoch += batch_size
-            end = self._index_in_epoch
-            return self._enc_inps[start:end], self._dec_inps[start:end], self._dec_outs[start:end]
-        
+        """Return the next `batch_size` examples from this data set.
+        The batch arrays are reused by the next call."""
+        rows = _next_rows(self, batch_size, shuffle)
+        self._buffers = _take_normalized_rows((self._enc_inps, self._dec_outs), rows,
+                                              self._scaler, self._buffers)
+        enc_inps, dec_outs = self._buffers[1]
+        self._dec_inps_buffer = _decoder_inputs(dec_outs, self._dec_inps_buffer)
+        return enc_inps, self._dec_inps_buffer, dec_outs
+
+    def gather(self, rows, seed=None):
+        """New float32 (enc_inps, dec_inps, dec_outs) arrays of the examples
+        rows, does not touch the state of next_batch (input pipelines). seed
+        is unused, the examples are not random"""
+        enc_inps, dec_outs = (self._normalized(arr).astype(np.float32)
+                              for arr in _take_rows((self._enc_inps, self._dec_outs), rows))
+        return enc_inps, _decoder_inputs(dec_outs), dec_outs
+
+class SequentialDataSet(object):
+    """Contiguous num_steps chunks of the series, in order, for truncated
+    backpropagation through time with states carried across batches.
+
+    data is [num_series, time_len, dim], the batches walk batch_size series
+    (wrapping around the series) from the first to the last chunk. A single
+    series [time_len, dim] is cut into batch_size contiguous streams.
+    scaler: MinMaxScaler of raw data, as for DataSet.
+    """
+    def __init__(self, data, num_steps, batch_size, scaler=None):
+        if np.ndim(data) == 2:
+            stream_len = data.shape[0] // batch_size
+            data = data[:batch_size * stream_len].reshape((batch_size, stream_len, -1))
+        self._data = data
+        self._scaler = scaler
+        self._num_steps = num_steps
+        self._batch_size = batch_size
+        num_series, time_len = data.shape[:2]
+        # the outputs are the inputs shifted by one step
+        self._num_chunks = (time_len - 1) // num_steps
+        if self._num_chunks == 0:
+            raise ValueError("Series of %d steps, too short for a chunk of %d steps and its outputs."
+                             % (time_len, num_steps))
+        self._num_groups = -(-num_series // batch_size)
+        self._group = 0
+        self._chunk = 0
+        self._rows = np.arange(batch_size) % num_series
+        self._epochs_completed = 0
+
+    @property
+    def num_chunks(self):
+        return self._num_chunks
+
+    @property
+    def epochs_completed(self):
+        return self._epochs_completed
+
+    def next_batch(self):
+        """Return the next chunks (inps, outs, is_first) of the current series,
+        is_first is True when the chunks start new series: the carried states
+        have to be reset before running them."""
+        is_first = self._chunk == 0
+        start = self._chunk * self._num_steps
+        # only the window of the chunk and its next step is read (and normalized)
+        window = self._data[self._rows, start:start + self._num_steps + 1]
+        if self._scaler is not None:
+            out = window if window.dtype == np.float32 else np.empty(window.shape, dtype=np.float32)
+            window = self._scaler.transform(window, out=out)
+        inps = window[:, :-1]
+        outs = window[:, 1:]
+        self._chunk += 1
+        if self._chunk == self._num_chunks:
+            # next group of series
+            self._chunk = 0
+            self._group += 1
+            if self._group == self._num_groups:
+                self._group = 0
+                self._epochs_completed += 1
+            num_series = self._data.shape[0]
+            self._rows = (self._group * self._batch_size + np.arange(self._batch_size)) % num_series
+        return inps, outs, is_first
+
 def read_data_sets(data_path, s2s, n_steps,
                                 n_test_steps = None,
                                 val_size = 0.1, 
                                 test_size = 0.1, 
-                                seed=None):
+                                seed=None,
+                                sequential_batch_size=None,
+                                mmap=False):
+    """Train, validation and test sets of the series in data_path, normalized
+    with a MinMaxScaler fitted on the training split only (stats['scaler']).
+    mmap: memory-map the .npy file instead of loading it, the scaler is
+    fitted in one streaming pass and the datasets normalize per batch.
+    """
     print("loading time series ...")
-    data = np.load(data_path)
+    data = np.load(data_path, mmap_mode="r" if mmap else None)
     # Expand the dimension if univariate time series
     if (np.ndim(data)==1):
             data = np.expand_dims(data, axis=1)
     print("input type ",type( data), np.shape(data))
 
-    # Normalize the data
-    print("normalize to (0-1)")
-    data, _ = normalize_columns(data)
     ntest = int(round(len(data) * (1.0 - test_size)))
     nval = int(round(len(data[:ntest]) * (1.0 - val_size)))
 
+    # Normalize the data with the stats of the training split
+    print("normalize to (0-1)")
+    scaler = MinMaxScaler().fit(data[:nval])
+    if not mmap:
+        # in place for float data
+        data = scaler.transform(data, out=data if data.dtype.kind == "f" else None)
+
     train_data, valid_data, test_data = data[:nval, ], data[nval:ntest, ], data[ntest:,]
 
-    train_options = dict(num_steps=n_steps, num_test_steps=n_test_steps, seed=seed)
+    train_options = dict(num_steps=n_steps, num_test_steps=n_test_steps, seed=seed,
+                         scaler=scaler if mmap else None)
     if s2s == True:
         train = DataSetS2S(train_data, **train_options)
         valid = DataSetS2S(valid_data, **train_options)
         test = DataSetS2S(test_data, **train_options)
     else:
-        train = DataSet(train_data, **train_options)
+        if sequential_batch_size is None:
+            train = DataSet(train_data, **train_options)
+        else:
+            # contiguous chunks for truncated BPTT
+            train = SequentialDataSet(train_data, n_steps, sequential_batch_size,
+                                      scaler=train_options["scaler"])
         valid = DataSet(valid_data, **train_options)
         test = DataSet(test_data, **train_options)     
 
@@ -264,5 +425,6 @@ def read_data_sets(data_path, s2s, n_steps,
     stats['num_examples'] = data.shape[0]
     stats['num_steps'] = data.shape[1]
     stats['num_input'] = data.shape[-1]
+    stats['scaler'] = scaler
 
     return base.Datasets(train=train, validation=valid, test=test), stats
\ No newline at end of file
@@ -10,6 +10,7 @@ from tensorflow.python.framework import random_seed
 import h5py
 import matplotlib.pyplot as plt
 
+from reader import _decoder_inputs
 
 
 # start of sequences
@@ -21,9 +22,12 @@ class MNISTDataSet(object):
                      input_steps,
                      output_steps,
                      image_size,
-                     seed=None):
+                     seed=None,
+                     rng=None):
         """Construct a DataSet.
         Seed arg provides for convenient deterministic testing.
+        rng: np.random.RandomState of the trajectories and shuffles. None: a
+        new one seeded like np.random.
         """
         self.data_ = data # N x H x W
         self.num_examples_ = data.shape[0]
@@ -43,6 +47,8 @@ class MNISTDataSet(object):
         seed1, seed2 = random_seed.get_seed(seed)
         # If op level seed is not set, use whatever graph level seed is returned
         np.random.seed(seed1 if seed is None else seed2)
+        # a RandomState rather than the np.random module, which does not pickle
+        self.rng_ = np.random.RandomState(seed1 if seed is None else seed2) if rng is None else rng
         
         if output_steps is None:
             output_steps=  self.seq_length_-input_steps
@@ -73,16 +79,17 @@ class MNISTDataSet(object):
     def epochs_completed(self):
         return self._epochs_completed
 
-    def gen_trajectory(self, batch_size):
+    def gen_trajectory(self, batch_size, rng=None):
+        rng = self.rng_ if rng is None else rng
         length = self.seq_length_
         canvas_size = self.image_size_ - self.digit_size_
         
         # Initial position uniform random inside the box.
-        y = np.random.rand(batch_size)
-        x = np.random.rand(batch_size)
+        y = rng.rand(batch_size)
+        x = rng.rand(batch_size)
 
         # Choose a random velocity.
-        theta = np.random.rand(batch_size) * 2 * np.pi
+        theta = rng.rand(batch_size) * 2 * np.pi
         v_y = np.sin(theta)
         v_x = np.cos(theta)
 
@@ -120,17 +127,25 @@ class MNISTDataSet(object):
         return np.maximum(a, b)
         #return b
 
-    def gen_video(self, ind, data_size):
-        start_y, start_x = self.gen_trajectory(data_size * self.num_digits_)
+    def gen_video(self, ind, data_size, out=None, rng=None):
+        """data_size videos of the digit ind, or of the digits ind[j],
+        written into out [data_size, seq_length, image_size, image_size] if
+        given. rng: RandomState of the trajectories, default self.rng_"""
+        inds = np.broadcast_to(ind, (data_size,))
+        start_y, start_x = self.gen_trajectory(data_size * self.num_digits_, rng)
         
         # minibatch data
-        data = np.zeros((data_size, self.seq_length_, self.image_size_, self.image_size_), dtype=np.float32)
+        if out is None:
+            data = np.zeros((data_size, self.seq_length_, self.image_size_, self.image_size_), dtype=np.float32)
+        else:
+            data = out
+            data[...] = 0
         
         for j in xrange(data_size):
             for n in xrange(self.num_digits_):
              
                 # get a digit from dataset
-                digit_image = self.data_[ind, :]   
+                digit_image = self.data_[inds[j], :]   
                 # generate video
                 for i in xrange(self.seq_length_):
                     top    = start_y[i, j * self.num_digits_ + n]
@@ -147,7 +162,7 @@ class MNISTDataSet(object):
         start = self._index_in_epoch
         # Shuffle for the first epoch
         if self._epochs_completed == 0 and start == 0 and shuffle:
-            np.random.shuffle(self.indices_)
+            self.rng_.shuffle(self.indices_)
             batch_video = self.gen_video(self.indices_[start], batch_size)
             # self._enc_inps = self.enc_inps[perm0]
             # self._dec_inps = self.dec_inps[perm0]
@@ -165,7 +180,7 @@ class MNISTDataSet(object):
             # dec_outs_rest_part = self._dec_outs[start:self._num_examples]
             # Shuffle the data
             if shuffle:
-                np.random.shuffle(self.indices_)
+                self.rng_.shuffle(self.indices_)
                 batch_video = self.gen_video(self.indices_[start], batch_size) 
                 # self._enc_inps = self.enc_inps[perm]
                 # self._dec_inps = self.dec_inps[perm]
@@ -189,12 +204,24 @@ class MNISTDataSet(object):
             self._index_in_epoch += batch_size
             batch_video = self.gen_video(self.indices_[start], batch_size)
 
-        self.enc_inps_ = batch_video[:,:self.input_steps_,:].reshape(-1, self.input_steps_, self.frame_size_)
-        self.dec_inps_ = np.insert(batch_video[:, self.input_steps_:self.seq_length_-1,:], 0, SOS, axis=1).reshape(-1, self.output_steps_, self.frame_size_) 
-        self.dec_outs_ = batch_video[:, self.input_steps_:self.seq_length_,:].reshape(-1, self.output_steps_, self.frame_size_) 
+        self.enc_inps_, self.dec_inps_, self.dec_outs_ = self._split_video(batch_video)
 
         return self.enc_inps_, self.dec_inps_, self.dec_outs_
 
+    def _split_video(self, batch_video):
+        """(enc_inps, dec_inps, dec_outs) of the videos batch_video"""
+        enc_inps = batch_video[:,:self.input_steps_,:].reshape(-1, self.input_steps_, self.frame_size_)
+        dec_outs = batch_video[:, self.input_steps_:self.seq_length_,:].reshape(-1, self.output_steps_, self.frame_size_) 
+        return enc_inps, _decoder_inputs(dec_outs), dec_outs
+
+    def gather(self, rows, seed=None):
+        """(enc_inps, dec_inps, dec_outs) of videos of the digits rows, does
+        not touch the state of next_batch (input pipelines). seed: of a
+        RandomState of this call only, so that concurrent calls do not share
+        self.rng_"""
+        rng = None if seed is None else np.random.RandomState(seed)
+        return self._split_video(self.gen_video(rows, len(rows), rng=rng))
+
     def display_data(self, data, rec=None, fut=None, fig=1, case_id=0, output_file=None):
         output_file1 = None
         output_file2 = None
@@ -0,0 +1,104 @@
+"""Single-pass rolling-origin evaluation of tensor RNN seq2seq models.
+
+Sweeps every test series once with the StreamingForecaster: the encoder
+advances one step per observation, and at every forecast origin a decoder
+rollout is forked from the cached states. The forks of several origins are
+batched into one rollout. The cost is linear in the series length instead of
+re-encoding a window per origin:
+
+    python rolling_eval.py --model=TLSTM --data_path=./data.npy \
+        --checkpoint_path=./log/tlstm/ --burn_in_steps=12 --horizon=12
+"""
+
+from __future__ import print_function
+
+import numpy as np
+
+
+def rolling_origin_eval(forecaster, series, burn_in_steps, horizon, stride=1, fork_batch_size=512):
+    """Per-horizon squared errors of forecasts from every origin of series.
+
+    series: [num_series, time_len, input_size]
+    burn_in_steps: observations encoded before the first origin
+    horizon: forecast steps per origin
+    stride: steps between two origins
+    Returns (rmse [horizon], number of forecasts per horizon).
+    """
+    num_series, time_len, _ = series.shape
+    sq_err = np.zeros(horizon)
+    count = 0
+    forks, targets = [], []
+
+    def _flush():
+        if not forks:
+            return 0.0
+        states = [np.concatenate(leaves, axis=1) for leaves in zip(*forks)]
+        preds = forecaster.rollout(states, horizon)
+        err = np.square(preds - np.concatenate(targets, axis=0))
+        del forks[:], targets[:]
+        return err.mean(axis=2).sum(axis=0)
+
+    states = forecaster.zero_states(num_series)
+    for t in range(time_len - horizon):
+        states = forecaster.step(states, series[:, t])
+        origin = t + 1
+        if origin >= burn_in_steps and (origin - burn_in_steps) % stride == 0:
+            # fork: the decoder forecasts series[:, origin:origin + horizon]
+            forks.append(states)
+            targets.append(series[:, origin:origin + horizon])
+            count += num_series
+            if len(forks) * num_series >= fork_batch_size:
+                sq_err += _flush()
+    sq_err += _flush()
+    return np.sqrt(sq_err / max(count, 1)), count
+
+
+def main():
+    import tensorflow as tf
+    from reader import read_data_sets
+    from streaming import StreamingForecaster
+    from train_config import TrainConfig
+
+    flags = tf.flags
+    flags.DEFINE_string("model", "TLSTM", "Model of the checkpoint.")
+    flags.DEFINE_string("data_path", "./data.npy", "Data input directory.")
+    flags.DEFINE_string("checkpoint_path", "./log/lstm/", "Trained model checkpoint.")
+    flags.DEFINE_integer("burn_in_steps", 12, "burn in steps")
+    flags.DEFINE_integer("horizon", 12, "forecast steps per origin")
+    flags.DEFINE_integer("stride", 1, "steps between two forecast origins")
+    flags.DEFINE_integer("fork_batch_size", 512, "forecasts per decoder rollout")
+    # model flags as in train_seq2seq.py, to rebuild the checkpoint graph
+    flags.DEFINE_integer("hidden_size", 8, "hidden layer size")
+    flags.DEFINE_integer("num_layers", 2, "number of stacked layers")
+    flags.DEFINE_integer("num_lags", 2, "number of previous hidden states")
+    flags.DEFINE_integer("rank", 2, "rank for tt decomposition")
+    FLAGS = flags.FLAGS
+
+    config = TrainConfig()
+    config.burn_in_steps = FLAGS.burn_in_steps
+    config.hidden_size = FLAGS.hidden_size
+    config.num_layers = FLAGS.num_layers
+    config.num_lags = FLAGS.num_lags
+    config.rank_vals = [FLAGS.rank]
+
+    dataset, stats = read_data_sets(FLAGS.data_path, True, FLAGS.burn_in_steps)
+    test = dataset.test
+    # whole test series: encoder inputs followed by the decoder targets
+    series = np.concatenate((test.enc_inps, test.dec_outs), axis=1)
+
+    forecaster = StreamingForecaster(FLAGS.model, config, stats['num_input'], FLAGS.horizon,
+                                     max_series=1)
+    forecaster.restore(FLAGS.checkpoint_path)
+    rmse, count = rolling_origin_eval(forecaster, series, FLAGS.burn_in_steps, FLAGS.horizon,
+                                      FLAGS.stride, FLAGS.fork_batch_size)
+    forecaster.close()
+
+    print('='*80)
+    print('|model|', FLAGS.model, '|series|', series.shape[0], '|forecasts|', count)
+    for h, err in enumerate(rmse):
+        print('|horizon|', h + 1, '|rmse|', err)
+    print('|mean rmse|', np.sqrt(np.mean(np.square(rmse))))
+
+
+if __name__ == "__main__":
+    main()
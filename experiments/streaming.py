@@ -0,0 +1,156 @@
+"""Stateful streaming forecasts with trained tensor RNN seq2seq models.
+
+Instead of re-encoding burn_in_steps of history for every forecast, the
+StreamingForecaster keeps the lagged states of every series between calls.
+Each new observation advances the encoder by a single step, and forecasts
+are rolled out from the current states on demand:
+
+    forecaster = StreamingForecaster("TLSTM", config, input_size, num_steps=80,
+                                     scaler=MinMaxScaler.load("./log/tlstm/scaler.npz"))
+    forecaster.restore("./log/tlstm/")
+    forecaster.update(["sensor_1", "sensor_2"], values)  # values [2, input_size]
+    preds = forecaster.forecast(["sensor_1", "sensor_2"])  # [2, 80, input_size]
+
+The graphs are built with the same variable scopes as model_seq2seq.py, so
+they restore the training checkpoints. With the scaler saved by the training
+scripts, update and forecast take and return raw values.
+"""
+
+from __future__ import print_function
+
+import copy
+
+import numpy as np
+import tensorflow as tf
+from tensorflow.python.util import nest
+
+from model_seq2seq import tensor_cell
+from trnn_imply import tensor_rnn_with_feed_prev
+
+
+class StreamingForecaster(object):
+    """Encoder step and decoder rollout graphs of a tensor seq2seq model.
+
+    The states of a batch are a list with one array [num_lags, batch_size,
+    size] per state tensor, lags ordered oldest first. The states of the
+    registered series live in preallocated arrays with one row per series.
+    step and rollout work on normalized values, update and forecast on raw
+    values when a scaler (reader.MinMaxScaler) is given.
+    """
+    def __init__(self, model, config, input_size, num_steps, max_series=1024, scope="Model",
+                 scaler=None):
+        config = copy.copy(config)
+        # serving graphs, no gradient checkpointing
+        config.recompute_segment = None
+        self._num_lags = config.num_lags
+        self._input_size = input_size
+        self._num_steps = num_steps
+        self._graph = tf.Graph()
+        with self._graph.as_default():
+            cell = tf.contrib.rnn.MultiRNNCell(
+                [tensor_cell(model, config) for _ in range(config.num_layers)])
+            self._state_size = cell.state_size
+            sizes = nest.flatten(cell.state_size)
+            self._lags_inps = [tf.placeholder(tf.float32, [self._num_lags, None, size])
+                               for size in sizes]
+            lags = self._unstack_lags(self._lags_inps)
+            self._inps = tf.placeholder(tf.float32, [None, 1, input_size])
+
+            with tf.variable_scope(scope):
+                with tf.variable_scope("Encoder"):
+                    # a single teacher forced step from the given lags, unrolled
+                    enc_config = copy.copy(config)
+                    enc_config.use_while_loop = False
+                    _, new_lags = tensor_rnn_with_feed_prev(cell, self._inps, True, enc_config, lags,
+                                                           is_decoder=False, keep_prob=1.0)
+                self._new_lags = self._stack_lags(new_lags)
+
+                with tf.variable_scope("Decoder"):
+                    # the decoder starts from SOS = 0 and feeds its outputs back
+                    config.burn_in_steps = 0
+                    batch_size = tf.shape(self._lags_inps[0])[1]
+                    dec_inps = tf.zeros([batch_size, num_steps, input_size])
+                    dec_inps.set_shape([None, num_steps, input_size])
+                    self._outputs, _ = tensor_rnn_with_feed_prev(cell, dec_inps, False, config, lags)
+
+            self._saver = tf.train.Saver()
+            self._sess = tf.Session(graph=self._graph)
+
+        self._scaler = scaler
+        self._max_series = max_series
+        self._rows = {}
+        self._free_rows = list(range(max_series - 1, -1, -1))
+        self._states = self.zero_states(max_series)
+
+    def _unstack_lags(self, stacked):
+        """[num_lags, batch_size, size] per state tensor -> list of lags"""
+        leaves = [tf.unstack(lag_inps, self._num_lags) for lag_inps in stacked]
+        return [nest.pack_sequence_as(self._state_size, list(lag)) for lag in zip(*leaves)]
+
+    def _stack_lags(self, lags):
+        """list of lags -> [num_lags, batch_size, size] per state tensor"""
+        return [tf.stack(leaves) for leaves in zip(*[nest.flatten(lag) for lag in lags])]
+
+    def restore(self, checkpoint_path):
+        if tf.gfile.IsDirectory(checkpoint_path):
+            checkpoint_path = tf.train.latest_checkpoint(checkpoint_path)
+        self._saver.restore(self._sess, checkpoint_path)
+
+    def close(self):
+        self._sess.close()
+
+    def zero_states(self, batch_size):
+        return [np.zeros((self._num_lags, batch_size, size), dtype=np.float32)
+                for size in nest.flatten(self._state_size)]
+
+    def step(self, states, values):
+        """Advance states by one observation values [batch_size, input_size]"""
+        feed_dict = dict(zip(self._lags_inps, states))
+        feed_dict[self._inps] = np.reshape(values, (-1, 1, self._input_size))
+        return self._sess.run(self._new_lags, feed_dict=feed_dict)
+
+    def rollout(self, states, num_steps=None):
+        """Forecasts [batch_size, num_steps, input_size] from states"""
+        feed_dict = dict(zip(self._lags_inps, states))
+        outputs = self._sess.run(self._outputs, feed_dict=feed_dict)
+        return outputs[:, :num_steps or self._num_steps]
+
+    def _series_rows(self, series_ids):
+        rows = []
+        for series_id in series_ids:
+            if series_id not in self._rows:
+                if not self._free_rows:
+                    raise ValueError("More than %d series." % self._max_series)
+                row = self._free_rows.pop()
+                for states in self._states:
+                    states[:, row] = 0.0
+                self._rows[series_id] = row
+            rows.append(self._rows[series_id])
+        return np.array(rows)
+
+    def remove(self, series_id):
+        self._free_rows.append(self._rows.pop(series_id))
+
+    def states(self, series_ids):
+        """Copy of the states of series_ids"""
+        rows = self._series_rows(series_ids)
+        return [np.take(states, rows, axis=1) for states in self._states]
+
+    def update(self, series_ids, values):
+        """Advance every series of series_ids by its new observation, a row of
+        values [len(series_ids), input_size]. Unknown series start from zero
+        states."""
+        rows = self._series_rows(series_ids)
+        if self._scaler is not None:
+            values = self._scaler.transform(values)
+        new_states = self.step([np.take(states, rows, axis=1) for states in self._states], values)
+        for states, new in zip(self._states, new_states):
+            states[:, rows] = new
+
+    def forecast(self, series_ids, num_steps=None):
+        """Forecasts [len(series_ids), num_steps, input_size] from the current
+        states of series_ids"""
+        preds = self.rollout(self.states(series_ids), num_steps)
+        if self._scaler is not None:
+            preds = self._scaler.inverse_transform(preds)
+        return preds
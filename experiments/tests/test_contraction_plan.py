@@ -0,0 +1,62 @@
+import itertools
+
+import numpy as np
+import pytest
+
+from contraction_plan import plan_contraction, plan_cost, tt_einsum_network
+
+
+def _tt_network(num_orders, ranks, state_size=5, batch_size=3, output_size=4):
+    inputs, output = tt_einsum_network(num_orders)
+    mat_ranks = [1] + list(ranks) + [output_size]
+    size_dict = {"z": batch_size}
+    for indices, r_in, r_out in zip(inputs[1:], mat_ranks[:-1], mat_ranks[1:]):
+        size_dict.update(zip(indices, (r_in, state_size, r_out)))
+    return inputs, output, size_dict
+
+
+def _min_flops(inputs, output, size_dict):
+    """Cheapest pairwise contraction order, by trying all of them"""
+    if len(inputs) == 1:
+        return 0
+    best = None
+    for i, j in itertools.combinations(range(len(inputs)), 2):
+        rest = [indices for k, indices in enumerate(inputs) if k not in (i, j)]
+        kept = set(output).union(*rest) if rest else set(output)
+        result = "".join(sorted(set(inputs[i] + inputs[j]) & kept))
+        flops = int(np.prod([size_dict[ix] for ix in set(inputs[i] + inputs[j])]))
+        flops += _min_flops(rest + [result], output, size_dict)
+        best = flops if best is None else min(best, flops)
+    return best
+
+
+@pytest.mark.parametrize("ranks", [[], [2], [8, 2], [1, 16, 3]])
+def test_plan_matches_einsum(ranks):
+    num_orders = len(ranks) + 1
+    inputs, output, size_dict = _tt_network(num_orders, ranks)
+    rng = np.random.RandomState(0)
+    operands = [rng.randn(*[size_dict[ix] for ix in indices]) for indices in inputs]
+    expected = np.einsum(",".join(inputs) + "->" + output, *operands)
+
+    for i, j, einsum in plan_contraction(inputs, output, size_dict):
+        b = operands.pop(j)
+        a = operands.pop(i)
+        operands.append(np.einsum(einsum, a, b))
+    assert len(operands) == 1
+    np.testing.assert_allclose(operands[0], expected, rtol=1e-10)
+
+
+@pytest.mark.parametrize("ranks", [[2], [8, 2], [1, 16, 3]])
+def test_plan_is_cheapest(ranks):
+    inputs, output, size_dict = _tt_network(len(ranks) + 1, ranks)
+    plan = plan_contraction(inputs, output, size_dict)
+    flops, _ = plan_cost(inputs, output, size_dict, plan)
+    assert flops == _min_flops(inputs, output, size_dict)
+
+
+def test_plans_are_memoized():
+    inputs, output, size_dict = _tt_network(3, [4, 2])
+    plan = plan_contraction(inputs, output, size_dict)
+    assert plan_contraction(list(inputs), output, dict(size_dict)) is plan
+    size_dict["z"] = 7
+    assert plan_contraction(inputs, output, size_dict) is not plan
@@ -0,0 +1,92 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("tensorflow")
+
+from reader import DataSet, DataSetS2S, MinMaxScaler, _take_rows, read_data_sets
+
+
+def test_scaler_fits_in_chunks():
+    data = np.random.RandomState(0).randn(1000, 3) * [1.0, 10.0, 100.0]
+    scaler = MinMaxScaler().fit(data, chunk_size=64)
+    np.testing.assert_array_equal(scaler.stats, [data.min(axis=0), data.max(axis=0)])
+    scaled = scaler.transform(data)
+    np.testing.assert_allclose(scaled.min(axis=0), 0.0, atol=1e-12)
+    np.testing.assert_allclose(scaled.max(axis=0), 1.0)
+    np.testing.assert_allclose(scaler.inverse_transform(scaled), data)
+
+
+def test_scaler_keeps_constant_columns():
+    data = np.array([[1.0, 5.0], [3.0, 5.0]], dtype=np.float32)
+    scaler = MinMaxScaler().fit(data)
+    scaled = scaler.transform(data, out=data)
+    assert scaled is data and scaled.dtype == np.float32
+    np.testing.assert_array_equal(scaled, [[0.0, 5.0], [1.0, 5.0]])
+
+
+def test_scaler_save_load(tmpdir):
+    scaler = MinMaxScaler().fit(np.random.RandomState(0).rand(20, 4))
+    path = str(tmpdir.join("scaler.npz"))
+    scaler.save(path)
+    np.testing.assert_array_equal(MinMaxScaler.load(path).stats, scaler.stats)
+
+
+def test_take_rows_reuses_buffers():
+    arrays = (np.arange(40.0).reshape(10, 4), np.arange(30).reshape(10, 3))
+    buffers = _take_rows(arrays, [3, 1, 7])
+    for array, buf in zip(arrays, buffers):
+        np.testing.assert_array_equal(buf, array[[3, 1, 7]])
+        assert buf.dtype == array.dtype
+    assert _take_rows(arrays, [0, 2, 4], buffers) is buffers
+    np.testing.assert_array_equal(buffers[0], arrays[0][[0, 2, 4]])
+    # a new batch size reallocates
+    assert len(_take_rows(arrays, [5, 6], buffers)[0]) == 2
+
+
+def test_epoch_visits_every_window_once():
+    data = np.random.RandomState(0).rand(23, 2).astype(np.float32)
+    dataset = DataSet(data, 4, seed=1)
+    seen = []
+    while dataset.epochs_completed == 0:
+        inps, outs = dataset.next_batch(3)
+        np.testing.assert_array_equal(inps[:, 1:], outs[:, :-1])
+        seen.extend(tuple(inp.ravel()) for inp in inps)
+    windows = set(tuple(inp.ravel()) for inp in dataset.inps)
+    # the last batch of the epoch is completed from the next one
+    assert set(seen) == windows and len(seen) - len(windows) < 3
+
+
+def test_s2s_batches_match_the_examples():
+    data = np.random.RandomState(0).rand(9, 7, 2).astype(np.float32)
+    dataset = DataSetS2S(data, 4, seed=1)
+    enc_inps, dec_inps, dec_outs = dataset.next_batch(5, shuffle=False)
+    np.testing.assert_array_equal(enc_inps, data[:5, :4])
+    np.testing.assert_array_equal(dec_outs, data[:5, 4:])
+    np.testing.assert_array_equal(dec_inps[:, 1:], dec_outs[:, :-1])
+    assert np.all(dec_inps[:, 0] == 0)
+
+
+@pytest.mark.parametrize("dtype", [np.int32, np.float64, np.float32])
+@pytest.mark.parametrize("s2s", [False, True])
+def test_mmap_batches_match_in_memory_ones(tmpdir, dtype, s2s):
+    shape = (40, 12, 2) if s2s else (200, 3)
+    path = str(tmpdir.join("data.npy"))
+    np.save(path, (np.random.RandomState(0).rand(*shape) * 100).astype(dtype))
+    in_memory, _ = read_data_sets(path, s2s, 6, seed=1)
+    mmapped, _ = read_data_sets(path, s2s, 6, seed=1, mmap=True)
+    for batch_size in (8, 8, 5):
+        state = np.random.get_state()
+        expected = [np.copy(array) for array in in_memory.train.next_batch(batch_size)]
+        np.random.set_state(state)
+        batch = mmapped.train.next_batch(batch_size)
+        for array, expected_array in zip(batch, expected):
+            assert array.dtype == np.float32
+            np.testing.assert_allclose(array, expected_array, atol=1e-5)
+
+
+def test_mmap_sequential_batches_are_float32(tmpdir):
+    path = str(tmpdir.join("data.npy"))
+    np.save(path, np.arange(600, dtype=np.int64).reshape(200, 3))
+    dataset, _ = read_data_sets(path, False, 6, sequential_batch_size=4, mmap=True)
+    inps, outs, _ = dataset.train.next_batch()
+    assert inps.dtype == np.float32 and 0.0 <= inps.min() and outs.max() <= 1.0
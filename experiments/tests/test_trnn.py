@@ -0,0 +1,65 @@
+import numpy as np
+import pytest
+
+tf = pytest.importorskip("tensorflow")
+
+from trnn import tensor_train_states_contraction, tt_matrix_linear, tt_matrix_modes
+
+
+def _tt_operands(batch_size, state_size, mat_ranks, seed=0):
+    rng = np.random.RandomState(seed)
+    states_vector = rng.rand(batch_size, state_size).astype(np.float32)
+    cores = [rng.randn(r_in, state_size, r_out).astype(np.float32)
+             for r_in, r_out in zip(mat_ranks[:-1], mat_ranks[1:])]
+    return states_vector, cores
+
+
+@pytest.mark.parametrize("mat_ranks", [[1, 4], [1, 3, 4], [1, 3, 2, 4]])
+def test_fused_contraction_matches_outer(mat_ranks):
+    states_value, cores_value = _tt_operands(5, 7, mat_ranks)
+    with tf.Graph().as_default():
+        states_vector = tf.constant(states_value)
+        cores = [tf.constant(core) for core in cores_value]
+        outer = tensor_train_states_contraction(states_vector, cores, "outer")
+        fused = tensor_train_states_contraction(states_vector, cores, "fused")
+        with tf.Session() as sess:
+            outer_value, fused_value = sess.run([outer, fused])
+    assert fused_value.shape == (5, mat_ranks[-1])
+    np.testing.assert_allclose(fused_value, outer_value, rtol=1e-4, atol=1e-5)
+
+
+def test_unknown_contraction():
+    states_value, cores_value = _tt_operands(2, 3, [1, 2, 2])
+    with tf.Graph().as_default():
+        with pytest.raises(ValueError):
+            tensor_train_states_contraction(tf.constant(states_value),
+                                            [tf.constant(core) for core in cores_value], "dense")
+
+
+@pytest.mark.parametrize("size,num_modes,modes", [(4096, 4, [8, 8, 8, 8]), (12, 2, [4, 3]),
+                                                   (7, 2, [7, 1]), (1, 3, [1, 1, 1])])
+def test_tt_matrix_modes(size, num_modes, modes):
+    assert tt_matrix_modes(size, num_modes) == modes
+
+
+def _dense_tt_matrix(cores):
+    """[prod(inp_modes), prod(out_modes)] matrix of TT-matrix cores"""
+    dense = np.ones((1, 1, 1))
+    for core in cores:
+        r_in, n, m, r_out = core.shape
+        dense = np.einsum("ijr,rnms->injms", dense, core)
+        dense = dense.reshape(dense.shape[0] * n, dense.shape[2] * m, r_out)
+    return dense[:, :, 0]
+
+
+@pytest.mark.parametrize("inp_modes,out_modes", [([4, 3], [2, 5]), ([2, 3, 2], [3, 1, 2])])
+def test_tt_matrix_linear_matches_dense(inp_modes, out_modes):
+    inputs_value = np.random.RandomState(0).rand(5, int(np.prod(inp_modes))).astype(np.float32)
+    with tf.Graph().as_default():
+        outputs = tt_matrix_linear(tf.constant(inputs_value), "tt_matrix", inp_modes, out_modes, 2)
+        cores = [var for var in tf.global_variables() if "mat_core" in var.op.name]
+        with tf.Session() as sess:
+            sess.run(tf.global_variables_initializer())
+            outputs_value, cores_value = sess.run([outputs, cores])
+    expected = np.dot(inputs_value, _dense_tt_matrix(cores_value))
+    np.testing.assert_allclose(outputs_value, expected, rtol=1e-4, atol=1e-5)
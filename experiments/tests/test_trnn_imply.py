@@ -0,0 +1,54 @@
+import copy
+
+import numpy as np
+import pytest
+
+tf = pytest.importorskip("tensorflow")
+
+from model_seq2seq import tensor_cell
+from train_config import TrainConfig
+from trnn_imply import tensor_rnn_with_feed_prev
+
+
+def _config(**kwargs):
+    config = TrainConfig()
+    config.hidden_size = 8
+    config.num_layers = 2
+    config.num_lags = 2
+    config.rank_vals = [2]
+    for name, value in kwargs.items():
+        setattr(config, name, value)
+    return config
+
+
+def _encoder_outputs(model, config, shared_cell, hoist_inputs, inputs, reuse):
+    """Outputs of a training encoder run with hoist_inputs on or off"""
+    config = copy.copy(config)
+    config.hoist_inputs = hoist_inputs
+    if shared_cell:
+        # one cell object for all layers, as in model_seq2seq
+        cell = tensor_cell(model, config)
+        cells = [cell for _ in range(config.num_layers)]
+    else:
+        cells = [tensor_cell(model, config) for _ in range(config.num_layers)]
+    with tf.variable_scope("Model", reuse=reuse):
+        cell = tf.contrib.rnn.MultiRNNCell(cells)
+        outputs, _ = tensor_rnn_with_feed_prev(cell, inputs, True, config)
+    return outputs
+
+
+@pytest.mark.parametrize("model", ["TRNN", "TLSTM", "MTRNN"])
+@pytest.mark.parametrize("shared_cell", [True, False])
+def test_hoisted_inputs_match_per_step_inputs(model, shared_cell):
+    # two layers and input_size != hidden_size: the hoisted projection must
+    # use the weights of the first layer
+    config = _config()
+    inputs_value = np.random.RandomState(0).rand(4, 6, 3).astype(np.float32)
+    with tf.Graph().as_default():
+        inputs = tf.constant(inputs_value)
+        hoisted = _encoder_outputs(model, config, shared_cell, True, inputs, None)
+        per_step = _encoder_outputs(model, config, shared_cell, False, inputs, True)
+        with tf.Session() as sess:
+            sess.run(tf.global_variables_initializer())
+            hoisted_value, per_step_value = sess.run([hoisted, per_step])
+    np.testing.assert_allclose(hoisted_value, per_step_value, rtol=1e-5, atol=1e-6)
@@ -0,0 +1,148 @@
+import numpy as np
+import pytest
+
+from trnn_numpy import CELL_SCOPE, OUTPUT_SCOPE, QuantizedArray, TensorRNNForecaster, \
+    load_weights, quantize, quantize_weights, save_weights
+
+HIDDEN_SIZE = 6
+NUM_LAGS = 3
+NUM_LAYERS = 2
+INPUT_SIZE = 4
+
+
+def _random_weights(model, rank_vals, freqs=None, seed=0):
+    """Weights of a NUM_LAYERS model in the variable layout of the
+    TensorFlow cells, MTRNN with one tensor train per frequency"""
+    rng = np.random.RandomState(seed)
+    out_size = 4 * HIDDEN_SIZE if model in ("TLSTM", "MLSTM") else HIDDEN_SIZE
+    mat_ranks = [1] + list(rank_vals) + [out_size]
+    weights = {}
+    for layer in range(NUM_LAYERS):
+        scope = "%s/cell_%d" % (CELL_SCOPE, layer)
+        input_size = INPUT_SIZE if layer == 0 else HIDDEN_SIZE
+        weights[scope + "/biases"] = 0.1 * rng.randn(out_size).astype(np.float32)
+        if model == "MLSTM":
+            weights[scope + "/weights"] = 0.3 * rng.randn(
+                input_size + HIDDEN_SIZE * NUM_LAGS, out_size).astype(np.float32)
+            continue
+        weights[scope + "/weights_x"] = 0.3 * rng.randn(input_size, out_size).astype(np.float32)
+        for k, freq in enumerate(freqs or [1]):
+            name = "weights_h" if k == 0 else "weights_h%d" % (k + 1)
+            state_size = HIDDEN_SIZE * len(range(0, NUM_LAGS, freq)) + 1
+            for i, (r_in, r_out) in enumerate(zip(mat_ranks[:-1], mat_ranks[1:])):
+                weights["%s/%s/core_%d" % (scope, name, i)] = 0.3 * rng.randn(
+                    r_in, state_size, r_out).astype(np.float32)
+    weights[OUTPUT_SCOPE + "/weights"] = rng.randn(HIDDEN_SIZE, INPUT_SIZE).astype(np.float32)
+    weights[OUTPUT_SCOPE + "/biases"] = 0.1 * rng.randn(INPUT_SIZE).astype(np.float32)
+    return weights
+
+
+def _forecaster(weights, model, rank_vals, num_freq=2):
+    return TensorRNNForecaster(weights, model, HIDDEN_SIZE, NUM_LAGS, rank_vals,
+                               NUM_LAYERS, num_freq)
+
+
+def _enc_inps(batch_size=3, num_steps=5, seed=1):
+    return np.random.RandomState(seed).rand(batch_size, num_steps, INPUT_SIZE).astype(np.float32)
+
+
+def test_single_frequency_mtrnn_is_trnn():
+    weights = _random_weights("TRNN", [3, 2])
+    trnn = _forecaster(weights, "TRNN", [3, 2]).forecast(_enc_inps(), 4)
+    mtrnn = _forecaster(weights, "MTRNN", [3, 2], num_freq=[1]).forecast(_enc_inps(), 4)
+    np.testing.assert_allclose(mtrnn, trnn, rtol=1e-6)
+
+
+def test_forecasts_restart_from_zero_states():
+    forecaster = _forecaster(_random_weights("TLSTM", [2]), "TLSTM", [2])
+    first = forecaster.forecast(_enc_inps(), 4)
+    forecaster.forecast(_enc_inps(batch_size=2, seed=2), 3)
+    np.testing.assert_array_equal(forecaster.forecast(_enc_inps(), 4), first)
+
+
+def test_optimizer_slots_are_dropped():
+    weights = _random_weights("TRNN", [2])
+    checkpoint = dict((name + "/RMSProp", value) for name, value in weights.items())
+    checkpoint.update(weights)
+    checkpoint["Model/global_step"] = np.zeros((), np.int64)
+    forecaster = _forecaster(checkpoint, "TRNN", [2])
+    assert forecaster.nbytes == _forecaster(weights, "TRNN", [2]).nbytes
+
+
+def test_int8_error_is_half_a_step():
+    array = np.random.RandomState(0).randn(3, 7, 5).astype(np.float32)
+    quantized = quantize(array, "int8")
+    assert quantized.values.dtype == np.int8 and quantized.scale.shape == (5,)
+    assert np.all(np.abs(quantized.dequantize() - array) <= quantized.scale / 2 + 1e-7)
+
+
+def test_clipped_int8_saturates():
+    array = np.array([0.1, -0.2, 4.0], dtype=np.float32)
+    quantized = quantize(array, "int8", clip=0.5)
+    np.testing.assert_allclose(quantized.dequantize(), [0.1, -0.2, 2.0], atol=0.01)
+
+
+@pytest.mark.parametrize("dtype", ["int8", "float16"])
+def test_quantized_weights_round_trip(tmpdir, dtype):
+    weights = _random_weights("TLSTM", [2])
+    quantized = quantize_weights(weights, dtype)
+    path = str(tmpdir.join("weights.npz"))
+    save_weights(path, quantized)
+    loaded = load_weights(path)
+    assert sorted(loaded) == sorted(weights)
+    for name, value in quantized.items():
+        assert isinstance(loaded[name], QuantizedArray)
+        np.testing.assert_array_equal(loaded[name].dequantize(), value.dequantize())
+
+
+@pytest.mark.parametrize("dtype,atol", [("int8", 0.1), ("float16", 0.01)])
+def test_quantized_forecasts(dtype, atol):
+    weights = _random_weights("MTRNN", [3, 2], freqs=[1, 2])
+    expected = _forecaster(weights, "MTRNN", [3, 2], [1, 2]).forecast(_enc_inps(), 4)
+    forecaster = _forecaster(quantize_weights(weights, dtype), "MTRNN", [3, 2], [1, 2])
+    np.testing.assert_allclose(forecaster.forecast(_enc_inps(), 4), expected, atol=atol)
+
+
+def test_quantized_weights_stay_resident():
+    weights = _random_weights("TLSTM", [2])
+    float_bytes = _forecaster(weights, "TLSTM", [2]).nbytes
+    forecaster = _forecaster(quantize_weights(weights, "int8"), "TLSTM", [2])
+    idle_bytes = forecaster.nbytes
+    assert idle_bytes < float_bytes / 2
+    forecasts = forecaster.forecast(_enc_inps(), 4)
+    # the float32 cells come on top of the int8 weights until unload
+    assert forecaster.nbytes > idle_bytes + float_bytes / 2
+    forecaster.unload()
+    assert forecaster.nbytes == idle_bytes
+    np.testing.assert_array_equal(forecaster.forecast(_enc_inps(), 4), forecasts)
+
+
+@pytest.mark.parametrize("model,num_freq", [("TRNN", 2), ("TLSTM", 2), ("MLSTM", 2),
+                                            ("MTRNN", 2), ("MTRNN", [2, 3])])
+def test_forecasts_match_tensorflow(model, num_freq):
+    tf = pytest.importorskip("tensorflow")
+    import model_seq2seq
+    from train_config import TrainConfig
+
+    config = TrainConfig()
+    config.hidden_size = HIDDEN_SIZE
+    config.num_lags = NUM_LAGS
+    config.num_layers = NUM_LAYERS
+    config.rank_vals = [3, 2]
+    config.num_freq = num_freq
+    enc_inps = _enc_inps()
+    num_steps = 4
+    with tf.Graph().as_default():
+        tf.set_random_seed(0)
+        X = tf.placeholder("float", [None, enc_inps.shape[1], INPUT_SIZE])
+        Y = tf.placeholder("float", [None, num_steps, INPUT_SIZE])
+        with tf.variable_scope("Model", reuse=None):
+            pred = getattr(model_seq2seq, model)(X, Y, False, config)
+        with tf.Session() as sess:
+            sess.run(tf.global_variables_initializer())
+            weights = dict((var.op.name, value) for var, value in
+                           zip(tf.global_variables(), sess.run(tf.global_variables())))
+            # the decoder starts from SOS = 0 and feeds its outputs back
+            expected = sess.run(pred, feed_dict={X: enc_inps, Y: np.zeros((3, num_steps, INPUT_SIZE))})
+    forecasts = _forecaster(weights, model, config.rank_vals, num_freq).forecast(enc_inps, num_steps)
+    np.testing.assert_allclose(forecasts, expected, rtol=1e-4, atol=1e-5)
@@ -0,0 +1,81 @@
+import numpy as np
+import pytest
+
+from tt_round import pad_ranks, round_weights, tt_ranks, tt_round, unflatten_cores
+
+
+def _random_cores(mat_ranks, state_size=5, seed=0):
+    rng = np.random.RandomState(seed)
+    return [rng.randn(r_in, state_size, r_out).astype(np.float32)
+            for r_in, r_out in zip(mat_ranks[:-1], mat_ranks[1:])]
+
+
+def _dense(cores):
+    """The [D, ..., D, output_size] tensor of a tensor train"""
+    dense = np.ones((1, 1))
+    for core in cores:
+        dense = np.tensordot(dense, core.astype(np.float64), axes=([-1], [0]))
+    return dense[0]
+
+
+def _error(cores, rounded):
+    dense = _dense(cores)
+    return np.linalg.norm(_dense(rounded) - dense) / np.linalg.norm(dense)
+
+
+def test_rounding_without_truncation_is_exact():
+    cores = _random_cores([1, 4, 3, 6])
+    rounded = tt_round(cores)
+    assert _error(cores, rounded) < 1e-5
+    # the open output rank is kept
+    assert rounded[-1].shape[2] == 6
+
+
+def test_redundant_ranks_are_removed():
+    # rank 2 tensor train padded with zeros up to rank 4
+    cores = pad_ranks(_random_cores([1, 2, 2, 3]), [4, 4])
+    rounded = tt_round(cores, tolerance=1e-6)
+    assert tt_ranks(rounded) == [2, 2]
+    assert _error(cores, rounded) < 1e-5
+
+
+@pytest.mark.parametrize("tolerance", [0.05, 0.2, 0.5])
+def test_tolerance_bounds_the_error(tolerance):
+    cores = _random_cores([1, 5, 5, 4], state_size=6)
+    assert _error(cores, tt_round(cores, tolerance=tolerance)) <= tolerance + 1e-6
+
+
+def test_max_rank():
+    cores = _random_cores([1, 5, 5, 4])
+    rounded = tt_round(cores, max_rank=2)
+    assert tt_ranks(rounded) == [2, 2]
+    assert [core.shape[1] for core in rounded] == [5, 5, 5]
+    assert _error(cores, rounded) < 1.0
+
+
+def test_padding_is_exact():
+    cores = _random_cores([1, 2, 3, 4])
+    padded = pad_ranks(cores, [3, 5])
+    assert tt_ranks(padded) == [3, 5]
+    np.testing.assert_array_equal(_dense(padded), _dense(cores))
+
+
+def test_round_weights_shares_the_ranks():
+    weights = {"w0/core_%d" % i: core for i, core in enumerate(_random_cores([1, 4, 4, 3], seed=1))}
+    weights.update(("w1/core_%d" % i, core) for i, core in enumerate(_random_cores([1, 4, 4, 3], seed=2)))
+    weights["biases"] = np.zeros(3, np.float32)
+    rounded, rank_vals = round_weights(weights, max_rank=3)
+    assert max(rank_vals) <= 3
+    for scope in ("w0", "w1"):
+        assert tt_ranks([rounded["%s/core_%d" % (scope, i)] for i in range(3)]) == rank_vals
+    assert rounded["biases"] is weights["biases"]
+
+
+def test_unflatten_cores():
+    cores = _random_cores([1, 2, 3])
+    flat = np.concatenate([core.ravel() for core in cores])
+    var_shapes = dict(("w/core_%d" % i, core.shape) for i, core in enumerate(cores))
+    weights = unflatten_cores({"w": flat}, var_shapes)
+    assert "w" not in weights
+    for i, core in enumerate(cores):
+        np.testing.assert_array_equal(weights["w/core_%d" % i], core)
@@ -40,6 +40,10 @@ flags.DEFINE_bool("use_error_prop", True,
 flags.DEFINE_integer("hidden_size", 16, "hidden layer size")
 flags.DEFINE_float("learning_rate", 1e-2, "learning rate")
 flags.DEFINE_integer("num_steps",20,"Training sequence length")
+flags.DEFINE_bool("carry_state", False,
+                  "Truncated BPTT over contiguous chunks with carried states")
+flags.DEFINE_bool("mmap", False,
+                  "Memory-map the data file and normalize per batch")
 
 
 FLAGS = flags.FLAGS
@@ -52,6 +56,7 @@ config.use_error_prop = FLAGS.use_error_prop
 config.hidden_size = FLAGS.hidden_size
 config.learning_rate = FLAGS.learning_rate
 config.num_steps = FLAGS.num_steps
+config.carry_state = FLAGS.carry_state
 
 training_steps = config.training_steps
 display_step = 200
@@ -60,7 +65,9 @@ num_test_steps = config.num_test_steps
 batch_size = config.batch_size
 
 # Construct dataset
-dataset, stats = read_data_sets(FLAGS.data_path, num_steps, num_steps)
+dataset, stats = read_data_sets(FLAGS.data_path, False, num_steps, num_test_steps,
+                                sequential_batch_size=batch_size if config.carry_state else None,
+                                mmap=FLAGS.mmap)
 
 # Network Parameters
 num_input = stats['num_input'] # dataset data input (time series dimension: 3)
@@ -102,7 +109,8 @@ optimizer = tf.train.RMSPropOptimizer(learning_rate=config.learning_rate)
 train_op = optimizer.minimize(train_loss)
 
 # Initialize the variables (i.e. assign their default value)
-init = tf.global_variables_initializer()
+init = tf.group(tf.global_variables_initializer(), tf.local_variables_initializer())
+carried_state_resets = tf.get_collection(CARRIED_STATE_RESETS)
 
 # Add ops to save and restore all the variables.
 saver = tf.train.Saver()
@@ -119,18 +127,26 @@ with tf.Session() as sess:
     sess.run(init)
 
     for step in range(1, training_steps+1):
-        batch_x, batch_y = dataset.train.next_batch(batch_size)
-        # Run optimization op (backprop)
-        sess.run(train_op, feed_dict={X: batch_x, Y: batch_y})
+        if config.carry_state:
+            batch_x, batch_y, is_first = dataset.train.next_batch()
+            if is_first:
+                # new series, start from zero states
+                sess.run(carried_state_resets)
+        else:
+            batch_x, batch_y = dataset.train.next_batch(batch_size)
         if step % display_step == 0 or step == 1:
-            # Calculate batch loss and accuracy
+            # Run optimization op (backprop) and calculate batch loss in the
+            # same run, a second run would advance the carried states
             run_options = tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE)
             run_metadata = tf.RunMetadata()
-            summary, tr_loss = sess.run([merged, train_loss], feed_dict={X: batch_x,Y: batch_y})
+            _, summary, tr_loss = sess.run([train_op, merged, train_loss], feed_dict={X: batch_x,Y: batch_y})
             train_writer.add_run_metadata(run_metadata, 'step%03d' % step)
             train_writer.add_summary(summary, step)
             print("Step " + str(step) + ", Minibatch Loss= " + \
                   "{:.4f}".format(tr_loss) )
+        else:
+            # Run optimization op (backprop)
+            sess.run(train_op, feed_dict={X: batch_x, Y: batch_y})
     print("Optimization Finished!")
 
     # Calculate accuracy for valid inps
@@ -156,6 +172,11 @@ with tf.Session() as sess:
     print("Model saved in file: %s" % save_path)
     # Save predictions 
     numpy.save(save_path+"predict.npy", (test_vals["true"], test_vals["pred"]))
+    # Save the scaler of the training split and the denormalized predictions
+    scaler = stats['scaler']
+    scaler.save(save_path+"scaler.npz")
+    numpy.save(save_path+"predict_denorm.npy",
+               (scaler.inverse_transform(test_vals["true"]), scaler.inverse_transform(test_vals["pred"])))
     # Save config file
     with open(save_path+"config.out", 'w') as f:
         f.write('num_layers:'+ str(config.num_layers) +'\t'+'hidden_size:'+ str(config.hidden_size)+
@@ -10,10 +10,24 @@ class TrainConfig(object):
   horizon = 1
   num_lags = 2 # num prev hiddens
   num_orders = 2 # tensor prod order
+  sketch_size = None # TensorSketch dim of high order states, None: full tensor
   rank_vals= [2]
-  num_freq = 2
+  num_freq = 2 # MTRNN resolution states[::num_freq], or list of frequencies e.g. [1, 2, 4]
+  contraction = "outer" # tt contraction: "outer" or "fused"
+  input_proj_size = None # TALSTM inputs projected to this size, None: raw inputs
+  tt_modes = None # TT-matrix factorization of the input size e.g. [8, 8, 8, 8], None: dense input/output layers
+  tt_rank = 4 # rank of the TT-matrix layers
+  use_while_loop = False # tf.while_loop over time instead of unrolled steps
+  hoist_inputs = True # one input projection for all ground truth steps (unrolled loop)
+  carry_state = False # truncated BPTT, states carried across contiguous training chunks
+  recompute_segment = None # steps per gradient checkpointing segment (training), None: keep all activations
+  num_samples = 1 # forecast particles per example at inference, > 1: sampled forecasts
+  feedback_noise = 0.0 # stddev of the gaussian noise on fed back outputs (sampled forecasts)
+  decoder = "autoregressive" # seq2seq decoder: "autoregressive" or "direct" (all horizons from the encoder states)
+  max_horizon = None # steps of the direct decoder, serves every shorter horizon, None: decoder steps
   training_epochs = int(1e2)
   keep_prob = 1.0 # dropout
+  use_sched_samp = False # scheduled sampling of the decoder inputs in training
   sample_prob = 0.0 # sample ground true
   batch_size = 20
   use_error_prop = True
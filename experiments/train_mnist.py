@@ -4,6 +4,8 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import time
+
 import numpy as np
 from six.moves import xrange  # pylint: disable=redefined-builtin
 
@@ -13,6 +15,8 @@ from tensorflow.python.framework import random_seed
 import tensorflow as tf
 from tensorflow.contrib import rnn
 from reader_mnist import read_data_sets
+from input_pipeline import batch_tensors
+from mnist_producer import MNISTBatchProducer
 from model_seq2seq import *
 from trnn import *
 import numpy 
@@ -36,6 +40,20 @@ flags.DEFINE_integer("batch_size", 20, "batch size")
 flags.DEFINE_float("learning_rate", 1e-3, "learning rate")
 flags.DEFINE_float("decay_rate", 0.8, "learning rate")
 flags.DEFINE_integer("rank", 2, "rank for tt decomposition")
+flags.DEFINE_bool("use_while_loop", False,
+                  "Build the recurrence with tf.while_loop instead of unrolling")
+flags.DEFINE_integer("recompute_segment", None,
+                     "Steps per gradient checkpointing segment in training, None: no recomputation")
+flags.DEFINE_integer("input_proj_size", None, "TALSTM input projection size")
+flags.DEFINE_string("tt_modes", None, "TT-matrix factorization of the frame size, e.g. 8,8,8,8")
+flags.DEFINE_integer("tt_rank", 4, "rank of the TT-matrix layers")
+flags.DEFINE_bool("use_pipeline", False,
+                  "Feed training batches from a tf.data pipeline instead of feed_dict")
+flags.DEFINE_integer("num_parallel_calls", 4, "parallel batch preparations of the pipeline")
+flags.DEFINE_integer("prefetch_batches", 2, "batches prepared ahead by the pipeline")
+flags.DEFINE_integer("num_workers", 0, "batch producer processes, 0: batches made by the training loop")
+flags.DEFINE_integer("queue_depth", 4, "shared memory batch slots of the producer")
+flags.DEFINE_integer("producer_seed", 0, "seed of the producer epoch permutations and trajectories")
 
 FLAGS = flags.FLAGS
 
@@ -54,9 +72,16 @@ config.batch_size = FLAGS.batch_size
 config.learning_rate = FLAGS.learning_rate
 config.decay_rate = FLAGS.decay_rate
 config.rank_vals = [FLAGS.rank]
+config.use_while_loop = FLAGS.use_while_loop
+config.recompute_segment = FLAGS.recompute_segment
+config.input_proj_size = FLAGS.input_proj_size
+if FLAGS.tt_modes:
+    config.tt_modes = [int(mode) for mode in FLAGS.tt_modes.split(",")]
+config.tt_rank = FLAGS.tt_rank
 
 # Scheduled sampling
 # = tf.Variable(0.0, trainable=False)
+config.use_sched_samp = FLAGS.use_sched_samp
 if FLAGS.use_sched_samp:
     config.sample_prob = tf.get_variable("sample_prob", shape=(), initializer=tf.zeros_initializer())
 sampling_burn_in = 400
@@ -72,6 +97,11 @@ test_steps = FLAGS.test_steps
 # Read MINIST Dataset
 print('inp steps', inp_steps, 'out steps', test_steps)
 dataset, stats = read_data_sets(FLAGS.data_path, inp_steps, test_steps)
+# worker processes started before any session
+producer = None
+if FLAGS.num_workers > 0 and not FLAGS.use_pipeline:
+    producer = MNISTBatchProducer(dataset.train, batch_size, FLAGS.num_workers,
+                                  FLAGS.queue_depth, FLAGS.producer_seed)
 
 # Network Parameters
 num_input = stats['num_input']  # dataset data input (time series dimension: 3)
@@ -79,10 +109,19 @@ out_steps = test_steps
 image_size = int(np.sqrt(num_input))
 
 # tf Graph input
-X = tf.placeholder("float", [None, inp_steps, num_input], name="enc_inps")
-Y = tf.placeholder("float", [None, out_steps, num_input], name="dec_inps")
-# Decoder output
-Z = tf.placeholder("float", [None, out_steps, num_input], name="dec_outs")
+if FLAGS.use_pipeline:
+    # training videos synthesized by the pipeline, validation and test batches are fed
+    train_x, train_y, train_z = batch_tensors(dataset.train, batch_size,
+                                              num_parallel_calls=FLAGS.num_parallel_calls,
+                                              prefetch_batches=FLAGS.prefetch_batches)
+    X = tf.placeholder_with_default(train_x, [None, inp_steps, num_input], name="enc_inps")
+    Y = tf.placeholder_with_default(train_y, [None, out_steps, num_input], name="dec_inps")
+    Z = tf.placeholder_with_default(train_z, [None, out_steps, num_input], name="dec_outs")
+else:
+    X = tf.placeholder("float", [None, inp_steps, num_input], name="enc_inps")
+    Y = tf.placeholder("float", [None, out_steps, num_input], name="dec_inps")
+    # Decoder output
+    Z = tf.placeholder("float", [None, out_steps, num_input], name="dec_outs")
 
 Model = globals()[FLAGS.model]
 with tf.name_scope("Train"):
@@ -123,6 +162,8 @@ train_pred_summary = tf.summary.image("train_pred", tf.reshape(train_pred[0],[ou
 
 # Initialize the variables (i.e. assign their default value)
 init = tf.global_variables_initializer()
+# Peak memory of the device, to compare recompute_segment settings
+peak_bytes = tf.contrib.memory_stats.MaxBytesInUse()
 saver = tf.train.Saver()
 
 hist_loss =[]
@@ -139,15 +180,27 @@ with tf.Session(config=sess_config) as sess:
     sess.run(init)    
     step = 0
     epoch =0
+    start_time, start_step = time.time(), 0
     while(epoch < training_epochs):
-        batch_x, batch_y, batch_z = dataset.train.next_batch(batch_size)
-        dataset.train.display_data(batch_z)
-
-        # Run optimization op (backprop)
-        sess.run(train_op, feed_dict={X: batch_x, Y: batch_y, Z:batch_z})
-        if step % display_step == 0 or step == 1:
-            # Calculate batch loss 
-            summary, loss = sess.run([merged,train_loss], feed_dict={X: batch_x,Y: batch_y, Z:batch_z})
+        if FLAGS.use_pipeline:
+            train_feed = {}
+        elif producer is not None:
+            batch_x, batch_y, batch_z = producer.next_batch()
+            train_feed = {X: batch_x, Y: batch_y, Z:batch_z}
+        else:
+            batch_x, batch_y, batch_z = dataset.train.next_batch(batch_size)
+            dataset.train.display_data(batch_z)
+            train_feed = {X: batch_x, Y: batch_y, Z:batch_z}
+
+        # Run optimization op (backprop), with the batch loss on display steps:
+        # the input pipeline hands out a new batch on every run
+        is_display = step % display_step == 0 or step == 1
+        if is_display:
+            _, summary, loss = sess.run([train_op, merged, train_loss], feed_dict=train_feed)
+        else:
+            sess.run(train_op, feed_dict=train_feed)
+        if is_display:
+            print("Steps/sec: %.2f" % ((step + 1 - start_step) / (time.time() - start_time)))
             run_options = tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE)
             run_metadata = tf.RunMetadata()
             summary_writer.add_run_metadata(run_metadata,'step%03d' % step)
@@ -173,10 +226,17 @@ with tf.Session(config=sess_config) as sess:
                 sample_prob = max(eps_min, 1.0-step/(2*training_steps))
                 sess.run(tf.assign(config.sample_prob, sample_prob))
                 print('Sampling prob:', sample_prob)
+            start_time, start_step = time.time(), step + 1
      
-        epoch = dataset.train.epochs_completed
+        if FLAGS.use_pipeline or producer is not None:
+            epoch = (step + 1) * batch_size // dataset.train.num_examples
+        else:
+            epoch = dataset.train.epochs_completed
         step = step + 1 
     print("Optimization Finished!")
+    if producer is not None:
+        producer.close()
+    print("Peak memory: %.1f MB" % (sess.run(peak_bytes) / 2.0**20))
 
     # Calculate accuracy for test datasets
     test_vals_loss = 1000
@@ -4,6 +4,9 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import copy
+import time
+
 import numpy as np
 from six.moves import xrange  # pylint: disable=redefined-builtin
 
@@ -13,6 +16,7 @@ from tensorflow.python.framework import random_seed
 import tensorflow as tf
 from tensorflow.contrib import rnn
 from reader import read_data_sets
+from input_pipeline import batch_tensors
 from model_seq2seq import *
 from trnn import *
 import numpy 
@@ -33,9 +37,29 @@ flags.DEFINE_bool("use_sched_samp", False,
 flags.DEFINE_integer("burn_in_steps", 12, "burn in steps")
 flags.DEFINE_integer("test_steps", None, "test steps size")
 flags.DEFINE_integer("hidden_size", 8, "hidden layer size")
+flags.DEFINE_integer("num_layers", 2, "number of stacked layers")
+flags.DEFINE_integer("num_lags", 2, "number of previous hidden states")
 flags.DEFINE_float("learning_rate", 1e-3, "learning rate")
 flags.DEFINE_float("decay_rate", 0.8, "learning rate")
 flags.DEFINE_integer("rank", 2, "rank for tt decomposition")
+flags.DEFINE_bool("use_while_loop", False,
+                  "Build the recurrence with tf.while_loop instead of unrolling")
+flags.DEFINE_integer("recompute_segment", None,
+                     "Steps per gradient checkpointing segment in training, None: no recomputation")
+flags.DEFINE_string("contraction", "outer",
+          "tt contraction: 'outer' (full state tensor) or 'fused' (per core)")
+flags.DEFINE_string("decoder", "autoregressive",
+          "seq2seq decoder: 'autoregressive' or 'direct' (one shot tt head)")
+flags.DEFINE_integer("max_horizon", None, "steps of the direct decoder head")
+flags.DEFINE_integer("num_samples", 1, "sampled test forecasts per example, > 1: forecast quantiles")
+flags.DEFINE_float("feedback_noise", 0.05, "noise stddev on fed back outputs of sampled forecasts")
+flags.DEFINE_string("quantiles", "0.05,0.5,0.95", "quantiles of the sampled forecasts")
+flags.DEFINE_bool("mmap", False,
+                  "Memory-map the data file and normalize per batch")
+flags.DEFINE_bool("use_pipeline", False,
+                  "Feed training batches from a tf.data pipeline instead of feed_dict")
+flags.DEFINE_integer("num_parallel_calls", 4, "parallel batch preparations of the pipeline")
+flags.DEFINE_integer("prefetch_batches", 2, "batches prepared ahead by the pipeline")
 
 FLAGS = flags.FLAGS
 
@@ -50,12 +74,20 @@ config = TrainConfig()
 config.use_error_prop = FLAGS.use_error_prop
 config.burn_in_steps = FLAGS.burn_in_steps
 config.hidden_size = FLAGS.hidden_size
+config.num_layers = FLAGS.num_layers
+config.num_lags = FLAGS.num_lags
 config.learning_rate = FLAGS.learning_rate
 config.decay_rate = FLAGS.decay_rate
 config.rank_vals = [FLAGS.rank]
+config.use_while_loop = FLAGS.use_while_loop
+config.recompute_segment = FLAGS.recompute_segment
+config.contraction = FLAGS.contraction
+config.decoder = FLAGS.decoder
+config.max_horizon = FLAGS.max_horizon
 
 # Scheduled sampling
 # = tf.Variable(0.0, trainable=False)
+config.use_sched_samp = FLAGS.use_sched_samp
 if FLAGS.use_sched_samp:
     config.sample_prob = tf.get_variable("sample_prob", shape=(), initializer=tf.zeros_initializer())
 sampling_burn_in = 400
@@ -70,7 +102,7 @@ test_steps = FLAGS.test_steps
 
 # Read Dataset
 print('inp steps', inp_steps, 'out steps', test_steps)
-dataset, stats = read_data_sets(FLAGS.data_path, True, inp_steps, test_steps)
+dataset, stats = read_data_sets(FLAGS.data_path, True, inp_steps, test_steps, mmap=FLAGS.mmap)
 
 # Network Parameters
 num_input = stats['num_input']  # dataset data input (time series dimension: 3)
@@ -82,11 +114,20 @@ if test_steps is None:
 
 
 # tf Graph input
-X = tf.placeholder("float", [None, inp_steps, num_input])
-Y = tf.placeholder("float", [None, out_steps, num_input])
+if FLAGS.use_pipeline:
+    # training batches from the pipeline, validation and test batches are fed
+    train_x, train_y, train_z = batch_tensors(dataset.train, batch_size,
+                                              num_parallel_calls=FLAGS.num_parallel_calls,
+                                              prefetch_batches=FLAGS.prefetch_batches)
+    X = tf.placeholder_with_default(train_x, [None, inp_steps, num_input])
+    Y = tf.placeholder_with_default(train_y, [None, out_steps, num_input])
+    Z = tf.placeholder_with_default(train_z, [None, out_steps, num_input])
+else:
+    X = tf.placeholder("float", [None, inp_steps, num_input])
+    Y = tf.placeholder("float", [None, out_steps, num_input])
 
-# Decoder output
-Z = tf.placeholder("float", [None, out_steps, num_input])
+    # Decoder output
+    Z = tf.placeholder("float", [None, out_steps, num_input])
 
 Model = globals()[FLAGS.model]
 with tf.name_scope("Train"):
@@ -96,6 +137,16 @@ with tf.name_scope("Test"):
     with tf.variable_scope("Model", reuse=True):
         test_pred = Model(X, Y, False,  config)
 
+# Sampled forecasts, num_samples particles per example decoded in one batch
+if FLAGS.num_samples > 1:
+    sample_config = copy.copy(config)
+    sample_config.num_samples = FLAGS.num_samples
+    sample_config.feedback_noise = FLAGS.feedback_noise
+    quantiles = [float(q) for q in FLAGS.quantiles.split(",")]
+    with tf.name_scope("Sample"):
+        with tf.variable_scope("Model", reuse=True):
+            samples = Model(X, Y, False, sample_config)
+            sample_quants = sample_quantiles(samples, quantiles)
 
 # Define loss and optimizer
 train_loss = tf.sqrt(tf.reduce_mean(tf.squared_difference(train_pred, Z)))
@@ -118,6 +169,8 @@ lr_summary = tf.summary.scalar('learning_rate', learning_rate)
 
 # Initialize the variables (i.e. assign their default value)
 init = tf.global_variables_initializer()
+# Peak memory of the device, to compare recompute_segment settings
+peak_bytes = tf.contrib.memory_stats.MaxBytesInUse()
 
 saver = tf.train.Saver()
 
@@ -131,13 +184,22 @@ with tf.Session() as sess:
     # Run the initializer
     sess.run(init)    
     
+    start_time, start_step = time.time(), 0
     for step in range(1, training_steps+1):
-        batch_x, batch_y, batch_z = dataset.train.next_batch(batch_size)
-        # Run optimization op (backprop)
-        sess.run(train_op, feed_dict={X: batch_x, Y: batch_y, Z:batch_z})
-        if step % display_step == 0 or step == 1:
-            # Calculate batch loss 
-            summary, loss = sess.run([merged,train_loss], feed_dict={X: batch_x,Y: batch_y, Z:batch_z, keep_prob: 0.5})
+        if FLAGS.use_pipeline:
+            train_feed = {}
+        else:
+            batch_x, batch_y, batch_z = dataset.train.next_batch(batch_size)
+            train_feed = {X: batch_x, Y: batch_y, Z:batch_z}
+        # Run optimization op (backprop), with the batch loss on display steps:
+        # the input pipeline hands out a new batch on every run
+        is_display = step % display_step == 0 or step == 1
+        if is_display:
+            _, summary, loss = sess.run([train_op, merged, train_loss], feed_dict=train_feed)
+        else:
+            sess.run(train_op, feed_dict=train_feed)
+        if is_display:
+            print("Steps/sec: %.2f" % ((step - start_step) / (time.time() - start_time)))
             run_options = tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE)
             run_metadata = tf.RunMetadata()
             summary_writer.add_run_metadata(run_metadata, 'step%03d' % step)
@@ -150,7 +212,7 @@ with tf.Session() as sess:
             valid_dec_inps = dataset.validation.dec_inps.reshape((-1, out_steps, num_input))
             valid_dec_outs = dataset.validation.dec_outs.reshape((-1, out_steps, num_input))
             va_sum, va_loss = sess.run([valid_summary,test_loss], \
-                                       feed_dict={X: valid_enc_inps, Y: valid_dec_inps, Z: valid_dec_outs, keep_prob: 1.0})
+                                       feed_dict={X: valid_enc_inps, Y: valid_dec_inps, Z: valid_dec_outs})
             summary_writer.add_summary(va_sum, step) 
             print("Validation Loss:", va_loss)
             
@@ -165,8 +227,10 @@ with tf.Session() as sess:
                 sample_prob = max(eps_min, 1.0-step/(2*training_steps))
                 sess.run(tf.assign(config.sample_prob, sample_prob))
                 print('Sampling prob:', sample_prob)
+            start_time, start_step = time.time(), step
 
     print("Optimization Finished!")
+    print("Peak memory: %.1f MB" % (sess.run(peak_bytes) / 2.0**20))
 
     # Calculate accuracy for test datasets
     test_enc_inps = dataset.test.enc_inps.reshape((-1, inp_steps, num_input))
@@ -180,14 +244,32 @@ with tf.Session() as sess:
         "pred":test_pred,
         "loss":test_loss
     }
-    test_vals = sess.run(fetches, feed_dict={X: test_enc_inps, Y: test_dec_inps, Z: test_dec_outs, keep_prob: 1.0})
+    start = time.time()
+    test_vals = sess.run(fetches, feed_dict={X: test_enc_inps, Y: test_dec_inps, Z: test_dec_outs})
+    point_time = time.time() - start
     print("Testing Loss:", test_vals["loss"])
 
+    if FLAGS.num_samples > 1:
+        start = time.time()
+        test_quants = sess.run(sample_quants, feed_dict={X: test_enc_inps, Y: test_dec_inps})
+        sample_time = time.time() - start
+        # share of the targets within the outer quantiles
+        coverage = np.mean((test_dec_outs >= test_quants[0]) & (test_dec_outs <= test_quants[-1]))
+        print("Quantiles", quantiles, "coverage:", coverage)
+        print("Forecast time: %.3fs, %d samples: %.3fs" % (point_time, FLAGS.num_samples, sample_time))
+
     # Save the variables to disk.
     save_path = saver.save(sess, FLAGS.save_path)
     print("Model saved in file: %s" % save_path)
     # Save predictions 
     numpy.save(save_path+"predict.npy", (test_vals["true"], test_vals["pred"]))
+    # Save the scaler of the training split and the denormalized predictions
+    scaler = stats['scaler']
+    scaler.save(save_path+"scaler.npz")
+    numpy.save(save_path+"predict_denorm.npy",
+               (scaler.inverse_transform(test_vals["true"]), scaler.inverse_transform(test_vals["pred"])))
+    if FLAGS.num_samples > 1:
+        numpy.save(save_path+"quantiles.npy", scaler.inverse_transform(test_quants))
     # Save config file
     with open(save_path+"config.out", 'w') as f:
         f.write('hidden_size:'+ str(config.hidden_size)+'\t'+ 'learning_rate:'+ str(config.learning_rate)+ '\n')
@@ -13,8 +13,40 @@ from tensorflow.python.ops.rnn_cell_impl import LSTMStateTuple
 
 import numpy as np
 import copy
+import zlib
 from collections import deque
 
+from contraction_plan import plan_contraction, tt_einsum_network
+
+# batch size assumed when planning contractions for a dynamic batch dimension
+PLAN_BATCH_SIZE = 128
+
+def _split_inputs(cell, inputs, output_size):
+    """(x, U * x) of the inputs of a cell, U * x is None unless precomputed.
+    Only the first layer gets tuples from the driver: (x, U * x), or (x,)
+    for the step that creates the variables, on which the cell records the
+    scope and size of its input projection for project_inputs. A cell object
+    shared by all layers of a MultiRNNCell keeps the scope of the first
+    layer this way."""
+    if not isinstance(inputs, tuple):
+        return inputs, None
+    if len(inputs) == 1:
+        cell._input_scope, cell._input_proj_size = vs.get_variable_scope(), output_size
+        return inputs[0], None
+    return inputs
+
+def project_inputs(cell, block):
+    """U * x [batch_size, num_steps, output_size] of every step of the ground
+    truth block [batch_size, num_steps, input_size] in one matmul, with the
+    input weights of the first layer cell (takes_input_projection). The driver
+    must have called it once with a (x,) tuple, so that its variables exist
+    and its scope is known."""
+    num_steps, input_size = block.get_shape().as_list()[1:]
+    flat = tf.reshape(block, [-1, input_size])
+    with vs.variable_scope(cell._input_scope, reuse=True):
+        out_x = _input_weights(flat, cell._input_proj_size, cell._tt_modes, cell._tt_rank)
+    return tf.reshape(out_x, [-1, num_steps, cell._input_proj_size])
+
 class MatrixRNNCell(RNNCell):
     """RNN cell with first order concatenation of hidden states"""
     def __init__(self, num_units, num_lags, activation=tanh, reuse=None):
@@ -89,12 +121,13 @@ class MatrixLSTMCell(RNNCell):
 
 class HighOrderRNNCell(RNNCell):
     """RNN cell with high-order interactions of hidden states"""
-    def __init__(self, num_units, num_lags, num_orders, activation=tanh, reuse=None):  
+    def __init__(self, num_units, num_lags, num_orders, activation=tanh, reuse=None, sketch_size=None):  
         super(HighOrderRNNCell, self).__init__(_reuse=reuse) 
         self._num_units = num_units
         self._num_lags = num_lags
         self._num_orders = num_orders
         self._activation = activation
+        self._sketch_size = sketch_size
 
     @property
     def state_size(self):
@@ -105,13 +138,14 @@ class HighOrderRNNCell(RNNCell):
         return self._num_units
 
     def __call__(self, inputs, states):
-        output = tensor_network_highorder( inputs, states, self._num_units, self._num_orders,True)
+        output = tensor_network_highorder( inputs, states, self._num_units, self._num_orders,True,
+                                           sketch_size=self._sketch_size)
         new_state = self._activation(output)
         return new_state, new_state
 
 class HighOrderLSTMCell(RNNCell):
     """LSTM cell with high-order interactions of hidden states"""
-    def __init__(self, num_units, num_lags, num_orders, forget_bias=1.0, state_is_tuple=True, activation=tanh, reuse=None):
+    def __init__(self, num_units, num_lags, num_orders, forget_bias=1.0, state_is_tuple=True, activation=tanh, reuse=None, sketch_size=None):
         super(HighOrderLSTMCell, self).__init__(_reuse=reuse)
         self._num_units = num_units
         self._num_lags = num_lags
@@ -119,6 +153,7 @@ class HighOrderLSTMCell(RNNCell):
         self._forget_bias = forget_bias
         self._state_is_tuple= state_is_tuple
         self._activation = activation
+        self._sketch_size = sketch_size
 
     @property
     def state_size(self):
@@ -150,7 +185,8 @@ class HighOrderLSTMCell(RNNCell):
 
         # concat = _linear([inputs, h], 4 * self._num_units, True)
         output_size = 4 * self._num_units
-        concat = tensor_network_highorder(inputs, hs, output_size, self._num_orders, True)
+        concat = tensor_network_highorder(inputs, hs, output_size, self._num_orders, True,
+                                          sketch_size=self._sketch_size)
         # i = input_gate, j = new_input, f = forget_gate, o = output_gate
         i, j, f, o = array_ops.split(value=concat, num_or_size_splits=4, axis=1)
 
@@ -169,11 +205,15 @@ class TensorAugLSTMCell(RNNCell):
     """LSTM cell with high-order interactions of hidden states
        With augmented states [X, h], explictly consider the high-order input 
     """
-    def __init__(self, num_units, num_lags, rank_vals, forget_bias=1.0, state_is_tuple=True, activation=tanh, reuse=None):
+    def __init__(self, num_units, num_lags, rank_vals, forget_bias=1.0, state_is_tuple=True, activation=tanh, reuse=None, contraction="outer", input_proj_size=None, tt_modes=None, tt_rank=None):
         super(TensorAugLSTMCell, self).__init__(_reuse=reuse)
         self._num_units = num_units
         self._num_lags = num_lags
         self._rank_vals = rank_vals
+        self._contraction = contraction
+        self._tt_modes = tt_modes # TT-matrix factorization of the input size
+        self._tt_rank = tt_rank
+        self._input_proj_size = input_proj_size # project inputs to this size before augmentation
         self._forget_bias = forget_bias
         self._state_is_tuple= state_is_tuple
         self._activation = activation
@@ -207,7 +247,8 @@ class TensorAugLSTMCell(RNNCell):
 
         # concat = _linear([inputs, h], 4 * self._num_units, True)
         output_size = 4 * self._num_units
-        concat = tensor_network_aug(inputs, hs, output_size, self._rank_vals, True)
+        concat = tensor_network_aug(inputs, hs, output_size, self._rank_vals, True, contraction=self._contraction,
+                                    input_proj_size=self._input_proj_size, tt_modes=self._tt_modes, tt_rank=self._tt_rank)
         # i = input_gate, j = new_input, f = forget_gate, o = output_gate
         i, j, f, o = array_ops.split(value=concat, num_or_size_splits=4, axis=1)
 
@@ -223,11 +264,15 @@ class TensorAugLSTMCell(RNNCell):
         
 class EinsumTensorRNNCell(RNNCell):
     """RNN cell with high order correlations with tensor contraction"""
-    def __init__(self, num_units, num_lags, rank_vals, activation=tanh, reuse=None):
+    takes_input_projection = True # accepts (x, U * x) inputs, see project_inputs
+    def __init__(self, num_units, num_lags, rank_vals, activation=tanh, reuse=None, contraction="outer", tt_modes=None, tt_rank=None):
         super(EinsumTensorRNNCell, self).__init__(_reuse=reuse)
         self._num_units = num_units
         self._num_lags = num_lags
         self._rank_vals = rank_vals
+        self._contraction = contraction
+        self._tt_modes = tt_modes # TT-matrix factorization of the input size
+        self._tt_rank = tt_rank
         self._activation = activation
 
     @property
@@ -239,17 +284,23 @@ class EinsumTensorRNNCell(RNNCell):
             return self._num_units
 
     def __call__(self, inputs, states):   
-            output = tensor_network_tt_einsum(inputs, states, self._num_units,self._rank_vals, True)
+            inputs, out_x = _split_inputs(self, inputs, self._num_units)
+            output = tensor_network_tt_einsum(inputs, states, self._num_units,self._rank_vals, True, contraction=self._contraction,
+                                              tt_modes=self._tt_modes, tt_rank=self._tt_rank, out_x=out_x)
             new_state = self._activation(output)
             return new_state, new_state
 
 class TensorLSTMCell(RNNCell):
     """LSTM cell with high order correlations with tensor contraction"""
-    def __init__(self, num_units, num_lags, rank_vals, forget_bias=1.0, state_is_tuple=True, activation=tanh, reuse=None):
+    takes_input_projection = True # accepts (x, U * x) inputs, see project_inputs
+    def __init__(self, num_units, num_lags, rank_vals, forget_bias=1.0, state_is_tuple=True, activation=tanh, reuse=None, contraction="outer", tt_modes=None, tt_rank=None):
         super(TensorLSTMCell, self).__init__(_reuse=reuse)
         self._num_units = num_units
         self._num_lags = num_lags
         self._rank_vals = rank_vals
+        self._contraction = contraction
+        self._tt_modes = tt_modes # TT-matrix factorization of the input size
+        self._tt_rank = tt_rank
         self._forget_bias = forget_bias
         self._state_is_tuple= state_is_tuple
         self._activation = activation
@@ -280,7 +331,9 @@ class TensorLSTMCell(RNNCell):
                 hs += (h,)
 
         output_size = 4 * self._num_units
-        concat = tensor_network_tt_einsum(inputs, hs, output_size, self._rank_vals, True)
+        inputs, out_x = _split_inputs(self, inputs, output_size)
+        concat = tensor_network_tt_einsum(inputs, hs, output_size, self._rank_vals, True, contraction=self._contraction,
+                                          tt_modes=self._tt_modes, tt_rank=self._tt_rank, out_x=out_x)
         # i = input_gate, j = new_input, f = forget_gate, o = output_gate
         i, j, f, o = array_ops.split(value=concat, num_or_size_splits=4, axis=1)
 
@@ -297,12 +350,16 @@ class TensorLSTMCell(RNNCell):
     
 class MTRNNCell(RNNCell):
     """Multi-resolution Tensor RNN cell """
-    def __init__(self, num_units, num_lags, num_freq, rank_vals, activation=tanh):
+    takes_input_projection = True # accepts (x, U * x) inputs, see project_inputs
+    def __init__(self, num_units, num_lags, num_freq, rank_vals, activation=tanh, reuse=None, contraction="outer", tt_modes=None, tt_rank=None):
         super(MTRNNCell, self).__init__(_reuse=reuse)
         self._num_units = num_units
         self._num_lags = num_lags
-        self._num_freq =  num_freq # frequency for the 2nd tt state
+        self._num_freq =  num_freq # frequency of the 2nd tt state, or list of frequencies of every tt state
         self._rank_vals = rank_vals
+        self._contraction = contraction
+        self._tt_modes = tt_modes # TT-matrix factorization of the input size
+        self._tt_rank = tt_rank
         self._activation = activation
 
     @property
@@ -314,7 +371,9 @@ class MTRNNCell(RNNCell):
         return self._num_units
 
     def __call__(self, inputs, states, scope=None):
-        output = tensor_network_mtrnn( inputs, states, self._num_units,self._rank_vals, self._num_freq,True)
+        inputs, out_x = _split_inputs(self, inputs, self._num_units)
+        output = tensor_network_mtrnn( inputs, states, self._num_units,self._rank_vals, self._num_freq,True, contraction=self._contraction,
+                                       tt_modes=self._tt_modes, tt_rank=self._tt_rank, out_x=out_x)
         new_state = self._activation(output)
         return new_state, new_state
 
@@ -360,8 +419,37 @@ def tensor_network_linear(inputs, states, output_size, bias, bias_start=0.0):
     return output
 
 
-def tensor_network_highorder(inputs, states, output_size, num_orders, bias, bias_start=0.0):
-    """tensor network [inputs, states]-> output with tensor models"""
+def _tensor_sketch(states_vector, num_orders, sketch_size, seed=None):
+    """TensorSketch of the order num_orders outer power of states_vector,
+    IFFT(FFT(C_1 v) * ... * FFT(C_K v)) with independent count sketches C_k.
+    Inner products of sketches approximate inner products of the full
+    [D**num_orders] tensors, at a cost linear in D.
+    seed: of the hash and sign functions, by default derived from the
+          variable scope so that every layer sketches independently
+    """
+    state_size = _shape_value(states_vector)[1]
+    if seed is None:
+        seed = zlib.crc32(vs.get_variable_scope().name.encode("utf-8")) & 0xffffffff
+    rng = np.random.RandomState(seed)
+    sketch_fft = None
+    for order in range(num_orders):
+        # count sketch: every coordinate goes to a random bucket with a random sign
+        buckets = rng.randint(sketch_size, size=state_size)
+        signs = rng.choice([-1.0, 1.0], size=state_size)
+        count_sketch = np.zeros((state_size, sketch_size), dtype=np.float32)
+        count_sketch[np.arange(state_size), buckets] = signs
+        count_sketch = vs.get_variable("count_sketch_%d" % order, [state_size, sketch_size],
+                                       initializer=tf.constant_initializer(count_sketch), trainable=False)
+        sketch = tf.matmul(states_vector, count_sketch)
+        sketch = tf.fft(tf.complex(sketch, tf.zeros_like(sketch)))
+        sketch_fft = sketch if sketch_fft is None else sketch_fft * sketch
+    return tf.real(tf.ifft(sketch_fft))
+
+def tensor_network_highorder(inputs, states, output_size, num_orders, bias, bias_start=0.0, sketch_size=None):
+    """tensor network [inputs, states]-> output with tensor models
+    sketch_size: if set, replace the full high order state tensor by its
+                 TensorSketch of that dimension
+    """
     # each coordinate of hidden state is independent- parallel
     num_lags = len(states)
     batch_size = tf.shape(inputs)[0]
@@ -373,78 +461,182 @@ def tensor_network_highorder(inputs, states, output_size, num_orders, bias, bias
    
     states_vector = tf.concat(states, 1)
     states_vector = tf.concat( [states_vector, tf.ones([batch_size, 1])], 1)
-    """form high order state tensor"""
-    states_tensor = states_vector
-    for order in range(num_orders-1):
-        states_tensor = _outer_product(batch_size, states_tensor, states_vector)
-    states_tensor= tf.reshape(states_tensor, [-1,total_state_size**num_orders] )
+    if sketch_size:
+        states_tensor = _tensor_sketch(states_vector, num_orders, sketch_size)
+    else:
+        """form high order state tensor"""
+        states_tensor = states_vector
+        for order in range(num_orders-1):
+            states_tensor = _outer_product(batch_size, states_tensor, states_vector)
+        states_tensor= tf.reshape(states_tensor, [-1,total_state_size**num_orders] )
     total_inputs.append(states_tensor)
     output = _linear(total_inputs, output_size, True)
     return output
 
 def tensor_train_contraction(states_tensor, cores):
+    """Contract the high order state tensor with the tt cores.
+    The pairwise contraction order is the cheapest one under the cost model
+    of contraction_plan, memoized per shape signature.
+    """
     # print("input:", states_tensor.name, states_tensor.get_shape().as_list())
-    # print("mat_dims", mat_dims)
-    # print("mat_ranks", mat_ranks)
-    # print("mat_ps", mat_ps)
-    # print("mat_size", mat_size)
-
-    abc = "abcdefgh"
-    ijk = "ijklmnopqrstuvwxy"
-
-    def _get_indices(r):
-        indices = "%s%s%s" % (abc[r], ijk[r], abc[r+1])
-        return indices
-
-    def _get_einsum(i, s2):
-        #
-        s1 = _get_indices(i)
-        _s1 = s1.replace(s1[1], "")
-        _s2 = s2.replace(s2[1], "")
-        _s3 = _s2 + _s1
-        _s3 = _s3[:-3] + _s3[-1:]
-        s3 = s1 + "," + s2 + "->" + _s3
-        return s3, _s3
 
     num_orders = len(cores)
-    # first factor
-    x = "z" + ijk[:num_orders] # "z" is the batch dimension
-    
-    # print(mat_core.get_shape().as_list())
+    # "z" is the batch dimension, "abc.." the tt ranks and "ijk.." the orders
+    inputs, output = tt_einsum_network(num_orders)
 
-    _s3 = x[:1] + x[2:] + "ab"
-    einsum = "aib," + x + "->" + _s3
-    x = _s3
+    size_dict = {"z": _shape_value(states_tensor)[0] or PLAN_BATCH_SIZE}
+    for indices, core in zip(inputs[1:], cores):
+        size_dict.update(zip(indices, _shape_value(core)))
 
-    # print("einsum", einsum, cores[0].get_shape().as_list, states_tensor.get_shape().as_list)
-
-    out_h = tf.einsum(einsum, cores[0], states_tensor)
-    # print(out_h.name, out_h.get_shape().as_list())
-
-    # 2nd - penultimate latent factor
-    for i in range(1, num_orders):
-
-        # We now compute the tensor inner product W * H, where W is decomposed
-        # into a tensor-train with D factors A^i. Each factor A^i is a 3-tensor,
-        # with dimensions [mat_rank[i], hidden_size, mat_rank[i+1] ]
-        # The lag index, indexing the components of the state vector H,
-        # runs from 1 <= i < K.
-
-        # print mat_core.get_shape().as_list()
-
-        einsum, x = ss, _s3 = _get_einsum(i, x)
-
-        # print "order", i, ss
-
-        out_h = tf.einsum(einsum, cores[i], out_h)
-        # print(out_h.name, out_h.get_shape().as_list())
+    operands = [states_tensor] + list(cores)
+    for i, j, einsum in plan_contraction(inputs, output, size_dict):
+        b = operands.pop(j)
+        a = operands.pop(i)
+        operands.append(tf.einsum(einsum, a, b))
+    out_h = operands[0]
 
     # print "Squeeze out the dimension-1 dummy dim (first dim of 1st latent factor)"
     out_h = tf.squeeze(out_h, [1])
     return out_h
 
+def tensor_train_contraction_fused(states_vector, cores):
+    """Contract the tt cores one order at a time against states_vector.
+    Same result as tensor_train_contraction on the outer product of the
+    states, without ever forming the [batch_size, D**num_orders] tensor.
+    """
+    out_h = None
+    for core in cores:
+        rank_in, state_size, rank_out = _shape_value(core)
+        # [batch_size, D] x [D, r_i * r_{i+1}] -> [batch_size, r_i, r_{i+1}]
+        core_mat = tf.reshape(tf.transpose(core, [1, 0, 2]), [state_size, rank_in * rank_out])
+        core_vec = tf.reshape(tf.matmul(states_vector, core_mat), [-1, rank_in, rank_out])
+        if out_h is None:
+            # the first rank is the dimension-1 dummy dim
+            out_h = tf.squeeze(core_vec, [1])
+        else:
+            out_h = tf.squeeze(tf.matmul(tf.expand_dims(out_h, 1), core_vec), [1])
+    return out_h
 
-def tensor_network_tt_einsum(inputs, states, output_size, rank_vals, bias, bias_start=0.0):
+def tensor_train_states_contraction(states_vector, cores, contraction="outer"):
+    """W * (states_vector x ... x states_vector) for tt cores of W
+    contraction: "outer" forms the high order state tensor first,
+                 "fused" contracts each core directly against the states
+    """
+    if contraction == "fused":
+        return tensor_train_contraction_fused(states_vector, cores)
+    if contraction != "outer":
+        raise ValueError("Unknown tt contraction: %s" % contraction)
+    batch_size = tf.shape(states_vector)[0]
+    """form high order state tensor"""
+    states_tensor = states_vector
+    for order in range(len(cores)-1):
+        states_tensor = _outer_product(batch_size, states_tensor, states_vector)
+    return tensor_train_contraction(states_tensor, cores)
+
+
+def tt_cores(name, mat_ranks, state_size):
+    """Cores A^i of a tensor-train transition tensor, one variable of shape
+    [mat_ranks[i], state_size, mat_ranks[i+1]] per core under scope name.
+    The variables are created once per cell and the same tensors are used by
+    every time step, see load_flat_cores for checkpoints with a flat weights_h.
+    """
+    mat_sizes = [int(r_in * state_size * r_out) for r_in, r_out in zip(mat_ranks[:-1], mat_ranks[1:])]
+    # same distribution as the default initializer of the former flat variable
+    limit = np.sqrt(3.0 / sum(mat_sizes))
+    initializer = tf.random_uniform_initializer(-limit, limit)
+    cores = []
+    with vs.variable_scope(name):
+        for i in range(len(mat_sizes)):
+            shape = [int(mat_ranks[i]), state_size, int(mat_ranks[i + 1])]
+            cores.append(vs.get_variable("core_%d" % i, shape, initializer=initializer))
+    return cores
+
+def load_flat_cores(sess, checkpoint_path, var_list=None):
+    """Restore a checkpoint written with the flat weights_h layout, where all
+    cores of a tensor train were serialized in one vector, into the per-core
+    variables of tt_cores. Other variables are restored by name.
+    """
+    if var_list is None:
+        var_list = tf.global_variables()
+    reader = tf.train.NewCheckpointReader(checkpoint_path)
+    saved = reader.get_variable_to_shape_map()
+    flat_cores = {}
+    for var in var_list:
+        name = var.op.name
+        scope, _, core = name.rpartition("/")
+        if name in saved:
+            var.load(reader.get_tensor(name), sess)
+        elif core.startswith("core_") and scope in saved:
+            flat_cores.setdefault(scope, []).append((int(core[len("core_"):]), var))
+        else:
+            print("%s not found." % name)
+    for scope, cores in flat_cores.items():
+        mat = reader.get_tensor(scope)
+        offset = 0
+        for _, var in sorted(cores, key=lambda core: core[0]):
+            shape = var.get_shape().as_list()
+            size = int(np.prod(shape))
+            var.load(mat[offset:offset + size].reshape(shape), sess)
+            offset += size
+        assert offset == mat.size, "%s does not match the shapes of its cores" % scope
+
+def tt_matrix_modes(size, num_modes):
+    """Factorize size into num_modes balanced modes, e.g. 4096 -> [8, 8, 8, 8]"""
+    factors = []
+    n, p = size, 2
+    while n > 1:
+        while n % p == 0:
+            factors.append(p)
+            n //= p
+        p += 1
+    modes = [1] * num_modes
+    for factor in sorted(factors, reverse=True):
+        modes[int(np.argmin(modes))] *= factor
+    return sorted(modes, reverse=True)
+
+def tt_matrix_linear(inputs, name, inp_modes, out_modes, rank, bias=False):
+    """inputs [batch_size, prod(inp_modes)] times a TT-matrix
+    W[(i_1..i_d), (j_1..j_d)] = G_1[i_1, j_1] ... G_d[i_d, j_d] with cores
+    G_k [r_k, n_k, m_k, r_{k+1}] (r_0 = r_d = 1) under scope name.
+    The dense [prod(inp_modes), prod(out_modes)] matrix is never formed."""
+    num_modes = len(inp_modes)
+    ranks = [1] + [rank] * (num_modes - 1) + [1]
+    input_size = int(np.prod(inp_modes))
+    output_size = int(np.prod(out_modes))
+    # every entry of W is a sum of prod(ranks) products of num_modes core
+    # entries, scaled to the glorot variance 2 / (input_size + output_size)
+    stddev = (2.0 / (input_size + output_size) / np.prod(ranks)) ** (0.5 / num_modes)
+    initializer = tf.random_normal_initializer(stddev=stddev)
+    with vs.variable_scope(name):
+        cores = [vs.get_variable("mat_core_%d" % k, [ranks[k], inp_modes[k], out_modes[k], ranks[k + 1]],
+                                 initializer=initializer) for k in range(num_modes)]
+        # out is [batch_size * m_1 .. m_{k-1}, r_k, n_k, n_{k+1} .. n_d]
+        out = inputs
+        rest = input_size
+        for k, core in enumerate(cores):
+            rest //= inp_modes[k]
+            out = tf.reshape(out, [-1, ranks[k], inp_modes[k], rest])
+            out = tf.reshape(tf.transpose(out, [0, 3, 1, 2]), [-1, ranks[k] * inp_modes[k]])
+            out = tf.matmul(out, tf.reshape(core, [ranks[k] * inp_modes[k], out_modes[k] * ranks[k + 1]]))
+            out = tf.reshape(out, [-1, rest, out_modes[k], ranks[k + 1]])
+            out = tf.transpose(out, [0, 2, 3, 1])
+        out = tf.reshape(out, [-1, output_size])
+        if bias:
+            biases = vs.get_variable("biases", [output_size])
+            out = nn_ops.bias_add(out, biases)
+    return out
+
+def _input_weights(inputs, output_size, tt_modes=None, tt_rank=None):
+    """U * x with a dense weights_x, or a TT-matrix weights_x when tt_modes
+    factorizes the input size"""
+    input_size = inputs.get_shape()[1].value
+    if tt_modes is not None and int(np.prod(tt_modes)) == input_size:
+        out_modes = tt_matrix_modes(output_size, len(tt_modes))
+        return tt_matrix_linear(inputs, "weights_x", tt_modes, out_modes, tt_rank)
+    weights_x = vs.get_variable("weights_x", [input_size, output_size] )
+    return tf.matmul(inputs, weights_x)
+
+def tensor_network_tt_einsum(inputs, states, output_size, rank_vals, bias, bias_start=0.0, contraction="outer", tt_modes=None, tt_rank=None, out_x=None):
 
     # print("Using Einsum Tensor-Train decomposition.")
 
@@ -458,10 +650,6 @@ def tensor_network_tt_einsum(inputs, states, output_size, rank_vals, bias, bias_
 
     total_state_size = (state_size * num_lags + 1 )
 
-    # These bookkeeping variables hold the dimension information that we'll
-    # use to store and access the transition tensor W efficiently.
-    mat_dims = np.ones((num_orders,)) * total_state_size
-
     # The latent dimensions used in our tensor-train decomposition.
     # Each factor A^i is a 3-tensor, with dimensions [a_i, hidden_size, a_{i+1}]
     # with dimensions [mat_rank[i], hidden_size, mat_rank[i+1] ]
@@ -470,38 +658,18 @@ def tensor_network_tt_einsum(inputs, states, output_size, rank_vals, bias, bias_
     # output.
     mat_ranks = np.concatenate(([1], rank_vals, [output_size]))
 
-    # This stores the boundary indices for the factors A. Starting from 0,
-    # each index i is computed by adding the number of weights in the i'th
-    # factor A^i.
-    mat_ps = np.cumsum(np.concatenate(([0], mat_ranks[:-1] * mat_dims * mat_ranks[1:])),dtype=np.int32)
-    mat_size = mat_ps[-1]
-
-    # Compute U * x
-    weights_x = vs.get_variable("weights_x", [input_size, output_size] )
-    out_x = tf.matmul(inputs, weights_x)
+    # Compute U * x, unless precomputed by the driver
+    if out_x is None:
+        out_x = _input_weights(inputs, output_size, tt_modes, tt_rank)
 
-    # Get a variable that holds all the weights of the factors A^i of the
-    # transition tensor W. All weights are stored serially, so we need to do
-    # some bookkeeping to keep track of where each factor is stored.
-    mat = vs.get_variable("weights_h", mat_size) # h_z x h_z... x output_size
+    # The factors A^i of the transition tensor W, each stored in its own
+    # variable with its final shape.
+    cores = tt_cores("weights_h", mat_ranks, total_state_size) # h_z x h_z... x output_size
 
-    #mat = tf.Variable(mat, name="weights")
     states_vector = tf.concat(states, 1)
     states_vector = tf.concat( [states_vector, tf.ones([batch_size, 1])], 1)
-    """form high order state tensor"""
-    states_tensor = states_vector
-    for order in range(num_orders-1):
-        states_tensor = _outer_product(batch_size, states_tensor, states_vector)
 
-    # print("tensor product", states_tensor.name, states_tensor.get_shape().as_list())
-    cores = []
-    for i in range(num_orders):
-        # Fetch the weights of factor A^i from our big serialized variable weights_h.
-        mat_core = tf.slice(mat, [mat_ps[i]], [mat_ps[i + 1] - mat_ps[i]])
-        mat_core = tf.reshape(mat_core, [mat_ranks[i], total_state_size, mat_ranks[i + 1]])   
-        cores.append(mat_core)
-        
-    out_h = tensor_train_contraction(states_tensor, cores)
+    out_h = tensor_train_states_contraction(states_vector, cores, contraction)
     # Compute h_t = U*x_t + W*H_{t-1}
     res = tf.add(out_x, out_h)
 
@@ -515,21 +683,27 @@ def tensor_network_tt_einsum(inputs, states, output_size, rank_vals, bias, bias_
 
     return nn_ops.bias_add(res,biases)
 
-def tensor_network_aug(inputs, states, output_size, rank_vals, bias, bias_start=0.0):
+def tensor_network_aug(inputs, states, output_size, rank_vals, bias, bias_start=0.0, contraction="outer", input_proj_size=None, tt_modes=None, tt_rank=None):
     """tensor network [inputs, states]-> output with tensor models"""
     # each coordinate of hidden state is independent- parallel
     num_orders = len(rank_vals)+1
     num_lags = len(states)
     batch_size = tf.shape(inputs)[0]
+    if input_proj_size is not None:
+        # learned projection of the inputs, so that the cores do not grow
+        # with the raw input size
+        with vs.variable_scope("input_proj"):
+            if tt_modes is not None and int(np.prod(tt_modes)) == inputs.get_shape()[1].value:
+                proj_modes = tt_matrix_modes(input_proj_size, len(tt_modes))
+                inputs = tt_matrix_linear(inputs, "weights", tt_modes, proj_modes, tt_rank, bias=True)
+            else:
+                inputs = _linear([inputs], input_proj_size, True)
     state_size = states[0].get_shape()[1].value #hidden layer size
     inp_size = inputs.get_shape()[1].value
     total_state_size = (inp_size +  state_size * num_lags + 1 )
 
-    mat_dims = np.ones((num_orders,)) * total_state_size
     mat_ranks = np.concatenate(([1], rank_vals, [output_size]))
-    mat_ps = np.cumsum(np.concatenate(([0], mat_ranks[:-1] * mat_dims * mat_ranks[1:])),dtype=np.int32)
-    mat_size = mat_ps[-1]
-    mat = vs.get_variable("weights", mat_size) # h_z x h_z... x output_size
+    cores = tt_cores("weights", mat_ranks, total_state_size) # h_z x h_z... x output_size
 
     states = (inputs,) + states  # concatenate the [x, h] 
     
@@ -537,102 +711,60 @@ def tensor_network_aug(inputs, states, output_size, rank_vals, bias, bias_start=
     #total_inputs = [inputs]
     states_vector = tf.concat(states, 1)
     states_vector = tf.concat( [states_vector, tf.ones([batch_size, 1])], 1)
-    """form high order state tensor"""
-    states_tensor = states_vector
-    for order in range(num_orders-1):
-        states_tensor = _outer_product(batch_size, states_tensor, states_vector)
-    
-    # states_tensor= tf.reshape(states_tensor, [-1,total_state_size**num_orders] )
 
-    cores = []
-    for i in range(num_orders):
-        # Fetch the weights of factor A^i from our big serialized variable weights_h.
-        mat_core = tf.slice(mat, [mat_ps[i]], [mat_ps[i + 1] - mat_ps[i]])
-        mat_core = tf.reshape(mat_core, [mat_ranks[i], total_state_size, mat_ranks[i + 1]])   
-        cores.append(mat_core)
-    
-    res = tensor_train_contraction(states_tensor, cores)
+    res = tensor_train_states_contraction(states_vector, cores, contraction)
     if not bias:
         return res
     biases = vs.get_variable("biases", [output_size])
     return nn_ops.bias_add(res,biases)
 
-def tensor_network_mtrnn(inputs, states, output_size, rank_vals, num_freq, bias, bias_start=0.0):
+def mtrnn_frequencies(num_freq):
+    """frequencies of the resolutions of a multi-resolution tensor rnn:
+    [1, num_freq] for an int, the list itself otherwise"""
+    if isinstance(num_freq, (list, tuple)):
+        return list(num_freq)
+    return [1, num_freq]
+
+def mtrnn_weights_name(k):
+    """tt weights of the k-th resolution: weights_h, weights_h2, weights_h3..."""
+    return "weights_h" if k == 0 else "weights_h%d" % (k + 1)
+
+def mtrnn_state_index(num_units, num_lags, freq):
+    """columns of states[::freq] and of the ones column in the states vector
+    [h_1, ..., h_L, 1]"""
+    lags = range(0, num_lags, freq)
+    return [lag * num_units + k for lag in lags for k in range(num_units)] + [num_units * num_lags]
+
+def tensor_network_mtrnn(inputs, states, output_size, rank_vals, num_freq, bias, bias_start=0.0, contraction="outer", tt_modes=None, tt_rank=None, out_x=None):
     "states to output mapping for multi-resolution tensor rnn"
-    """tensor train decomposition for the full tenosr """
-    num_orders = len(rank_vals)+1#alpha_1 to alpha_{K-1}
+    """one tensor train per resolution states[::freq], all sliced from the
+    same states vector """
     num_lags = len(states)
     batch_size = tf.shape(inputs)[0] 
     state_size = output_size #hidden layer size
     input_size= inputs.get_shape()[1].value
 
 
-    # input weights W_x 
-    weights_x = vs.get_variable("weights_x", [input_size, output_size] )
-    out_x = tf.matmul(inputs, weights_x)
-
+    # input weights W_x, unless precomputed by the driver
+    if out_x is None:
+        out_x = _input_weights(inputs, output_size, tt_modes, tt_rank)
 
-    # 1st tensor train layer W_h
-    total_state_size = (state_size * num_lags + 1 )
-    mat_dims = np.ones((num_orders,)) * total_state_size
+    # shared states vector [h_1, ..., h_L, 1]
+    states_vector = tf.concat(list(states) + [tf.ones([batch_size, 1])], 1)
     mat_ranks = np.concatenate(([1], rank_vals, [output_size]))
-    mat_ps = np.cumsum(np.concatenate(([0], mat_ranks[:-1] * mat_dims * mat_ranks[1:])),dtype=np.int32)
-    mat_size = mat_ps[-1]
-    mat = vs.get_variable("weights_h", mat_size) # h_z x h_z... x output_size
 
-    states_vector = tf.concat(states, 1)
-    states_vector = tf.concat([states_vector, tf.ones([batch_size, 1])],1)
-    """form high order state tensor"""
-    states_tensor = states_vector
-    for order in range(num_orders-1):
-        states_tensor = _outer_product(batch_size, states_tensor, states_vector)
-
-    cores = []
-    for i in range(num_orders):
-        # Fetch the weights of factor A^i from our big serialized variable weights_h.
-        mat_core = tf.slice(mat, [mat_ps[i]], [mat_ps[i + 1] - mat_ps[i]])
-        mat_core = tf.reshape(mat_core, [mat_ranks[i], total_state_size, mat_ranks[i + 1]])   
-        cores.append(mat_core)
-
-        print('-'*80)  
-        print('1st layer tensor train\n')
-        print('|states res|', 1, '|states len|', len(states), '|states size|', states_tensor.get_shape())
-        h_1 = tensor_train_contraction(states_tensor, cores)
-
-     # 2nd tensor train layer W_h2
-    total_state_size = (state_size * num_lags//num_freq + 1 )
-    mat_dims = np.ones((num_orders,)) * total_state_size
-    mat_ranks = np.concatenate(([1], rank_vals, [output_size]))
-    mat_ps = np.cumsum(np.concatenate(([0], mat_ranks[:-1] * mat_dims * mat_ranks[1:])),dtype=np.int32)
-    mat_size = mat_ps[-1]
-    mat = vs.get_variable("weights_h2", mat_size) # h_z x h_z... x output_size
-
-
-    new_states = states[::num_freq]
-    states_vector = tf.concat(new_states,1)
-    states_vector = tf.concat([states_vector, tf.ones([batch_size, 1])],1)
-    """form high order state tensor"""
-    states_tensor = states_vector
-    for order in range(num_orders-1):
-        states_tensor = _outer_product(batch_size, states_tensor, states_vector)
-
-    cores = []
-    for i in range(num_orders):
-        # Fetch the weights of factor A^i from our big serialized variable weights_h.
-        mat_core = tf.slice(mat, [mat_ps[i]], [mat_ps[i + 1] - mat_ps[i]])
-        mat_core = tf.reshape(mat_core, [mat_ranks[i], total_state_size, mat_ranks[i + 1]])   
-        cores.append(mat_core)
-    print('-'*80)  
-    print('2nd layer tensor train\n')
-    print('|states res|', num_freq, '|states len|', len(new_states), '|states size|', states_tensor.get_shape())
-    h_2 = tensor_train_contraction(states_tensor, cores)
-
-    # Combine two tensor train 
-    out_h = h_1 + h_2
-    # Compute h_t = W_x*x_t + W_h*H_{t-1}
-    res = tf.add(out_x, out_h)
+    # Compute h_t = W_x*x_t + sum_k W_hk*H_{t-1}[::freq_k]
+    res = out_x
+    for k, freq in enumerate(mtrnn_frequencies(num_freq)):
+        if freq == 1:
+            res_states = states_vector
+        else:
+            res_states = tf.gather(states_vector, mtrnn_state_index(state_size, num_lags, freq), axis=1)
+        total_state_size = res_states.get_shape()[1].value
+        cores = tt_cores(mtrnn_weights_name(k), mat_ranks, total_state_size) # h_z x h_z... x output_size
+        res = tf.add(res, tensor_train_states_contraction(res_states, cores, contraction))
 
     if not bias:
-        return
+        return res
     biases = vs.get_variable("biases", [output_size])
     return  nn_ops.bias_add(res,biases)
\ No newline at end of file
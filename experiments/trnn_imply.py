@@ -6,7 +6,6 @@ from tensorflow.python.ops import array_ops
 from tensorflow.python.ops import nn_ops
 from tensorflow.python.ops.math_ops import tanh
 from tensorflow.python.util import nest
-from tensorflow.contrib.distributions import Bernoulli
 from tensorflow.contrib.layers import fully_connected
 from tensorflow.python.ops.rnn_cell_impl import LSTMStateTuple
 
@@ -14,14 +13,21 @@ import numpy as np
 import copy
 from collections import deque
 
+from trnn import project_inputs, tt_matrix_linear, tt_matrix_modes
 
-def rnn_with_feed_prev(cell, inputs, is_training, config, initial_state=None):
+# TT-matrix modes of the direct multi-horizon head
+HEAD_NUM_MODES = 3
+
+def rnn_with_feed_prev(cell, inputs, is_training, config, initial_state=None, is_decoder=None,
+                       keep_prob=None):
     prev = None
     outputs = []
     sample_prob = config.sample_prob # scheduled sampling probability
 
     feed_prev = not is_training if config.use_error_prop else False
-    is_sample = is_training and initial_state is not None # decoder  
+    if is_decoder is None:
+        is_decoder = initial_state is not None
+    is_sample = is_training and is_decoder and config.use_sched_samp
 
     if is_sample:
         print("Creating model @ training  --> Using scheduled sampling.")
@@ -33,6 +39,10 @@ def rnn_with_feed_prev(cell, inputs, is_training, config, initial_state=None):
     else:
         print(' '*30+" --> Feeding ground truth into input.")
 
+    if config.use_while_loop:
+        return dynamic_rnn_with_feed_prev(cell, inputs, is_training, config, initial_state, is_decoder,
+                                          keep_prob)
+
     with tf.variable_scope("rnn") as varscope:
         if varscope.caching_device is None:
             varscope.set_caching_device(lambda op: op.device)
@@ -47,10 +57,8 @@ def rnn_with_feed_prev(cell, inputs, is_training, config, initial_state=None):
         # phased lstm input
         inp_t = tf.expand_dims(tf.range(1,batch_size+1), 1)
 
-        dist = Bernoulli(probs=config.sample_prob)
-        samples = dist.sample(sample_shape=num_steps)
-        # with tf.Session() as sess:
-        #     print('bernoulli',samples.eval())
+        truth_mask = _truth_mask(batch_size, num_steps, config.sample_prob) if is_sample else None
+        dropout_mask = _dropout_mask(batch_size, cell.output_size, config, is_training, keep_prob)
         if initial_state is None:
             initial_state = cell.zero_state(batch_size, dtype= tf.float32)
         state = initial_state
@@ -61,22 +69,21 @@ def rnn_with_feed_prev(cell, inputs, is_training, config, initial_state=None):
 
             inp = inputs[:, time_step, :]
             
+            # sampled and fed back inputs reuse the projected previous output
             if is_sample and time_step > 0: 
-                with tf.variable_scope(tf.get_variable_scope(), reuse=True):
-                    inp = tf.cond(tf.cast(samples[time_step], tf.bool),  lambda:tf.identity(inp) , \
-                       lambda:fully_connected(cell_output, input_size, activation_fn=tf.sigmoid))
-                    
+                inp = tf.where(truth_mask[:, time_step], inp, output)
                     
             if feed_prev and prev is not None and time_step >= burn_in_steps:
-                with tf.variable_scope(tf.get_variable_scope(), reuse=True):
-                    inp = fully_connected(prev, input_size,  activation_fn=tf.sigmoid)
-                    #print("t", time_step, ">=", burn_in_steps, "--> feeding back output into input.")
+                inp = _feedback(output, config.feedback_noise)
 
             if isinstance(cell._cells[0], tf.contrib.rnn.PhasedLSTMCell):
                 (cell_output, state) = cell((inp_t, inp), state)
             else:
                 (cell_output, state) = cell(inp, state)
 
+            if dropout_mask is not None:
+                cell_output = cell_output * dropout_mask
+
             prev = cell_output
             with tf.variable_scope(tf.get_variable_scope(), reuse=False):
                 output = fully_connected(cell_output, input_size, activation_fn=tf.sigmoid)
@@ -107,14 +114,44 @@ def _list_to_states(states_list):
         # new cell has s*num_lags states
     return output_states
 
-def tensor_rnn_with_feed_prev(cell, inputs, is_training, config, initial_states=None):
+def _output_projection(cell_output, input_size, config):
+    """fully_connected output layer, or a TT-matrix one when config.tt_modes
+    factorizes input_size"""
+    tt_modes = config.tt_modes
+    if tt_modes is None or int(np.prod(tt_modes)) != input_size:
+        return fully_connected(cell_output, input_size, activation_fn=tf.sigmoid)
+    hidden_modes = tt_matrix_modes(cell_output.get_shape()[1].value, len(tt_modes))
+    return tf.sigmoid(tt_matrix_linear(cell_output, "tt_output", hidden_modes, tt_modes, config.tt_rank, bias=True))
+
+def direct_horizon_outputs(states, num_steps, input_size, config):
+    """Direct multi-horizon decoder: the outputs [batch_size, num_steps,
+    input_size] of all the horizons at once from the final encoder states
+    (all lags and layers), through a TT-matrix head of config.tt_rank with
+    HEAD_NUM_MODES modes. The head predicts config.max_horizon steps (default
+    num_steps) and the first num_steps are returned, so a head trained on
+    max_horizon serves every shorter horizon."""
+    max_horizon = config.max_horizon or num_steps
+    if num_steps > max_horizon:
+        raise ValueError("%d steps, more than the max horizon %d." % (num_steps, max_horizon))
+    flat = tf.concat(nest.flatten(list(states)), 1)
+    inp_modes = tt_matrix_modes(flat.get_shape()[1].value, HEAD_NUM_MODES)
+    out_modes = tt_matrix_modes(max_horizon * input_size, HEAD_NUM_MODES)
+    with tf.variable_scope("trnn"):
+        outputs = tf.sigmoid(tt_matrix_linear(flat, "tt_head", inp_modes, out_modes, config.tt_rank, bias=True))
+    outputs = tf.reshape(outputs, [-1, max_horizon, input_size])
+    return outputs[:, :num_steps, :]
+
+def tensor_rnn_with_feed_prev(cell, inputs, is_training, config, initial_states=None, is_decoder=None,
+                              keep_prob=None):
     """High Order Recurrent Neural Network Layer
     """
     #tuple of 2-d tensor (batch_size, s)
     outputs = []
     prev = None
     feed_prev = not is_training if config.use_error_prop else False
-    is_sample = is_training and initial_states is not None
+    if is_decoder is None:
+        is_decoder = initial_states is not None
+    is_sample = is_training and is_decoder and config.use_sched_samp
 
     if is_sample:
         print("Creating model @ training  --> Using scheduled sampling.")
@@ -126,6 +163,13 @@ def tensor_rnn_with_feed_prev(cell, inputs, is_training, config, initial_states=
     else:
         print(' '*30+" --> Feeding ground truth into input.")
 
+    if is_training and config.recompute_segment:
+        return recompute_tensor_rnn_with_feed_prev(cell, inputs, is_training, config, initial_states, is_decoder,
+                                                   keep_prob)
+    if config.use_while_loop:
+        return dynamic_tensor_rnn_with_feed_prev(cell, inputs, is_training, config, initial_states, is_decoder,
+                                                 keep_prob)
+
     with tf.variable_scope("trnn") as varscope:
         if varscope.caching_device is None:
                     varscope.set_caching_device(lambda op: op.device)
@@ -138,8 +182,20 @@ def tensor_rnn_with_feed_prev(cell, inputs, is_training, config, initial_states=
         burn_in_steps =  config.burn_in_steps
         
         # Scheduled sampling
-        dist = Bernoulli(probs=config.sample_prob)
-        samples = dist.sample(sample_shape=num_steps)
+        truth_mask = _truth_mask(batch_size, num_steps, config.sample_prob) if is_sample else None
+        dropout_mask = _dropout_mask(batch_size, cell.output_size, config, is_training, keep_prob)
+
+        # the first num_truth steps always take the ground truth, the input
+        # projection of steps 1..num_truth-1 is computed at once after the
+        # first step has created the variables
+        num_truth = int(num_steps)
+        if is_sample:
+            num_truth = 1
+        if feed_prev:
+            num_truth = min(num_truth, max(burn_in_steps, 1))
+        hoist = (config.hoist_inputs and num_truth > 1 and
+                 getattr(cell._cells[0], "takes_input_projection", False))
+        block_proj = None
         
         if initial_states is None:
             initial_states =[]
@@ -155,34 +211,308 @@ def tensor_rnn_with_feed_prev(cell, inputs, is_training, config, initial_states=
 
             inp = inputs[:, time_step, :]
 
+            # sampled and fed back inputs reuse the projected previous output
             if is_sample and time_step > 0: 
-                with tf.variable_scope(tf.get_variable_scope(), reuse=True):
-                    inp = tf.cond(tf.cast(samples[time_step], tf.bool),  lambda:tf.identity(inp) , \
-                       lambda:fully_connected(cell_output, input_size, activation_fn=tf.sigmoid))
+                inp = tf.where(truth_mask[:, time_step], inp, output)
                     
             if feed_prev and prev is not None and time_step >= burn_in_steps:
-                with tf.variable_scope(tf.get_variable_scope(), reuse=True):
-                    inp = fully_connected(cell_output, input_size, activation_fn=tf.sigmoid)
-                    #print("t", time_step, ">=", burn_in_steps, "--> feeding back output into input.")
+                inp = _feedback(output, config.feedback_noise)
 
             states = _list_to_states(states_list)
             """input tensor is [batch_size, num_steps, input_size]"""
+            if hoist and time_step == 0:
+                # marks the first layer, which records its input scope
+                inp = (inp,)
+            elif block_proj is not None and time_step < num_truth:
+                # the first layer takes (x, U * x), see trnn.project_inputs
+                inp = (inp, block_proj[:, time_step - 1])
             (cell_output, state)=cell(inp, states)
+            if hoist and time_step == 0:
+                block_proj = project_inputs(cell._cells[0], inputs[:, 1:num_truth, :])
 
-            # dropout 
-            # keep_prob = tf.placeholder(tf.float32)
-            keep_prob = 0.5
-            cell_output = tf.nn.dropout(cell_output, keep_prob)
+            # dropout, same mask at every step
+            if dropout_mask is not None:
+                cell_output = cell_output * dropout_mask
 
             states_list = _shift(states_list, state)
 
             prev = cell_output
             with tf.variable_scope(tf.get_variable_scope(), reuse=False):
-                output = fully_connected(cell_output, input_size, activation_fn=tf.sigmoid)
+                output = _output_projection(cell_output, input_size, config)
                 outputs.append(output)
 
     outputs = tf.stack(outputs,1)
     return outputs, states_list
 
+def _truth_mask(batch_size, num_steps, sample_prob):
+    """Scheduled sampling mask [batch_size, num_steps] drawn once per sequence,
+    True (with probability sample_prob) where the ground truth is fed"""
+    return tf.random_uniform(tf.stack([batch_size, int(num_steps)])) < sample_prob
+
+def _dropout_mask(batch_size, size, config, is_training, keep_prob=None):
+    """Dropout mask [batch_size, size] of the cell outputs, drawn once per
+    sequence and applied at every step. keep_prob defaults to config.keep_prob
+    when training and to 1.0 otherwise. None (no dropout ops) when keep_prob
+    is 1.0."""
+    if keep_prob is None:
+        keep_prob = config.keep_prob if is_training else 1.0
+    if keep_prob >= 1.0:
+        return None
+    return tf.floor(keep_prob + tf.random_uniform(tf.stack([batch_size, size]))) / keep_prob
+
+def _feedback(output, noise):
+    """Output fed back as the next input, with gaussian noise of stddev noise
+    (sampled forecasts)"""
+    if not noise:
+        return output
+    return output + tf.random_normal(tf.shape(output), stddev=noise)
+
+def _feed_input(inp, prev_out, time_step, truth_mask, is_sample, feed_prev, burn_in_steps, noise=0.0):
+    """Input of a while loop step: the ground truth inp, or the previous
+    output prev_out when it is sampled or fed back (as in the unrolled loops)"""
+    if is_sample:
+        use_truth = tf.logical_or(tf.equal(time_step, 0), truth_mask[:, time_step])
+        inp = tf.where(use_truth, inp, prev_out)
+    if feed_prev:
+        use_prev = tf.logical_and(time_step > 0, time_step >= burn_in_steps)
+        inp = tf.where(use_prev, _feedback(prev_out, noise), inp)
+    return inp
+
+def dynamic_rnn_with_feed_prev(cell, inputs, is_training, config, initial_state=None, is_decoder=None,
+                               keep_prob=None):
+    """rnn_with_feed_prev with a tf.while_loop over time, the graph size does
+    not depend on num_steps. Same variables and outputs as the unrolled loop."""
+    feed_prev = not is_training if config.use_error_prop else False
+    if is_decoder is None:
+        is_decoder = initial_state is not None
+    is_sample = is_training and is_decoder and config.use_sched_samp
 
+    with tf.variable_scope("rnn") as varscope:
+        if varscope.caching_device is None:
+            varscope.set_caching_device(lambda op: op.device)
+
+        inputs_shape = inputs.get_shape().with_rank_at_least(3)
+        batch_size = tf.shape(inputs)[0]
+        num_steps = inputs_shape[1].value
+        input_size = int(inputs_shape[2])
+        burn_in_steps = config.burn_in_steps
+
+        # phased lstm input
+        inp_t = tf.expand_dims(tf.range(1,batch_size+1), 1)
+
+        truth_mask = _truth_mask(batch_size, num_steps, config.sample_prob) if is_sample else None
+        dropout_mask = _dropout_mask(batch_size, cell.output_size, config, is_training, keep_prob)
+        if initial_state is None:
+            initial_state = cell.zero_state(batch_size, dtype= tf.float32)
+
+        inputs_ta = tf.TensorArray(tf.float32, size=num_steps).unstack(tf.transpose(inputs, [1, 0, 2]))
+        outputs_ta = tf.TensorArray(tf.float32, size=num_steps)
+        # projected output of the previous step, fed back or sampled as input
+        prev_out = tf.zeros([batch_size, input_size])
+
+        def _step(time_step, state_leaves, prev_out, outputs_ta):
+            state = nest.pack_sequence_as(initial_state, state_leaves)
+            inp = _feed_input(inputs_ta.read(time_step), prev_out, time_step, truth_mask,
+                              is_sample, feed_prev, burn_in_steps, config.feedback_noise)
+            if isinstance(cell._cells[0], tf.contrib.rnn.PhasedLSTMCell):
+                (cell_output, state) = cell((inp_t, inp), state)
+            else:
+                (cell_output, state) = cell(inp, state)
+            if dropout_mask is not None:
+                cell_output = cell_output * dropout_mask
+            output = fully_connected(cell_output, input_size, activation_fn=tf.sigmoid)
+            return time_step + 1, nest.flatten(state), output, outputs_ta.write(time_step, output)
+
+        _, state_leaves, _, outputs_ta = tf.while_loop(
+            lambda time_step, *_: time_step < num_steps, _step,
+            (tf.constant(0), nest.flatten(initial_state), prev_out, outputs_ta))
+        state = nest.pack_sequence_as(initial_state, state_leaves)
+
+    outputs = tf.transpose(outputs_ta.stack(), [1, 0, 2])
+    outputs.set_shape([None, num_steps, input_size])
+    return outputs, state
+
+def dynamic_tensor_rnn_with_feed_prev(cell, inputs, is_training, config, initial_states=None, is_decoder=None,
+                                      keep_prob=None):
+    """tensor_rnn_with_feed_prev with a tf.while_loop over time, the graph size
+    does not depend on num_steps. Same variables and outputs as the unrolled loop.
+
+    The last num_lags states live in a ring buffer [num_lags, batch_size, size]
+    per state tensor: at step t slot (t + k) % num_lags holds lag k (oldest
+    first), and the new state overwrites the oldest slot t % num_lags.
+    """
+    feed_prev = not is_training if config.use_error_prop else False
+    if is_decoder is None:
+        is_decoder = initial_states is not None
+    is_sample = is_training and is_decoder and config.use_sched_samp
+    num_lags = config.num_lags
+
+    with tf.variable_scope("trnn") as varscope:
+        if varscope.caching_device is None:
+                    varscope.set_caching_device(lambda op: op.device)
 
+        inputs_shape = inputs.get_shape().with_rank_at_least(3)
+        batch_size = tf.shape(inputs)[0]
+        num_steps = inputs_shape[1].value
+        input_size = int(inputs_shape[2])
+        burn_in_steps =  config.burn_in_steps
+
+        # Scheduled sampling
+        truth_mask = _truth_mask(batch_size, num_steps, config.sample_prob) if is_sample else None
+        dropout_mask = _dropout_mask(batch_size, cell.output_size, config, is_training, keep_prob)
+
+        if initial_states is None:
+            initial_states =[]
+            for lag in range(num_lags):
+                initial_state =  cell.zero_state(batch_size, dtype= tf.float32)
+                initial_states.append(initial_state)
+        initial_states = list(initial_states)
+        # state structure of one lag: a tuple of the states of every layer
+        structure = initial_states[0]
+        lags_leaves = [nest.flatten(states) for states in initial_states]
+        ring = [tf.stack(leaves) for leaves in zip(*lags_leaves)]
+
+        inputs_ta = tf.TensorArray(tf.float32, size=num_steps).unstack(tf.transpose(inputs, [1, 0, 2]))
+        outputs_ta = tf.TensorArray(tf.float32, size=num_steps)
+        prev_out = tf.zeros([batch_size, input_size])
+
+        def _read_lags(ring, order):
+            """ring buffers -> list of num_lags states, oldest first"""
+            lags = zip(*[tf.unstack(tf.gather(buf, order), num_lags) for buf in ring])
+            return [nest.pack_sequence_as(structure, list(leaves)) for leaves in lags]
+
+        def _step(time_step, ring, prev_out, outputs_ta):
+            inp = _feed_input(inputs_ta.read(time_step), prev_out, time_step, truth_mask,
+                              is_sample, feed_prev, burn_in_steps, config.feedback_noise)
+            order = tf.mod(time_step + tf.range(num_lags), num_lags)
+            states = _list_to_states(_read_lags(ring, order))
+            (cell_output, state)=cell(inp, states)
+
+            # dropout, same mask at every step
+            if dropout_mask is not None:
+                cell_output = cell_output * dropout_mask
+
+            # overwrite the oldest lag with the new state
+            oldest = tf.equal(tf.range(num_lags), tf.mod(time_step, num_lags))
+            ring = [tf.where(oldest, tf.tile(tf.expand_dims(leaf, 0), [num_lags, 1, 1]), buf)
+                    for leaf, buf in zip(nest.flatten(state), ring)]
+
+            output = _output_projection(cell_output, input_size, config)
+            return time_step + 1, ring, output, outputs_ta.write(time_step, output)
+
+        _, ring, _, outputs_ta = tf.while_loop(
+            lambda time_step, *_: time_step < num_steps, _step,
+            (tf.constant(0), ring, prev_out, outputs_ta))
+        states_list = _read_lags(ring, [(num_steps + k) % num_lags for k in range(num_lags)])
+
+    outputs = tf.transpose(outputs_ta.stack(), [1, 0, 2])
+    outputs.set_shape([None, num_steps, input_size])
+    return outputs, states_list
+
+def recompute_tensor_rnn_with_feed_prev(cell, inputs, is_training, config, initial_states=None, is_decoder=None,
+                                        keep_prob=None):
+    """tensor_rnn_with_feed_prev for training with gradient checkpointing:
+    every config.recompute_segment steps form one
+    tf.contrib.layers.recompute_grad block. Only the lag states at the segment
+    boundaries are kept for backprop, the in-cell contractions of a segment
+    are recomputed on the backward pass. Shorter segments use less memory and
+    recompute more. Same variables and outputs as the unrolled loop.
+
+    The cell variables are resource variables, as recompute_grad requires.
+    """
+    if is_decoder is None:
+        is_decoder = initial_states is not None
+    is_sample = is_training and is_decoder and config.use_sched_samp
+    num_lags = config.num_lags
+
+    with tf.variable_scope("trnn", use_resource=True) as varscope:
+        if varscope.caching_device is None:
+                    varscope.set_caching_device(lambda op: op.device)
+
+        inputs_shape = inputs.get_shape().with_rank_at_least(3)
+        batch_size = tf.shape(inputs)[0]
+        num_steps = inputs_shape[1].value
+        input_size = int(inputs_shape[2])
+
+        # the random masks are drawn once outside of the segments, so that the
+        # recomputation sees the same ones. The first step takes the ground truth.
+        if is_sample:
+            truth_mask = tf.logical_or(_truth_mask(batch_size, num_steps, config.sample_prob),
+                                       tf.equal(tf.range(num_steps), 0))
+            truth_mask = tf.to_float(truth_mask)
+        else:
+            # unused by the segments, no random draw
+            truth_mask = tf.ones(tf.stack([batch_size, num_steps]))
+        dropout_mask = _dropout_mask(batch_size, cell.output_size, config, is_training, keep_prob)
+        masks = [] if dropout_mask is None else [dropout_mask]
+
+        if initial_states is None:
+            initial_states =[]
+            for lag in range(num_lags):
+                initial_state =  cell.zero_state(batch_size, dtype= tf.float32)
+                initial_states.append(initial_state)
+        structure = initial_states[0]
+        num_leaves = len(nest.flatten(structure))
+
+        def _segment(inps, truth, prev_out, *args):
+            """steps of inps [batch_size, segment, input_size] from the flat
+            lag states args (after the dropout mask, if any)"""
+            dropout = args[0] if masks else None
+            leaves = args[len(masks):]
+            states_list = [nest.pack_sequence_as(structure, list(leaves[k * num_leaves:(k + 1) * num_leaves]))
+                           for k in range(num_lags)]
+            outputs = []
+            for k in range(inps.get_shape()[1].value):
+                inp = inps[:, k, :]
+                if is_sample:
+                    inp = tf.where(truth[:, k] > 0.5, inp, prev_out)
+                (cell_output, state) = cell(inp, _list_to_states(states_list))
+                if dropout is not None:
+                    cell_output = cell_output * dropout
+                states_list = list(_shift(states_list, state))
+                prev_out = _output_projection(cell_output, input_size, config)
+                outputs.append(prev_out)
+                # variables are created by the first step only
+                tf.get_variable_scope().reuse_variables()
+            return [tf.stack(outputs, 1), prev_out] + nest.flatten(states_list)
+
+        segment_fn = tf.contrib.layers.recompute_grad(_segment)
+        outputs = []
+        prev_out = tf.zeros([batch_size, input_size])
+        leaves = nest.flatten(list(initial_states))
+        for start in range(0, num_steps, config.recompute_segment):
+            end = min(start + config.recompute_segment, num_steps)
+            results = segment_fn(inputs[:, start:end, :], truth_mask[:, start:end], prev_out, *(masks + leaves))
+            outputs.append(results[0])
+            prev_out = results[1]
+            leaves = list(results[2:])
+        states_list = [nest.pack_sequence_as(structure, leaves[k * num_leaves:(k + 1) * num_leaves])
+                       for k in range(num_lags)]
+
+    outputs = tf.concat(outputs, 1)
+    outputs.set_shape([None, num_steps, input_size])
+    return outputs, states_list
+
+# reset ops of the carried states, run them before a batch of new series
+CARRIED_STATE_RESETS = "carried_state_resets"
+
+def rnn_with_carried_state(rnn_fn, cell, inputs, is_training, config):
+    """Truncated BPTT: run rnn_fn (rnn_with_feed_prev or
+    tensor_rnn_with_feed_prev) from states held in local variables and
+    store its final states back in them, so that the next sess.run continues
+    the series where this one stopped. No gradient flows into the carried
+    states. The variables need a static batch size, config.batch_size."""
+    if rnn_fn is tensor_rnn_with_feed_prev:
+        structure = [cell.state_size] * config.num_lags # states_list
+    else:
+        structure = cell.state_size
+    carried = [tf.Variable(tf.zeros([config.batch_size, size]), trainable=False,
+                           collections=[tf.GraphKeys.LOCAL_VARIABLES], name="carried_state")
+               for size in nest.flatten(structure)]
+    initial_states = nest.pack_sequence_as(structure, [tf.identity(var) for var in carried])
+    outputs, states = rnn_fn(cell, inputs, is_training, config, initial_states, is_decoder=False)
+    new_states = nest.flatten(list(states) if rnn_fn is tensor_rnn_with_feed_prev else states)
+    with tf.control_dependencies([tf.assign(var, new) for var, new in zip(carried, new_states)]):
+        outputs = tf.identity(outputs)
+    tf.add_to_collection(CARRIED_STATE_RESETS, tf.variables_initializer(carried))
+    return outputs, states
@@ -0,0 +1,467 @@
+"""NumPy forward pass of trained tensor RNN seq2seq models for CPU serving.
+
+Only NumPy is imported at module level. Checkpoints are converted once with
+export_weights (which needs TensorFlow) into a .npz file that the forecaster
+loads without TensorFlow:
+
+    python trnn_numpy.py export ./log/tlstm/ tlstm.npz
+    python trnn_numpy.py bench tlstm.npz --model=TLSTM --hidden_size=8 --rank=2
+
+The weights can be stored as int8 or float16 (quantize_weights, see
+trnn_quant.py for calibration). A forecaster keeps its weights quantized in
+memory and dequantizes them into float32 cells on first use; unload()
+drops the float32 copy again, so that hundreds of per-sensor models stay
+resident at the quantized size and only the active ones take float32
+memory. The int8 matrices and tt cores carry one float32 scale per column,
+so a [rows, columns] matrix takes rows + 4 bytes per column instead of
+4 * rows, e.g. 3.2x less for the 17 row matrices of hidden_size=8 and two
+lags; large matrices approach 4x. Optimizer slots of the checkpoint are
+not kept (model_weights).
+
+Dropout is not applied: the NumPy forward pass is the expectation of the
+dropped out TensorFlow graph.
+"""
+
+from __future__ import print_function
+
+import argparse
+import time
+
+import numpy as np
+
+# variable scopes of the seq2seq models in model_seq2seq.py. The decoder calls
+# the same MultiRNNCell as the encoder, so both share the encoder's cell
+# variables; the output projection belongs to the decoder.
+CELL_SCOPE = "Model/Encoder/trnn/multi_rnn_cell"
+OUTPUT_SCOPE = "Model/Decoder/trnn/fully_connected"
+
+
+def export_weights(checkpoint_path, output_path):
+    """Dump every variable of a TensorFlow checkpoint into a .npz file"""
+    import tensorflow as tf
+    if tf.gfile.IsDirectory(checkpoint_path):
+        checkpoint_path = tf.train.latest_checkpoint(checkpoint_path)
+    reader = tf.train.NewCheckpointReader(checkpoint_path)
+    weights = {name: reader.get_tensor(name)
+               for name in reader.get_variable_to_shape_map()}
+    np.savez(output_path, **weights)
+    return weights
+
+
+def load_weights(path):
+    """Load the variables written by export_weights or save_weights"""
+    with np.load(path) as f:
+        weights = {name: f[name] for name in f.files if not name.endswith(":scale")}
+        for name, values in weights.items():
+            if values.dtype == np.int8:
+                weights[name] = QuantizedArray(values, f[name + ":scale"])
+            elif values.dtype == np.float16:
+                weights[name] = QuantizedArray(values)
+    return weights
+
+
+def save_weights(path, weights):
+    """Save float and quantized weights into a .npz file"""
+    arrays = {}
+    for name, value in weights.items():
+        if isinstance(value, QuantizedArray):
+            arrays[name] = value.values
+            if value.scale is not None:
+                arrays[name + ":scale"] = value.scale
+        else:
+            arrays[name] = value
+    np.savez(path, **arrays)
+
+
+class QuantizedArray(object):
+    """int8 values with one float32 scale per index of the last axis
+    (per column of a matrix, per r_{i+1} rank slice of a tt core) or one
+    scale for a vector, or float16 values without scale"""
+    def __init__(self, values, scale=None):
+        self.values = values
+        self.scale = scale
+
+    @property
+    def shape(self):
+        return self.values.shape
+
+    @property
+    def nbytes(self):
+        return self.values.nbytes + (0 if self.scale is None else self.scale.nbytes)
+
+    def dequantize(self):
+        values = self.values.astype(np.float32)
+        if self.scale is not None:
+            values *= self.scale
+        return values
+
+
+def quantize(array, dtype="int8", clip=1.0):
+    """Symmetric quantization of array. For int8 the scale of every index
+    of the last axis (of the whole array for a vector) maps clip * max |value|
+    to 127; a clip below one saturates the largest values for a finer step
+    on the others."""
+    if dtype == "float16":
+        return QuantizedArray(array.astype(np.float16))
+    if dtype != "int8":
+        raise ValueError("Unknown quantization dtype %s." % dtype)
+    if array.ndim == 1:
+        amax = clip * np.abs(array).max(keepdims=True)
+    else:
+        amax = clip * np.abs(array.reshape(-1, array.shape[-1])).max(axis=0)
+    scale = np.where(amax > 0, amax / 127.0, 1.0).astype(np.float32)
+    values = np.clip(np.round(array / scale), -127, 127).astype(np.int8)
+    return QuantizedArray(values, scale)
+
+
+def quantize_weights(weights, dtype="int8", clip=1.0):
+    """Quantize every float32 matrix, tt core and bias of weights.
+    clip: one clip ratio for all arrays, or a {name: clip} dict"""
+    quantized = {}
+    for name, value in weights.items():
+        if isinstance(value, np.ndarray) and value.ndim >= 1 and value.dtype == np.float32:
+            ratio = clip.get(name, 1.0) if isinstance(clip, dict) else clip
+            quantized[name] = quantize(value, dtype, ratio)
+        else:
+            quantized[name] = value
+    return quantized
+
+
+def dequantize_weights(weights):
+    """float32 copy of every quantized array of weights"""
+    return {name: value.dequantize() if isinstance(value, QuantizedArray) else value
+            for name, value in weights.items()}
+
+
+def weights_nbytes(weights):
+    return sum(value.nbytes for value in weights.values())
+
+
+def model_weights(weights, scopes=(CELL_SCOPE, OUTPUT_SCOPE)):
+    """The variables of weights under scopes, without the optimizer slots
+    (capitalized suffixes such as weights_x/RMSProp) and other checkpoint
+    variables"""
+    return {name: value for name, value in weights.items()
+            if name.startswith(tuple(scope + "/" for scope in scopes))
+            and not name.rpartition("/")[2][:1].isupper()}
+
+
+def _sigmoid(x):
+    return 0.5 * (np.tanh(0.5 * x) + 1.0)
+
+
+def _tt_cores(weights, name, mat_ranks, state_size):
+    """Cores of the tt weights under name, stored as [D, r_i * r_{i+1}]
+    matrices so that each core is a single matmul against the states.
+    Reads both the per-core variables name/core_i and a flat name vector."""
+    shapes = [(r_in, state_size, r_out) for r_in, r_out in zip(mat_ranks[:-1], mat_ranks[1:])]
+    if name in weights:
+        mat = weights[name]
+        sizes = [int(np.prod(shape)) for shape in shapes]
+        assert sum(sizes) == mat.size, "%s does not match the tt ranks %s" % (name, mat_ranks)
+        flat = np.split(mat, np.cumsum(sizes)[:-1])
+        cores = [core.reshape(shape) for core, shape in zip(flat, shapes)]
+    else:
+        cores = [weights["%s/core_%d" % (name, i)] for i in range(len(shapes))]
+    core_mats = []
+    for core in cores:
+        r_in, _, r_out = core.shape
+        core_mat = np.ascontiguousarray(core.transpose(1, 0, 2).reshape(state_size, r_in * r_out))
+        core_mats.append((core_mat, r_in, r_out))
+    return core_mats
+
+
+def tt_contract(states_vector, cores):
+    """W * (states_vector x ... x states_vector), one core at a time"""
+    out = None
+    for core_mat, r_in, r_out in cores:
+        core_vec = np.dot(states_vector, core_mat).reshape(-1, r_in, r_out)
+        if out is None:
+            out = core_vec[:, 0]
+        else:
+            out = np.matmul(out[:, None, :], core_vec)[:, 0]
+    return out
+
+
+def _flatten(value):
+    """The arrays in value, a (nested) list or tuple of arrays"""
+    if isinstance(value, np.ndarray):
+        yield value
+    elif isinstance(value, (list, tuple)):
+        for item in value:
+            for array in _flatten(item):
+                yield array
+
+
+def _base(array):
+    """The array that owns the memory of array"""
+    while array.base is not None and isinstance(array.base, np.ndarray):
+        array = array.base
+    return array
+
+
+class _NumpyCell(object):
+    """Weights of one layer. step() maps the input and the lag buffer
+    [batch_size, num_lags * num_units + 1] (last column is ones) to the
+    pre-activation of the cell"""
+    is_lstm = False
+
+    def __init__(self, weights, scope, num_units, num_lags, rank_vals=None, num_freq=None):
+        self._num_units = num_units
+        self._num_lags = num_lags
+        self._state_size = num_units * num_lags + 1
+
+    def _out_size(self):
+        return 4 * self._num_units if self.is_lstm else self._num_units
+
+    def arrays(self):
+        """Every weight array the cell holds"""
+        for value in self.__dict__.values():
+            for array in _flatten(value):
+                yield array
+
+
+class _TensorTrain(_NumpyCell):
+    """tensor_network_tt_einsum"""
+    def __init__(self, weights, scope, num_units, num_lags, rank_vals=None, num_freq=None):
+        super(_TensorTrain, self).__init__(weights, scope, num_units, num_lags)
+        mat_ranks = [1] + list(rank_vals) + [self._out_size()]
+        self._weights_x = weights[scope + "/weights_x"]
+        self._biases = weights[scope + "/biases"]
+        self._cores = _tt_cores(weights, scope + "/weights_h", mat_ranks, self._state_size)
+
+    def step(self, inputs, states_vector):
+        res = np.dot(inputs, self._weights_x)
+        res += tt_contract(states_vector, self._cores)
+        res += self._biases
+        return res
+
+
+class _MultiResolution(_NumpyCell):
+    """tensor_network_mtrnn"""
+    def __init__(self, weights, scope, num_units, num_lags, rank_vals=None, num_freq=None):
+        super(_MultiResolution, self).__init__(weights, scope, num_units, num_lags)
+        freqs = num_freq if isinstance(num_freq, (list, tuple)) else [1, num_freq]
+        mat_ranks = [1] + list(rank_vals) + [self._out_size()]
+        self._weights_x = weights[scope + "/weights_x"]
+        self._biases = weights[scope + "/biases"]
+        # columns of states[::freq] (and the ones column) in the lag buffer,
+        # None for every lag (mtrnn_state_index, mtrnn_weights_name)
+        self._resolutions = []
+        for k, freq in enumerate(freqs):
+            if freq == 1:
+                index, state_size = None, self._state_size
+            else:
+                index = np.array([lag * num_units + j for lag in range(0, num_lags, freq)
+                                  for j in range(num_units)] + [self._state_size - 1])
+                state_size = len(index)
+            name = "weights_h" if k == 0 else "weights_h%d" % (k + 1)
+            cores = _tt_cores(weights, "%s/%s" % (scope, name), mat_ranks, state_size)
+            self._resolutions.append((index, cores))
+
+    def step(self, inputs, states_vector):
+        res = np.dot(inputs, self._weights_x)
+        for index, cores in self._resolutions:
+            if index is None:
+                res += tt_contract(states_vector, cores)
+            else:
+                res += tt_contract(np.take(states_vector, index, axis=1), cores)
+        res += self._biases
+        return res
+
+
+class _TensorTrainLSTM(_TensorTrain):
+    """TensorLSTMCell"""
+    is_lstm = True
+
+
+class _MatrixLSTM(_NumpyCell):
+    """MatrixLSTMCell, _linear over [inputs, h_1, ..., h_L]"""
+    is_lstm = True
+
+    def __init__(self, weights, scope, num_units, num_lags, rank_vals=None, num_freq=None):
+        super(_MatrixLSTM, self).__init__(weights, scope, num_units, num_lags)
+        mat = weights[scope + "/weights"]
+        input_size = mat.shape[0] - num_units * num_lags
+        self._weights_x = mat[:input_size]
+        self._weights_h = mat[input_size:]
+        self._biases = weights[scope + "/biases"]
+
+    def step(self, inputs, states_vector):
+        res = np.dot(inputs, self._weights_x)
+        res += np.dot(states_vector[:, :-1], self._weights_h)
+        res += self._biases
+        return res
+
+
+CELLS = {
+    "TRNN": _TensorTrain,
+    "MTRNN": _MultiResolution,
+    "TLSTM": _TensorTrainLSTM,
+    "MLSTM": _MatrixLSTM,
+}
+
+
+class TensorRNNForecaster(object):
+    """Seq2seq forecasts of a trained TRNN/MTRNN/TLSTM/MLSTM in NumPy.
+
+    The lags of every layer live in one preallocated buffer
+    [batch_size, num_lags * hidden_size + 1] that is shifted in place.
+    The weights stay as given (quantized or not), the float32 cells are
+    built on the first step and dropped by unload.
+    """
+    def __init__(self, weights, model, hidden_size, num_lags, rank_vals,
+                 num_layers=2, num_freq=2, forget_bias=1.0,
+                 cell_scope=CELL_SCOPE, output_scope=OUTPUT_SCOPE):
+        if isinstance(weights, str):
+            weights = load_weights(weights)
+        self._weights = model_weights(weights, (cell_scope, output_scope))
+        self._cell_class = CELLS[model]
+        self._cell_args = (hidden_size, num_lags, rank_vals, num_freq)
+        self._cell_scope = cell_scope
+        self._output_scope = output_scope
+        self._cells = None
+        self._is_lstm = self._cell_class.is_lstm
+        self._num_units = hidden_size
+        self._num_lags = num_lags
+        self._num_layers = num_layers
+        self._forget_bias = forget_bias
+        self._batch_size = None
+        self.reset(1)
+
+    @property
+    def input_size(self):
+        return self._weights[self._output_scope + "/weights"].shape[1]
+
+    @property
+    def nbytes(self):
+        """Resident weights: the stored arrays, plus the float32 arrays of
+        the cells when loaded (those not shared with the stored ones)"""
+        stored = set(id(_base(value)) for value in self._weights.values()
+                     if isinstance(value, np.ndarray))
+        nbytes = weights_nbytes(self._weights)
+        if self._cells is not None:
+            arrays = [self._weights_out, self._biases_out]
+            for cell in self._cells:
+                arrays.extend(cell.arrays())
+            bases = dict((id(_base(a)), _base(a)) for a in arrays)
+            nbytes += sum(a.nbytes for key, a in bases.items() if key not in stored)
+        return nbytes
+
+    def load(self):
+        """Dequantize the weights into float32 cells, done by the first step"""
+        if self._cells is not None:
+            return
+        weights = dequantize_weights(self._weights)
+        self._cells = [self._cell_class(weights, "%s/cell_%d" % (self._cell_scope, layer), *self._cell_args)
+                       for layer in range(self._num_layers)]
+        self._weights_out = weights[self._output_scope + "/weights"]
+        self._biases_out = weights[self._output_scope + "/biases"]
+
+    def unload(self):
+        """Drop the float32 cells, the quantized weights stay"""
+        self._cells = self._weights_out = self._biases_out = None
+
+    def reset(self, batch_size):
+        """Zero states for batch_size series"""
+        if batch_size != self._batch_size:
+            self._batch_size = batch_size
+            self._lags = np.zeros((self._num_layers, batch_size,
+                                   self._num_units * self._num_lags + 1), dtype=np.float32)
+            self._c = np.zeros((self._num_layers, batch_size, self._num_units), dtype=np.float32)
+        self._lags[:] = 0.0
+        self._lags[:, :, -1] = 1.0
+        self._c[:] = 0.0
+
+    def step(self, inputs):
+        """Advance every layer by one time step, returns the top hidden state"""
+        self.load()
+        num_units = self._num_units
+        h = inputs
+        for layer, cell in enumerate(self._cells):
+            lags = self._lags[layer]
+            res = cell.step(h, lags)
+            if self._is_lstm:
+                i, j, f, o = np.split(res, 4, axis=1)
+                c = self._c[layer]
+                c *= _sigmoid(f + self._forget_bias)
+                c += _sigmoid(i) * np.tanh(j)
+                h = np.tanh(c) * _sigmoid(o)
+            else:
+                h = np.tanh(res)
+            # drop the oldest lag, append h as the newest one
+            lags[:, :-num_units - 1] = lags[:, num_units:-1]
+            lags[:, -num_units - 1:-1] = h
+        return h
+
+    def project(self, h):
+        """Output projection (fully_connected with sigmoid activation)"""
+        self.load()
+        return _sigmoid(np.dot(h, self._weights_out) + self._biases_out)
+
+    def forecast(self, enc_inps, num_steps):
+        """Encode enc_inps [batch_size, burn_in_steps, input_size] and feed
+        the decoder outputs back for num_steps steps"""
+        enc_inps = np.asarray(enc_inps, dtype=np.float32)
+        batch_size = enc_inps.shape[0]
+        self.reset(batch_size)
+        for t in range(enc_inps.shape[1]):
+            self.step(enc_inps[:, t])
+        outputs = np.empty((batch_size, num_steps, self.input_size), dtype=np.float32)
+        # decoder starts from the start of sequence symbol SOS = 0
+        inp = np.zeros((batch_size, self.input_size), dtype=np.float32)
+        for t in range(num_steps):
+            inp = outputs[:, t] = self.project(self.step(inp))
+        return outputs
+
+
+def num_freq_arg(freqs):
+    """--num_freq f is the int MTRNN frequency, --num_freq 1 f g a list"""
+    return freqs[0] if len(freqs) == 1 else freqs
+
+
+def _bench(args):
+    start = time.time()
+    forecaster = TensorRNNForecaster(args.weights, args.model, args.hidden_size,
+                                     args.num_lags, [args.rank], args.num_layers,
+                                     num_freq_arg(args.num_freq))
+    idle_bytes = forecaster.nbytes
+    forecaster.load()
+    print("load time: %.1f ms" % (1e3 * (time.time() - start)))
+    print("resident weights: %d bytes idle, %d bytes loaded" % (idle_bytes, forecaster.nbytes))
+    inp = np.zeros((1, forecaster.input_size), dtype=np.float32)
+    for _ in range(10):
+        forecaster.step(inp)
+    start = time.time()
+    for _ in range(args.num_iters):
+        forecaster.step(inp)
+    print("step latency: %.3f ms" % (1e3 * (time.time() - start) / args.num_iters))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    sub = parser.add_subparsers(dest="command")
+    export = sub.add_parser("export", help="convert a checkpoint to .npz")
+    export.add_argument("checkpoint")
+    export.add_argument("output")
+    bench = sub.add_parser("bench", help="time single series steps")
+    bench.add_argument("weights")
+    bench.add_argument("--model", default="TLSTM", choices=sorted(CELLS))
+    bench.add_argument("--hidden_size", type=int, default=8)
+    bench.add_argument("--num_lags", type=int, default=2)
+    bench.add_argument("--num_layers", type=int, default=2)
+    bench.add_argument("--num_freq", type=int, nargs="+", default=[2],
+                        help="MTRNN frequency, or frequencies of every resolution")
+    bench.add_argument("--rank", type=int, default=2)
+    bench.add_argument("--num_iters", type=int, default=1000)
+    args = parser.parse_args()
+    if args.command == "export":
+        export_weights(args.checkpoint, args.output)
+    elif args.command == "bench":
+        _bench(args)
+    else:
+        parser.print_help()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,149 @@
+"""Calibration and accuracy-versus-latency report of quantized NumPy forecasters.
+
+Quantizes the tt cores, weight matrices and biases of weights exported with
+trnn_numpy.py to int8 (per-core, per-rank-slice scales) and float16, picks the
+int8 clip ratio on training batches, and compares the resident footprint of
+an idle model (quantized weights only) and of a loaded one (plus its float32
+cells), the load (dequantization) and step latencies and the validation error
+of every variant:
+
+    python trnn_quant.py tlstm.npz --data_path=./data.npy --model=TLSTM \
+        --hidden_size=8 --rank=2 --output=tlstm_int8.npz
+"""
+
+from __future__ import print_function
+
+import argparse
+import time
+
+import numpy as np
+
+from trnn_numpy import CELLS, TensorRNNForecaster, load_weights, quantize_weights, \
+    save_weights, num_freq_arg
+
+CLIP_RATIOS = (1.0, 0.9, 0.8, 0.7, 0.6)
+
+
+def calibration_batches(dataset, batch_size, num_batches, burn_in_steps):
+    """(enc_inps, dec_outs) batches of a DataSetS2S, or of a DataSet whose
+    windows are split after burn_in_steps"""
+    batches = []
+    for _ in range(num_batches):
+        # the datasets reuse their batch arrays
+        batch = [np.copy(array) for array in dataset.next_batch(batch_size)]
+        if len(batch) == 3:
+            enc_inps, _, dec_outs = batch
+        else:
+            inps = batch[0]
+            enc_inps, dec_outs = inps[:, :burn_in_steps], inps[:, burn_in_steps:]
+        batches.append((enc_inps, dec_outs))
+    return batches
+
+
+def forecast_rmse(forecaster, batches, targets=None):
+    """RMSE of the forecasts over batches against the dec_outs of the
+    batches, or against targets (one array per batch)"""
+    sq_err, count = 0.0, 0
+    for k, (enc_inps, dec_outs) in enumerate(batches):
+        pred = forecaster.forecast(enc_inps, dec_outs.shape[1])
+        ref = dec_outs if targets is None else targets[k]
+        sq_err += np.sum(np.square(pred - ref))
+        count += pred.size
+    return np.sqrt(sq_err / count)
+
+
+def calibrate(weights, batches, forecaster_args, clip_ratios=CLIP_RATIOS):
+    """int8 clip ratio of weights with the forecasts closest to the float32
+    forecasts on batches. Returns (clip ratio, rmse to float32)."""
+    reference = TensorRNNForecaster(weights, **forecaster_args)
+    targets = [reference.forecast(enc_inps, dec_outs.shape[1]) for enc_inps, dec_outs in batches]
+    best = None
+    for clip in clip_ratios:
+        forecaster = TensorRNNForecaster(quantize_weights(weights, "int8", clip), **forecaster_args)
+        err = forecast_rmse(forecaster, batches, targets)
+        if best is None or err < best[1]:
+            best = (clip, err)
+    return best
+
+
+def step_latency(forecaster, num_iters=1000):
+    """ms per single series step"""
+    forecaster.reset(1)
+    inp = np.zeros((1, forecaster.input_size), dtype=np.float32)
+    for _ in range(10):
+        forecaster.step(inp)
+    start = time.time()
+    for _ in range(num_iters):
+        forecaster.step(inp)
+    return 1e3 * (time.time() - start) / num_iters
+
+
+def load_latency(forecaster, num_iters=100):
+    """ms to dequantize the weights of an idle forecaster into its cells"""
+    start = time.time()
+    for _ in range(num_iters):
+        forecaster.unload()
+        forecaster.load()
+    return 1e3 * (time.time() - start) / num_iters
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("weights", help=".npz written by trnn_numpy.py export")
+    parser.add_argument("--data_path", default="./data.npy")
+    parser.add_argument("--model", default="TLSTM", choices=sorted(CELLS))
+    parser.add_argument("--burn_in_steps", type=int, default=12)
+    parser.add_argument("--test_steps", type=int, default=None)
+    parser.add_argument("--hidden_size", type=int, default=8)
+    parser.add_argument("--num_lags", type=int, default=2)
+    parser.add_argument("--num_layers", type=int, default=2)
+    parser.add_argument("--num_freq", type=int, nargs="+", default=[2],
+                        help="MTRNN frequency, or frequencies of every resolution")
+    parser.add_argument("--rank", type=int, default=2)
+    parser.add_argument("--batch_size", type=int, default=50)
+    parser.add_argument("--num_calibration_batches", type=int, default=10)
+    parser.add_argument("--num_iters", type=int, default=1000)
+    parser.add_argument("--dtype", default="int8", choices=["int8", "float16"],
+                        help="dtype of the saved quantized weights")
+    parser.add_argument("--output", default=None, help="quantized .npz output")
+    args = parser.parse_args()
+
+    from reader import read_data_sets
+    dataset, _ = read_data_sets(args.data_path, True, args.burn_in_steps, args.test_steps)
+    batches = calibration_batches(dataset.train, args.batch_size,
+                                  args.num_calibration_batches, args.burn_in_steps)
+    valid = dataset.validation
+    valid_batches = [(valid.enc_inps, valid.dec_outs)]
+
+    forecaster_args = dict(model=args.model, hidden_size=args.hidden_size,
+                           num_lags=args.num_lags, rank_vals=[args.rank],
+                           num_layers=args.num_layers, num_freq=num_freq_arg(args.num_freq))
+    weights = load_weights(args.weights)
+    clip, calib_err = calibrate(weights, batches, forecaster_args)
+    variants = [("float32", weights),
+                ("float16", quantize_weights(weights, "float16")),
+                ("int8", quantize_weights(weights, "int8", clip))]
+
+    print('='*80)
+    print('|int8 clip ratio|', clip, '|calibration rmse to float32|', calib_err)
+    print('%-8s %12s %12s %10s %10s %12s' % ('dtype', 'idle bytes', 'loaded bytes',
+                                            'load ms', 'step ms', 'valid rmse'))
+    float_bytes = None
+    for name, variant in variants:
+        forecaster = TensorRNNForecaster(variant, **forecaster_args)
+        idle_bytes = forecaster.nbytes
+        if float_bytes is None:
+            float_bytes = idle_bytes
+        load_ms = load_latency(forecaster)
+        loaded_bytes = forecaster.nbytes
+        print('%-8s %12d %12d %10.3f %10.3f %12.6f  (idle %.2fx smaller)' % (
+            name, idle_bytes, loaded_bytes, load_ms, step_latency(forecaster, args.num_iters),
+            forecast_rmse(forecaster, valid_batches), float(float_bytes) / idle_bytes))
+
+    if args.output:
+        save_weights(args.output, dict(variants)[args.dtype])
+        print("Quantized weights saved in file: %s" % args.output)
+
+
+if __name__ == "__main__":
+    main()
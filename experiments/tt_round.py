@@ -0,0 +1,224 @@
+"""Post-training TT rank truncation (TT-SVD rounding) of tensor RNN checkpoints.
+
+Rounds the cores of every tensor train in a trained TLSTM/TRNN/TALSTM/MTRNN
+checkpoint to a target rank and/or relative error tolerance, writes a smaller
+checkpoint that the same cells load with the reduced rank, and reports the
+validation error against the parameter and FLOP reduction:
+
+    python tt_round.py --model=TLSTM --data_path=./data.npy \
+        --checkpoint_path=./log/tlstm/ --save_path=./log/tlstm_r2/ \
+        --rank=8 --max_rank=2
+"""
+
+from __future__ import print_function
+
+import os
+
+import numpy as np
+
+
+def tt_round(cores, max_rank=None, tolerance=None):
+    """TT-SVD rounding of cores [r_i, D_i, r_{i+1}] (r_0 = 1, the last rank is
+    the open output dimension and is kept).
+    max_rank: upper bound on every inner rank
+    tolerance: relative Frobenius error of the rounded tensor train
+    """
+    cores = [np.array(core, dtype=np.float64) for core in cores]
+    num_orders = len(cores)
+
+    # right-to-left orthogonalization: every core but the first has
+    # orthonormal rows once reshaped to [r_i, D_i * r_{i+1}]
+    for k in range(num_orders - 1, 0, -1):
+        r_in, dim, r_out = cores[k].shape
+        q, r = np.linalg.qr(cores[k].reshape(r_in, dim * r_out).T)
+        cores[k] = q.T.reshape(-1, dim, r_out)
+        cores[k - 1] = np.einsum("adb,cb->adc", cores[k - 1], r)
+
+    # the norm of the whole tensor train now sits in the first core
+    delta = 0.0
+    if tolerance and num_orders > 1:
+        delta = tolerance * np.linalg.norm(cores[0]) / np.sqrt(num_orders - 1)
+
+    # left-to-right truncated SVDs
+    for k in range(num_orders - 1):
+        r_in, dim, r_out = cores[k].shape
+        u, s, v = np.linalg.svd(cores[k].reshape(r_in * dim, r_out), full_matrices=False)
+        # smallest rank with a truncation error below delta
+        tail = np.sqrt(np.cumsum(s[::-1] ** 2))[::-1]
+        rank = max(1, int(np.sum(tail > delta)))
+        if max_rank:
+            rank = min(rank, max_rank)
+        cores[k] = u[:, :rank].reshape(r_in, dim, rank)
+        cores[k + 1] = np.einsum("ab,bdc->adc", s[:rank, None] * v[:rank], cores[k + 1])
+    return [core.astype(np.float32) for core in cores]
+
+
+def tt_ranks(cores):
+    """inner ranks r_1 .. r_{K-1}"""
+    return [core.shape[2] for core in cores[:-1]]
+
+
+def pad_ranks(cores, rank_vals):
+    """Zero-pad the inner ranks of cores up to rank_vals (exact)"""
+    ranks = [1] + list(rank_vals) + [cores[-1].shape[2]]
+    padded = []
+    for k, core in enumerate(cores):
+        r_in, dim, r_out = core.shape
+        new_core = np.zeros((ranks[k], dim, ranks[k + 1]), dtype=core.dtype)
+        new_core[:r_in, :, :r_out] = core
+        padded.append(new_core)
+    return padded
+
+
+def tt_flops(cores):
+    """multiply-adds per example of contracting cores against a state vector
+    one core at a time (tensor_train_contraction_fused)"""
+    flops = 0
+    for core in cores:
+        r_in, dim, r_out = core.shape
+        flops += dim * r_in * r_out + r_in * r_out
+    return flops
+
+
+def find_tt_networks(weights):
+    """{scope: [core_0, core_1, ...]} of every tensor train in weights"""
+    networks = {}
+    for name in weights:
+        scope, _, core = name.rpartition("/")
+        if core.startswith("core_"):
+            networks.setdefault(scope, []).append(name)
+    for scope in networks:
+        networks[scope].sort(key=lambda name: int(name.rpartition("_")[2]))
+    return networks
+
+
+def round_weights(weights, max_rank=None, tolerance=None):
+    """Round every tensor train in weights to a rank shared by all of them
+    (the cells take a single rank_vals); returns new weights and rank_vals"""
+    networks = find_tt_networks(weights)
+    rounded = {}
+    rank_vals = None
+    for scope, names in networks.items():
+        cores = tt_round([weights[name] for name in names], max_rank, tolerance)
+        rounded[scope] = cores
+        ranks = tt_ranks(cores)
+        rank_vals = ranks if rank_vals is None else [max(a, b) for a, b in zip(rank_vals, ranks)]
+    new_weights = dict(weights)
+    for scope, cores in rounded.items():
+        for name, core in zip(networks[scope], pad_ranks(cores, rank_vals)):
+            new_weights[name] = core
+    return new_weights, rank_vals
+
+
+def unflatten_cores(weights, var_shapes):
+    """Cut flat tt vectors (the layout before per-core variables) into the
+    cores named in var_shapes {name: shape}"""
+    weights = dict(weights)
+    for scope, names in find_tt_networks(var_shapes).items():
+        if names[0] in weights or scope not in weights:
+            continue
+        flat = weights.pop(scope)
+        offset = 0
+        for name in names:
+            size = int(np.prod(var_shapes[name]))
+            weights[name] = flat[offset:offset + size].reshape(var_shapes[name])
+            offset += size
+    return weights
+
+
+def _tt_stats(weights):
+    networks = find_tt_networks(weights)
+    params = sum(weights[name].size for names in networks.values() for name in names)
+    flops = sum(tt_flops([weights[name] for name in names]) for names in networks.values())
+    return params, flops
+
+
+def main():
+    import tensorflow as tf
+    from reader import read_data_sets
+    from model_seq2seq import TLSTM, TRNN, TALSTM, MTRNN
+    from train_config import TrainConfig
+    from trnn_numpy import num_freq_arg
+
+    flags = tf.flags
+    flags.DEFINE_string("model", "TLSTM", "Model of the checkpoint.")
+    flags.DEFINE_string("data_path", "./data.npy", "Data input directory.")
+    flags.DEFINE_string("checkpoint_path", "./log/lstm/", "Trained model checkpoint.")
+    flags.DEFINE_string("save_path", "./log/lstm_rounded/", "Rounded model output directory (created).")
+    flags.DEFINE_integer("burn_in_steps", 12, "burn in steps")
+    flags.DEFINE_integer("test_steps", None, "test steps size")
+    flags.DEFINE_integer("hidden_size", 8, "hidden layer size")
+    flags.DEFINE_integer("num_layers", 2, "number of stacked layers")
+    flags.DEFINE_integer("num_lags", 2, "number of previous hidden states")
+    flags.DEFINE_list("num_freq", ["2"], "MTRNN frequency, or frequencies of every resolution e.g. 1,2,4")
+    flags.DEFINE_list("rank", ["2"], "ranks of the trained tt decomposition, e.g. 2 or 4,2")
+    flags.DEFINE_integer("max_rank", None, "target rank of the rounded tt decomposition")
+    flags.DEFINE_float("tolerance", None, "relative error tolerance of the rounding")
+    FLAGS = flags.FLAGS
+    trained_rank_vals = [int(rank) for rank in FLAGS.rank]
+
+    Model = {"TLSTM": TLSTM, "TRNN": TRNN, "TALSTM": TALSTM, "MTRNN": MTRNN}[FLAGS.model]
+
+    checkpoint_path = FLAGS.checkpoint_path
+    if tf.gfile.IsDirectory(checkpoint_path):
+        checkpoint_path = tf.train.latest_checkpoint(checkpoint_path)
+    reader = tf.train.NewCheckpointReader(checkpoint_path)
+    weights = {name: reader.get_tensor(name) for name in reader.get_variable_to_shape_map()}
+
+    dataset, stats = read_data_sets(FLAGS.data_path, True, FLAGS.burn_in_steps, FLAGS.test_steps)
+    valid = dataset.validation
+    num_input = stats['num_input']
+    inp_steps = valid.enc_inps.shape[1]
+    out_steps = valid.dec_outs.shape[1]
+
+    def _evaluate(rank_vals, values, save_path=None):
+        """validation loss of the model with rank_vals and variable values"""
+        tf.reset_default_graph()
+        config = TrainConfig()
+        config.burn_in_steps = FLAGS.burn_in_steps
+        config.hidden_size = FLAGS.hidden_size
+        config.num_layers = FLAGS.num_layers
+        config.num_lags = FLAGS.num_lags
+        config.num_freq = num_freq_arg([int(freq) for freq in FLAGS.num_freq])
+        config.rank_vals = rank_vals
+        X = tf.placeholder("float", [None, inp_steps, num_input])
+        Y = tf.placeholder("float", [None, out_steps, num_input])
+        Z = tf.placeholder("float", [None, out_steps, num_input])
+        with tf.variable_scope("Model", reuse=None):
+            pred = Model(X, Y, False, config)
+        loss = tf.sqrt(tf.reduce_mean(tf.squared_difference(pred, Z)))
+        model_vars = tf.global_variables()
+        values = unflatten_cores(values, {var.op.name: var.get_shape().as_list() for var in model_vars})
+        with tf.Session() as sess:
+            for var in model_vars:
+                var.load(values[var.op.name], sess)
+            va_loss = sess.run(loss, feed_dict={X: valid.enc_inps, Y: valid.dec_inps, Z: valid.dec_outs})
+            if save_path is not None:
+                # model variables only, the optimizer slots do not match the new ranks
+                save_path = tf.train.Saver(model_vars).save(sess, save_path)
+        return va_loss, values, save_path
+
+    if not tf.gfile.IsDirectory(FLAGS.save_path):
+        tf.gfile.MakeDirs(FLAGS.save_path)
+    va_loss, weights, _ = _evaluate(trained_rank_vals, weights)
+    new_weights, rank_vals = round_weights(weights, FLAGS.max_rank, FLAGS.tolerance)
+    new_va_loss, _, save_path = _evaluate(rank_vals, new_weights,
+                                          os.path.join(FLAGS.save_path, "model.ckpt"))
+
+    params, flops = _tt_stats(weights)
+    new_params, new_flops = _tt_stats(new_weights)
+    print('='*80)
+    print('|rank|', trained_rank_vals, '->', rank_vals)
+    print('|tt params|', params, '->', new_params, '(%.2fx smaller)' % (float(params) / new_params))
+    print('|tt flops/step|', flops, '->', new_flops, '(%.2fx fewer)' % (float(flops) / new_flops))
+    print('|valid loss|', va_loss, '->', new_va_loss, '(%+.4f)' % (new_va_loss - va_loss))
+    print("Rounded model saved in file: %s" % save_path)
+    with open(os.path.join(FLAGS.save_path, "rounding.out"), 'w') as f:
+        f.write('rank_vals:' + str(rank_vals) + '\n')
+        f.write('tt_params:' + str(params) + '\t' + 'rounded_tt_params:' + str(new_params) + '\n')
+        f.write('tt_flops:' + str(flops) + '\t' + 'rounded_tt_flops:' + str(new_flops) + '\n')
+        f.write('valid_error:' + str(va_loss) + '\t' + 'rounded_valid_error:' + str(new_va_loss) + '\n')
+
+
+if __name__ == "__main__":
+    main()